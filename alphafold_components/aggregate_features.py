@@ -16,7 +16,7 @@
 
 import os
 
-from typing import Any, Mapping, MutableMapping, Optional, Sequence, Union
+from typing import Any, Iterable, Mapping, MutableMapping, Optional, Sequence, Union
 from kfp.v2 import dsl
 from kfp.v2.dsl import Output, Input, Artifact, Dataset
 
@@ -33,7 +33,13 @@ def aggregate_features(
     msa3: Input[Dataset],
     msa4: Input[Dataset],
     template_features: Input[Dataset],
-    features: Output[Dataset]):
+    features: Output[Dataset],
+    verify_msa_deduplication: bool=False,
+    max_workers: int=1,
+    compact_features: bool=True,
+    max_msa_hits: int=0,
+    feature_cache_dir: str='',
+    feature_cache_max_gb: float=100.0):
     """Aggregates MSAs and template features to create model features 
     
     In the prototype, we assume a fixed number of inputs, mirroring the sample
@@ -41,13 +47,48 @@ def aggregate_features(
     consider "dynamic" at runtime or at least highly configurable at compile time
     component.
 
+    Duplicate MSA rows are dropped based on 128-bit digests of the aligned
+    sequences. Set `verify_msa_deduplication` to compare the encoded rows on
+    every digest hit as well.
+
+    With `max_workers` > 1 the MSA files are read and encoded in parallel by
+    forked worker processes and merged in input order, so the first MSA still
+    wins during deduplication. Small inputs are always processed serially.
+
+    With `compact_features` integer features such as the MSA and the
+    deletion matrix are stored in the narrowest dtype that holds their
+    values. The predict step widens them back when loading.
+
+    With `max_msa_hits` > 0 each MSA is capped to its query and the first
+    `max_msa_hits` hits in file order, i.e. the best ranked hits of the
+    search tool, before deduplication. The number of rows dropped from each
+    MSA is recorded in the `msa_depths` metadata of `features`.
+
+    With `feature_cache_dir`, e.g. a mounted bucket under /gcs, the inputs
+    are hashed first and a bundle aggregated earlier from the same inputs
+    is reused. The cache keeps at most `feature_cache_max_gb` of bundles and
+    evicts the least recently used ones; it shares the layout of
+    `alphafold_runners/feature_cache.py`.
+
     """
 
+    import collections
+    import fcntl
+    import glob
+    import hashlib
+    import itertools
+    import json
+    import multiprocessing
     import os
     import logging
     import numpy as np
     import pickle
+    import queue
+    import shutil
+    import string
+    import struct
     import time
+    import zipfile
 
     
     from alphafold.common import residue_constants
@@ -74,57 +115,309 @@ def aggregate_features(
         return features
         
         
-    def _make_msa_features(msas: Sequence[parsers.Msa]) -> dict:
-        """Constructs a feature dict of MSA features."""
+    # MSA identifiers are stored as int32 codes per row plus a deduplicated
+    # vocabulary, e.g. `msa_species_identifiers_codes` and
+    # `msa_species_identifiers_vocabulary`
+    identifier_features = ['msa_uniprot_accession_identifiers', 'msa_species_identifiers']
+
+    # 256-entry byte -> HHblits token id lookup table used to encode MSAs
+    hhblits_aa_lookup = np.full((256,), -1, dtype=np.int16)
+    for res, token in residue_constants.HHBLITS_AA_TO_ID.items():
+        hhblits_aa_lookup[ord(res)] = token
+
+
+    def _encode_sequences(sequences: Sequence[str], num_res: int) -> np.ndarray:
+        """Encodes aligned sequences into a preallocated token matrix."""
+        int_msa = np.empty((len(sequences), num_res), dtype=np.int32)
+        chunk_size = 4096
+        for start in range(0, len(sequences), chunk_size):
+            chunk = sequences[start:start + chunk_size]
+            if any(len(sequence) != num_res for sequence in chunk):
+                raise ValueError(f'All MSA sequences must have length {num_res}.')
+            residues = np.frombuffer(
+                ''.join(chunk).encode('ascii', errors='replace'), dtype=np.uint8)
+            tokens = hhblits_aa_lookup[residues.reshape(len(chunk), num_res)]
+            if (tokens < 0).any():
+                res = chr(residues.reshape(tokens.shape)[tokens < 0][0])
+                raise ValueError(f'Unsupported residue in MSA sequence: {res!r}')
+            int_msa[start:start + len(chunk)] = tokens
+        return int_msa
+
+
+    def _make_msa_features(
+        msas: Sequence[Iterable[tuple]], digests: Optional[list]=None) -> dict:
+        """Constructs a feature dict of MSA features.
+
+        If `digests` is given, the digest of every kept row is appended to it.
+        """
         if not msas:
             raise ValueError('At least one MSA must be provided.')
 
-        int_msa = []
-        deletion_matrix = []
-        uniprot_accession_ids = []
-        species_ids = []
-        seen_sequences = set()
-        for msa_index, msa in enumerate(msas):
-            if not msa:
-                raise ValueError(f'MSA {msa_index} must contain at least one sequence.')
-            for sequence_index, sequence in enumerate(msa.sequences):
-                if sequence in seen_sequences:
+        msa_chunks = []
+        deletion_chunks = []
+        pending_sequences = []
+        pending_deletions = []
+        chunk_size = 4096
+        num_rows = 0
+        identifier_codes = []
+        prefix_codes = {}
+        vocabularies = {name: {} for name in identifier_features}
+        seen_digests = {} if verify_msa_deduplication else set()
+
+        def _identifier_codes(description):
+            """Returns interned identifier codes, parsing each description prefix once."""
+            # get_identifiers only reads the first word, up to a /start-end suffix
+            words = description.split(None, 1)
+            prefix = words[0].partition('/')[0] if words else ''
+            codes = prefix_codes.get(prefix)
+            if codes is None:
+                identifiers = msa_identifiers.get_identifiers(prefix)
+                values = [identifiers.uniprot_accession_id, identifiers.species_id]
+                codes = tuple(
+                    vocabularies[name].setdefault(
+                        value.encode('utf-8'), len(vocabularies[name]))
+                    for name, value in zip(identifier_features, values))
+                prefix_codes[prefix] = codes
+            return codes
+
+        def _row_tokens(row_index):
+            chunk, offset = divmod(row_index, chunk_size)
+            if chunk < len(msa_chunks):
+                return msa_chunks[chunk][offset]
+            return _encode_sequences([pending_sequences[offset]], num_res)[0]
+
+        def _new_row_digest(sequence):
+            """Returns the digest of a sequence, or None if it is a duplicate."""
+            digest = hashlib.blake2b(
+                sequence.encode('ascii', errors='replace'), digest_size=16).digest()
+            if not verify_msa_deduplication:
+                if digest in seen_digests:
+                    return None
+                seen_digests.add(digest)
+                return digest
+            row_indices = seen_digests.get(digest, [])
+            if isinstance(row_indices, int):
+                row_indices = [row_indices]
+            if row_indices:
+                tokens = _encode_sequences([sequence], num_res)[0]
+                if any(np.array_equal(_row_tokens(i), tokens) for i in row_indices):
+                    return None
+                logging.warning('Digest collision resolved during MSA deduplication')
+            seen_digests[digest] = row_indices + [num_rows] if row_indices else num_rows
+            return digest
+
+        def _flush_pending_rows():
+            if pending_sequences:
+                msa_chunks.append(_encode_sequences(pending_sequences, num_res))
+                deletion_chunks.append(np.array(pending_deletions, dtype=np.int32))
+                pending_sequences.clear()
+                pending_deletions.clear()
+
+        for msa_index, records in enumerate(msas):
+            num_records = 0
+            for sequence, deletion_row, description in records:
+                num_records += 1
+                if not num_rows:
+                    num_res = len(sequence)
+                digest = _new_row_digest(sequence)
+                if digest is None:
                     continue
-                seen_sequences.add(sequence)
-                int_msa.append(
-                    [residue_constants.HHBLITS_AA_TO_ID[res] for res in sequence])
-                deletion_matrix.append(msa.deletion_matrix[sequence_index])
-                identifiers = msa_identifiers.get_identifiers(
-                    msa.descriptions[sequence_index])
-                uniprot_accession_ids.append(
-                    identifiers.uniprot_accession_id.encode('utf-8'))
-                species_ids.append(identifiers.species_id.encode('utf-8'))
-
-        num_res = len(msas[0].sequences[0])
-        num_alignments = len(int_msa)
+                if digests is not None:
+                    digests.append(digest)
+                pending_sequences.append(sequence)
+                pending_deletions.append(deletion_row)
+                num_rows += 1
+                if len(pending_sequences) == chunk_size:
+                    _flush_pending_rows()
+                identifier_codes.append(_identifier_codes(description))
+            if not num_records:
+                raise ValueError(f'MSA {msa_index} must contain at least one sequence.')
+        _flush_pending_rows()
+
+        num_alignments = num_rows
         features = {}
-        features['deletion_matrix_int'] = np.array(deletion_matrix, dtype=np.int32)
-        features['msa'] = np.array(int_msa, dtype=np.int32)
+        features['deletion_matrix_int'] = np.concatenate(deletion_chunks)
+        features['msa'] = np.concatenate(msa_chunks)
         features['num_alignments'] = np.array(
             [num_alignments] * num_res, dtype=np.int32)
-        features['msa_uniprot_accession_identifiers'] = np.array(
-            uniprot_accession_ids, dtype=np.object_)
-        features['msa_species_identifiers'] = np.array(species_ids, dtype=np.object_)
+        identifier_codes = np.array(identifier_codes, dtype=np.int32)
+        for column, name in enumerate(identifier_features):
+            features[f'{name}_codes'] = np.ascontiguousarray(identifier_codes[:, column])
+            features[f'{name}_vocabulary'] = np.array(
+                list(vocabularies[name]), dtype=np.object_)
         return features
 
 
-    def _read_msa(msa_path: str, msa_format: str):
-
-        if os.path.exists(msa_path):
-            with open(msa_path) as f:
-                msa = f.read()
-            if msa_format == 'sto':
-                msa = parsers.parse_stockholm(msa)
-            elif msa_format == 'a3m':
-                msa = parsers.parse_a3m(msa)
-            else:
-                raise RuntimeError(f'Unsupported MSA format: {msa_format}') 
-        return msa
+    max_msa_rows = max_msa_hits + 1 if max_msa_hits > 0 else None
+
+    def _a3m_records(f, depth):
+        """Yields (sequence, deletion row, description) from an A3M file."""
+        deletion_table = str.maketrans('', '', string.ascii_lowercase)
+        description, chunks = None, []
+        for line in itertools.chain(f, ['>']):
+            line = line.strip()
+            if line.startswith('>'):
+                if description is not None:
+                    a3m_sequence = ''.join(chunks)
+                    residues = np.frombuffer(
+                        a3m_sequence.encode('ascii', errors='replace'), dtype=np.uint8)
+                    is_insertion = (residues >= ord('a')) & (residues <= ord('z'))
+                    insertions = np.cumsum(is_insertion, dtype=np.int32)
+                    deletion_row = np.diff(insertions[~is_insertion], prepend=0)
+                    yield (a3m_sequence.translate(deletion_table),
+                           deletion_row, description)
+                depth['num_rows'] += 1
+                # Rows beyond the depth cap are only counted
+                keep = max_msa_rows is None or depth['num_rows'] <= max_msa_rows
+                description, chunks = (line[1:] if keep else None), []
+            elif line and description is not None:
+                chunks.append(line)
+        # The trailing '>' is not a row
+        depth['num_rows'] -= 1
+
+
+    def _stockholm_records(f, depth):
+        """Yields (sequence, deletion row, description) from a Stockholm file."""
+        name_to_segments = collections.OrderedDict()
+        dropped_names = set()
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith(('#', '//')):
+                continue
+            name, sequence = line.split()
+            if name not in name_to_segments:
+                # Rows beyond the depth cap are only counted
+                if max_msa_rows is not None and len(name_to_segments) >= max_msa_rows:
+                    dropped_names.add(name)
+                    continue
+                name_to_segments[name] = []
+            name_to_segments[name].append(sequence)
+        depth['num_rows'] = len(name_to_segments) + len(dropped_names)
+
+        keep_columns = None
+        while name_to_segments:
+            name, segments = name_to_segments.popitem(last=False)
+            residues = np.frombuffer(
+                ''.join(segments).encode('ascii', errors='replace'), dtype=np.uint8)
+            if keep_columns is None:
+                query_gaps = residues == ord('-')
+                keep_columns = ~query_gaps
+            insertions = np.cumsum(
+                query_gaps & (residues != ord('-')), dtype=np.int32)
+            deletion_row = np.diff(insertions[keep_columns], prepend=0)
+            yield (residues[keep_columns].tobytes().decode('ascii'),
+                   deletion_row, name)
+
+
+    def _read_msa(msa_path: str, msa_format: str, depth: dict):
+        """Lazily reads MSA records straight from the file handle.
+
+        The total number of rows in the file is counted into `depth`.
+        """
+        if msa_format == 'sto':
+            reader = _stockholm_records
+        elif msa_format == 'a3m':
+            reader = _a3m_records
+        else:
+            raise RuntimeError(f'Unsupported MSA format: {msa_format}') 
+        with open(msa_path) as f:
+            yield from reader(f, depth)
+
+
+    def _merge_msa_features(msa_features) -> dict:
+        """Merges per-MSA features in input order; the first occurrence of a row wins."""
+        seen_digests = {}
+        keep_masks = []
+        for msa_index, (features, digests, _) in enumerate(msa_features):
+            keep = np.zeros((len(digests),), dtype=bool)
+            for row_index, digest in enumerate(digests):
+                if not verify_msa_deduplication:
+                    if digest not in seen_digests:
+                        seen_digests[digest] = None
+                        keep[row_index] = True
+                    continue
+                kept_rows = seen_digests.setdefault(digest, [])
+                tokens = features['msa'][row_index]
+                if any(np.array_equal(msa_features[m][0]['msa'][r], tokens)
+                       for m, r in kept_rows):
+                    continue
+                if kept_rows:
+                    logging.warning('Digest collision resolved during MSA deduplication')
+                kept_rows.append((msa_index, row_index))
+                keep[row_index] = True
+            keep_masks.append(keep)
+
+        merged = {}
+        for key in ['deletion_matrix_int', 'msa']:
+            merged[key] = np.concatenate([
+                features[key][keep]
+                for (features, _, _), keep in zip(msa_features, keep_masks)])
+        for name in identifier_features:
+            # Remap the codes of every MSA into one vocabulary, adding values
+            # in order of first use as the serial path does
+            vocabulary = {}
+            merged_codes = []
+            for (features, _, _), keep in zip(msa_features, keep_masks):
+                codes = features[f'{name}_codes'][keep]
+                unique_codes, first_rows = np.unique(codes, return_index=True)
+                used_codes = unique_codes[np.argsort(first_rows)]
+                remap = np.zeros((len(features[f'{name}_vocabulary']),), dtype=np.int32)
+                remap[used_codes] = [
+                    vocabulary.setdefault(value, len(vocabulary))
+                    for value in features[f'{name}_vocabulary'][used_codes]]
+                merged_codes.append(remap[codes])
+            merged[f'{name}_codes'] = np.concatenate(merged_codes)
+            merged[f'{name}_vocabulary'] = np.array(list(vocabulary), dtype=np.object_)
+        num_res = merged['msa'].shape[1]
+        merged['num_alignments'] = np.array(
+            [len(merged['msa'])] * num_res, dtype=np.int32)
+        return merged
+
+
+    def _make_msa_features_in_parallel(msa_inputs, max_workers):
+        """Builds per-MSA features in forked processes and merges them in order.
+
+        Returns the merged features and the depth of every MSA.
+
+        Forking lets the workers run the nested helpers of this component,
+        which could not be pickled for a process pool.
+        """
+        ctx = multiprocessing.get_context('fork')
+        results = ctx.Queue()
+
+        def _worker(index, msa_path, msa_format):
+            try:
+                digests = []
+                depth = {'num_rows': 0}
+                features = _make_msa_features(
+                    [_read_msa(msa_path, msa_format, depth)], digests=digests)
+                results.put((index, (features, digests, depth), None))
+            except Exception as e:
+                results.put((index, None, repr(e)))
+
+        pending = list(enumerate(msa_inputs))
+        processes = []
+        msa_features = {}
+        while len(msa_features) < len(msa_inputs):
+            while pending and len(processes) - len(msa_features) < max_workers:
+                index, (msa_path, msa_format) = pending.pop(0)
+                process = ctx.Process(target=_worker, args=(index, msa_path, msa_format))
+                process.start()
+                processes.append(process)
+            try:
+                index, features, error = results.get(timeout=10)
+            except queue.Empty:
+                if any(p.exitcode not in (None, 0) for p in processes):
+                    raise RuntimeError('An MSA worker exited unexpectedly')
+                continue
+            if error:
+                raise RuntimeError(f'Failed to process MSA {msa_inputs[index][0]}: {error}')
+            msa_features[index] = features
+        for process in processes:
+            process.join()
+
+        msa_features = [msa_features[index] for index in range(len(msa_inputs))]
+        return _merge_msa_features(msa_features), [depth for _, _, depth in msa_features]
 
     def _read_sequence(sequence_path: str):
 
@@ -143,9 +436,135 @@ def aggregate_features(
             template_features = pickle.load(f)
         return template_features
 
+    def _compact_dtype(array):
+        """Returns the narrowest integer dtype that holds the values of `array`."""
+        if array.dtype.kind not in 'iu' or array.size == 0:
+            return array.dtype
+        dtype = np.result_type(np.min_scalar_type(array.min()),
+                               np.min_scalar_type(array.max()))
+        return dtype if dtype.itemsize < array.dtype.itemsize else array.dtype
+
+    def _write_feature_bundle(features, path, compact, metadata):
+        """Writes features as an uncompressed zip of aligned `.npy` members.
+
+        This is the format of `alphafold_runners/feature_bundle.py`, which
+        lets the predict step memory map the arrays it reads.
+        """
+        manifest = {'format': 'feature-bundle', 'version': 2,
+                    'features': {}, 'metadata': metadata}
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED, allowZip64=True) as zf:
+            for key, value in features.items():
+                array = np.asarray(value)
+                is_object = array.dtype == object
+                if is_object:
+                    array = array.astype(np.bytes_)
+                manifest['features'][key] = {
+                    'dtype': 'object' if is_object else array.dtype.str,
+                    'shape': list(array.shape)}
+                if compact and _compact_dtype(array) != array.dtype:
+                    array = array.astype(_compact_dtype(array))
+                    manifest['features'][key]['storage_dtype'] = array.dtype.str
+                name = f'{key}.npy'
+                zinfo = zipfile.ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0))
+                # Pad the local header so the array data is 64-byte aligned,
+                # including the 20-byte Zip64 extra field added by zipfile
+                data_offset = zf.fp.tell() + 30 + len(name) + 4 + 20
+                padding = -data_offset % 64
+                zinfo.extra = struct.pack('<HH', 0xD935, padding) + b'\0' * padding
+                with zf.open(zinfo, 'w', force_zip64=True) as f:
+                    np.lib.format.write_array(f, array, allow_pickle=False)
+            zf.writestr('manifest.json', json.dumps(manifest, indent=2))
+
+    def _feature_cache_key(msa_inputs):
+        """Returns the content hash of the inputs and aggregation options."""
+        hasher = hashlib.sha256()
+        hasher.update(b'features-v1-bundle-v2')
+        inputs = [('sequence', sequence.path)]
+        inputs += [(f'msa:{msa_format}', msa_path) for msa_path, msa_format in msa_inputs]
+        inputs += [('templates', template_features.path)]
+        for label, path in inputs:
+            hasher.update(label.encode('utf-8'))
+            hasher.update(struct.pack('<Q', os.path.getsize(path)))
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(2**20), b''):
+                    hasher.update(block)
+        options = {'verify_deduplication': verify_msa_deduplication,
+                   'compact_features': compact_features,
+                   'max_msa_hits': max_msa_hits}
+        hasher.update(json.dumps(options, sort_keys=True).encode('utf-8'))
+        return hasher.hexdigest()
+
+    def _cached_bundle_manifest(path):
+        """Returns the manifest of a complete cached bundle, or None."""
+        try:
+            with zipfile.ZipFile(path) as zf:
+                manifest = json.loads(zf.read('manifest.json'))
+                names = set(zf.namelist())
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            return None
+        if not all(f'{key}.npy' in names for key in manifest['features']):
+            return None
+        return manifest
+
+    def _update_feature_cache(**increments):
+        """Updates the shared cache stats and evicts entries beyond the size cap."""
+        with open(os.path.join(feature_cache_dir, '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = []
+            for entry_path in glob.glob(os.path.join(feature_cache_dir, '*.npz')):
+                entry_stat = os.stat(entry_path)
+                entries.append((entry_stat.st_mtime, entry_stat.st_size, entry_path))
+            total_size = sum(size for _, size, _ in entries)
+            increments['evictions'] = 0
+            for _, size, entry_path in sorted(entries):
+                if total_size <= feature_cache_max_gb * 2**30:
+                    break
+                os.remove(entry_path)
+                total_size -= size
+                increments['evictions'] += 1
+
+            stats_path = os.path.join(feature_cache_dir, 'stats.json')
+            try:
+                with open(stats_path) as f:
+                    stats = json.load(f)
+            except (OSError, ValueError):
+                stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+            for name, increment in increments.items():
+                stats[name] = stats.get(name, 0) + increment
+            with open(f'{stats_path}.tmp', 'w') as f:
+                json.dump(stats, f)
+            os.replace(f'{stats_path}.tmp', stats_path)
+        lookups = stats['hits'] + stats['misses']
+        return stats['hits'] / lookups if lookups else 0.0
+
     t0 = time.time()
     logging.info('Starting feature aggregation ...')
 
+    msa_inputs = [(msa.path, msa.metadata['data_format'])
+                  for msa in [msa1, msa2, msa3, msa4]]
+    features.metadata['data_format'] = 'npz'
+
+    if feature_cache_dir:
+        os.makedirs(feature_cache_dir, exist_ok=True)
+        cache_key = _feature_cache_key(msa_inputs)
+        cache_entry_path = os.path.join(feature_cache_dir, f'{cache_key}.npz')
+        manifest = _cached_bundle_manifest(cache_entry_path)
+        if manifest is not None:
+            try:
+                shutil.copyfile(cache_entry_path, features.path)
+                os.utime(cache_entry_path)
+            except FileNotFoundError:
+                # Evicted by another process since it was checked
+                manifest = None
+        if manifest is not None:
+            hit_rate = _update_feature_cache(hits=1)
+            features.metadata['msa_depths'] = manifest['metadata'].get('msa_depths', [])
+            features.metadata['feature_cache'] = {'key': cache_key, 'hit': True}
+            logging.info(f'Feature cache hit for {cache_key}, hit rate {hit_rate:.1%}. '
+                         f'Elapsed time: {time.time() - t0}')
+            return
+        logging.info(f'Feature cache miss for {cache_key}')
+
     # Create sequence features
     seq, seq_desc, num_res = _read_sequence(sequence.path) 
     sequence_features = _make_sequence_features(
@@ -153,14 +572,19 @@ def aggregate_features(
         description=seq_desc,
         num_res=num_res)
 
-    msas = []
-    msas.append(_read_msa(msa1.path, msa1.metadata['data_format']))
-    msas.append(_read_msa(msa2.path, msa2.metadata['data_format']))
-    msas.append(_read_msa(msa3.path, msa3.metadata['data_format']))
-    msas.append(_read_msa(msa4.path, msa4.metadata['data_format']))
-    if not msas:
-        raise RuntimeError('No MSAs passed to the component')
-    msa_features = _make_msa_features(msas=msas)
+    total_msa_size = sum(os.path.getsize(msa_path) for msa_path, _ in msa_inputs)
+    if max_workers > 1 and total_msa_size >= 64 * 2**20:
+        logging.info(f'Processing {len(msa_inputs)} MSAs using {max_workers} workers')
+        msa_features, msa_depths = _make_msa_features_in_parallel(msa_inputs, max_workers)
+    else:
+        msa_depths = [{'num_rows': 0} for _ in msa_inputs]
+        msas = [_read_msa(msa_path, msa_format, depth)
+                for (msa_path, msa_format), depth in zip(msa_inputs, msa_depths)]
+        msa_features = _make_msa_features(msas=msas)
+    for (msa_path, _), depth in zip(msa_inputs, msa_depths):
+        depth['num_dropped'] = max(depth['num_rows'] - (max_msa_rows or depth['num_rows']), 0)
+        logging.info(f'MSA {msa_path}: dropped {depth["num_dropped"]} of '
+                     f'{depth["num_rows"]} rows beyond the depth cap')
 
     # Create template features
     template_features = _read_template_features(template_features.path)
@@ -172,9 +596,19 @@ def aggregate_features(
     }
 
     features_path = features.path
-    features.metadata['data_format'] = 'pkl'
-    with open(features_path, 'wb') as f:
-        pickle.dump(model_features, f, protocol=4)
+    features.metadata['msa_depths'] = msa_depths
+    _write_feature_bundle(
+        model_features, features_path, compact=compact_features,
+        metadata={'max_msa_hits': max_msa_hits, 'msa_depths': msa_depths})
+    logging.info(f'Wrote {os.path.getsize(features_path) / 2**20:.1f} MiB of features')
+
+    if feature_cache_dir:
+        if os.path.getsize(features_path) <= feature_cache_max_gb * 2**30:
+            shutil.copyfile(features_path, f'{cache_entry_path}.{os.getpid()}.tmp')
+            os.replace(f'{cache_entry_path}.{os.getpid()}.tmp', cache_entry_path)
+        hit_rate = _update_feature_cache(misses=1)
+        features.metadata['feature_cache'] = {'key': cache_key, 'hit': False}
+        logging.info(f'Feature cache hit rate {hit_rate:.1%}')
 
     t1 = time.time()
     logging.info(f'Feature aggregation completed. Elapsed time: {t1-t0}')
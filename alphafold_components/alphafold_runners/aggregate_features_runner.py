@@ -11,29 +11,54 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-"""A encapsulating AlphaFold feature engineering"""
+"""A encapsulating AlphaFold feature engineering
 
+By default the runner aggregates the features of a single sequence given by
+SEQUENCE_PATH, MSAS_PATH, TEMPLATE_FEATURES_PATH and OUTPUT_FEATURES_PATH.
 
+With BATCH_MANIFEST_PATH it aggregates many sequences in one process
+instead. The manifest is a JSON list of objects with the keys
+`sequence_path`, `msas_path`, `template_features_path` and
+`output_features_path`; relative paths are resolved against the manifest's
+directory. Items are processed by BATCH_WORKERS processes, and items whose
+output already is a complete feature bundle are skipped.
+"""
+
+
+import json
 import logging
 import numpy as np
 import os
 import pathlib
 import pickle
 import sys
+import time
 
-from typing import List
+from concurrent import futures
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
 from alphafold.common import residue_constants
-from alphafold.data import msa_identifiers
 from alphafold.data import parsers
 from alphafold.data import templates
 
+from feature_bundle import is_complete_feature_bundle, write_feature_bundle
+from feature_cache import DEFAULT_MAX_BYTES, FeatureCache, content_key
+from msa_dedup import SequenceDeduplicator, sequence_digest
+from msa_encoding import MsaRowBuffer
+from msa_identifier_codes import IdentifierInterner
+from msa_reader import MsaDepth, MsaRecord, iter_msa_records
+
+
+# Keys of a batch manifest item
+BATCH_ITEM_KEYS = (
+    'sequence_path',
+    'msas_path',
+    'template_features_path',
+    'output_features_path',
+)
 
-# Required inputs
-SEQUENCE_PATH = os.environ['SEQUENCE_PATH']
-MSAS_PATH = os.environ['MSAS_PATH']
-TEMPLATE_FEATURES_PATH = os.environ['TEMPLATE_FEATURES_PATH']
-OUTPUT_FEATURES_PATH = os.environ['OUTPUT_FEATURES_PATH']
+# Below this total MSA size the process pool costs more than it saves
+MIN_PARALLEL_MSA_BYTES = 64 * 2**20
 
 
 def _make_sequence_features(
@@ -53,57 +78,166 @@ def _make_sequence_features(
     return features
 
 
-def _make_msa_features(msas: List[parsers.Msa]) -> dict:
-    """Constructs a feature dict of MSA features."""
-    if not msas:
-        raise ValueError('At least one MSA must be provided.')
+def _msa_feature_dict(
+    rows: MsaRowBuffer,
+    identifiers: IdentifierInterner) -> dict:
+    """Assembles the MSA feature dict from accumulated rows.
 
-    int_msa = []
-    deletion_matrix = []
-    uniprot_accession_ids = []
-    species_ids = []
-    seen_sequences = set()
-    for msa_index, msa in enumerate(msas):
-        if not msa:
-            raise ValueError(f'MSA {msa_index} must contain at least one sequence.')
-        for sequence_index, sequence in enumerate(msa.sequences):
-            if sequence in seen_sequences:
-                continue
-            seen_sequences.add(sequence)
-            int_msa.append(
-                [residue_constants.HHBLITS_AA_TO_ID[res] for res in sequence])
-            deletion_matrix.append(msa.deletion_matrix[sequence_index])
-            identifiers = msa_identifiers.get_identifiers(
-                msa.descriptions[sequence_index])
-            uniprot_accession_ids.append(
-                identifiers.uniprot_accession_id.encode('utf-8'))
-            species_ids.append(identifiers.species_id.encode('utf-8'))
-
-    num_res = len(msas[0].sequences[0])
-    num_alignments = len(int_msa)
+    Species and accession identifiers are stored as integer codes into
+    deduplicated vocabularies, see `msa_identifier_codes`.
+    """
+    num_res = rows.num_res
+    num_alignments = len(rows)
+    int_msa, deletion_matrix = rows.finalize()
     features = {}
-    features['deletion_matrix_int'] = np.array(deletion_matrix, dtype=np.int32)
-    features['msa'] = np.array(int_msa, dtype=np.int32)
+    features['deletion_matrix_int'] = deletion_matrix
+    features['msa'] = int_msa
     features['num_alignments'] = np.array(
         [num_alignments] * num_res, dtype=np.int32)
-    features['msa_uniprot_accession_identifiers'] = np.array(
-        uniprot_accession_ids, dtype=np.object_)
-    features['msa_species_identifiers'] = np.array(species_ids, dtype=np.object_)
+    features.update(identifiers.features())
     return features
 
 
-def _read_msa(msa_path: str, msa_format: str):
+def _log_collisions(seen_sequences: SequenceDeduplicator):
+    if seen_sequences.num_collisions:
+        logging.warning(
+            f'{seen_sequences.num_collisions} digest collisions resolved '
+            'during MSA deduplication')
+
+
+def _make_msa_features(
+    msas: List[Iterable[MsaRecord]],
+    verify_deduplication: bool=False,
+    digests: Optional[List[bytes]]=None) -> dict:
+    """Constructs a feature dict of MSA features.
+
+    Each MSA is consumed record by record and written row by row into
+    preallocated arrays. Duplicate sequences are dropped based on digests,
+    optionally verified against the already encoded rows. If `digests` is
+    given, the digest of every kept row is appended to it.
+    """
+    if not msas:
+        raise ValueError('At least one MSA must be provided.')
+
+    rows = None
+    identifiers = IdentifierInterner()
+    seen_sequences = None
+    for msa_index, records in enumerate(msas):
+        num_records = 0
+        for record in records:
+            num_records += 1
+            if rows is None:
+                rows = MsaRowBuffer(num_res=len(record.sequence), dtype=np.int32)
+                seen_sequences = SequenceDeduplicator(
+                    verify=verify_deduplication, rows=rows)
+            digest = sequence_digest(record.sequence)
+            if not seen_sequences.add_digest(digest, sequence=record.sequence):
+                continue
+            if digests is not None:
+                digests.append(digest)
+            rows.append(record.sequence, record.deletion_row)
+            identifiers.add(record.description)
+        if not num_records:
+            raise ValueError(f'MSA {msa_index} must contain at least one sequence.')
+
+    _log_collisions(seen_sequences)
+    logging.info(f'Parsed identifiers of {identifiers.num_parsed} unique '
+                 f'descriptions for {len(rows)} MSA rows')
+    return _msa_feature_dict(rows, identifiers)
+
+
+def _read_msa(
+    msa_path: str,
+    msa_format: str,
+    max_hits: int=0,
+    depth: Optional[MsaDepth]=None) -> Iterator[MsaRecord]:
+    """Returns a lazy iterator over the records of an MSA file.
+
+    With `max_hits` only the query and the first `max_hits` rows are read,
+    see `msa_reader`.
+    """
+    return iter_msa_records(msa_path, msa_format, max_hits=max_hits, depth=depth)
+
+
+def _log_msa_depths(msa_depths: Dict[str, MsaDepth]):
+    for msa_path, depth in msa_depths.items():
+        logging.info(f'MSA {msa_path}: kept {depth.num_kept} of {depth.num_rows} '
+                     f'rows, dropped {depth.num_dropped} beyond the depth cap')
+
+
+def _load_msa_features(
+    msa_path: str,
+    msa_format: str,
+    verify_deduplication: bool=False,
+    max_hits: int=0) -> Tuple[dict, List[bytes], MsaDepth]:
+    """Builds the features, row digests and depth of a single MSA file.
+
+    This is the unit of work of the parallel path and runs in a worker process.
+    """
+    digests = []
+    depth = MsaDepth()
+    try:
+        features = _make_msa_features(
+            msas=[_read_msa(msa_path, msa_format, max_hits, depth)],
+            verify_deduplication=verify_deduplication,
+            digests=digests)
+    except ValueError as e:
+        raise ValueError(f'Invalid MSA {msa_path}: {e}') from e
+    return features, digests, depth
+
+
+def _merge_msa_features(
+    msa_features: List[Tuple[dict, List[bytes], MsaDepth]],
+    verify_deduplication: bool=False) -> dict:
+    """Merges per-MSA features in order, so the first occurrence of a row wins."""
+    rows = None
+    identifiers = IdentifierInterner()
+    seen_sequences = None
+    for features, digests, _ in msa_features:
+        if rows is None:
+            rows = MsaRowBuffer(num_res=features['msa'].shape[1], dtype=np.int32)
+            seen_sequences = SequenceDeduplicator(
+                verify=verify_deduplication, rows=rows)
+        kept_rows = []
+        for row_index, digest in enumerate(digests):
+            tokens = features['msa'][row_index]
+            if not seen_sequences.add_digest(digest, tokens=tokens):
+                continue
+            rows.append_encoded(tokens, features['deletion_matrix_int'][row_index])
+            kept_rows.append(row_index)
+        identifiers.extend(features, np.array(kept_rows, dtype=np.int64))
+
+    _log_collisions(seen_sequences)
+    return _msa_feature_dict(rows, identifiers)
+
+
+def _make_msa_features_in_parallel(
+    msa_paths: dict,
+    max_workers: int,
+    verify_deduplication: bool=False,
+    max_hits: int=0,
+    msa_depths: Optional[Dict[str, MsaDepth]]=None) -> dict:
+    """Reads, deduplicates and encodes every MSA in a process pool.
+
+    The per-MSA results are merged in the order of `msa_paths`, which keeps
+    the output identical to the serial path. The depth of every MSA is
+    stored in `msa_depths` if given.
+    """
+    max_workers = min(max_workers, len(msa_paths))
+    logging.info(f'Processing {len(msa_paths)} MSAs using {max_workers} workers')
+    with futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        msa_features = list(executor.map(
+            _load_msa_features,
+            msa_paths.keys(),
+            msa_paths.values(),
+            [verify_deduplication] * len(msa_paths),
+            [max_hits] * len(msa_paths)))
+    if msa_depths is not None:
+        msa_depths.update(
+            (msa_path, depth) for msa_path, (_, _, depth) in zip(msa_paths, msa_features))
+    return _merge_msa_features(
+        msa_features, verify_deduplication=verify_deduplication)
 
-    if os.path.exists(msa_path):
-        with open(msa_path) as f:
-            msa = f.read()
-        if msa_format == 'sto':
-            msa = parsers.parse_stockholm(msa)
-        elif msa_format == 'a3m':
-            msa = parsers.parse_a3m(msa)
-        else:
-            raise RuntimeError(f'Unsupported MSA format: {msa_format}') 
-    return msa
 
 def _read_sequence(sequence_path: str):
 
@@ -127,25 +261,67 @@ def aggregate_features(
     sequence_path: str,
     msa_paths: List[dict],
     template_features_path: str,
-    output_features_path: str):
-    """Aggregates MSAs and template features to create model features.""" 
+    output_features_path: str,
+    verify_deduplication: bool=False,
+    max_workers: int=1,
+    compact_features: bool=True,
+    max_msa_hits: int=0,
+    feature_cache_dir: Optional[str]=None,
+    feature_cache_max_bytes: int=DEFAULT_MAX_BYTES):
+    """Aggregates MSAs and template features to create model features.
+
+    With `max_msa_hits` > 0 each MSA is capped to its query and first
+    `max_msa_hits` hits before deduplication. The rows read and dropped per
+    MSA are logged and recorded in the feature bundle manifest.
+
+    With `feature_cache_dir` the inputs are hashed first and, if the same
+    inputs were aggregated before, the cached bundle is returned without
+    reading the MSAs. See `feature_cache`.
+    """
 
     logging.info('Starting feature aggregation ...')
 
+    if not msa_paths:
+        raise RuntimeError('No MSAs passed to the component')
+
+    feature_cache = None
+    if feature_cache_dir:
+        feature_cache = FeatureCache(feature_cache_dir, feature_cache_max_bytes)
+        cache_key = content_key(
+            sequence_path, msa_paths, template_features_path,
+            options={'verify_deduplication': verify_deduplication,
+                     'compact_features': compact_features,
+                     'max_msa_hits': max_msa_hits})
+        if feature_cache.get(cache_key, output_features_path):
+            logging.info(f'Feature cache hit for {cache_key}, '
+                         f'hit rate {feature_cache.stats()["hit_rate"]:.1%}')
+            logging.info(f'Feature aggregation completed. Save to {output_features_path}')
+            return
+        logging.info(f'Feature cache miss for {cache_key}')
+
     # Create sequence features
     seq, seq_desc, num_res = _read_sequence(sequence_path) 
     sequence_features = _make_sequence_features(
         sequence=seq,
         description=seq_desc,
         num_res=num_res)
-    
-    msas = []
-    for msa_path, msa_format in msa_paths.items():
-        msas.append(_read_msa(msa_path, msa_format))
 
-    if not msas:
-        raise RuntimeError('No MSAs passed to the component')
-    msa_features = _make_msa_features(msas=msas)
+    total_msa_size = sum(os.path.getsize(msa_path) for msa_path in msa_paths)
+    msa_depths = {}
+    if max_workers > 1 and len(msa_paths) > 1 and total_msa_size >= MIN_PARALLEL_MSA_BYTES:
+        msa_features = _make_msa_features_in_parallel(
+            msa_paths=msa_paths,
+            max_workers=max_workers,
+            verify_deduplication=verify_deduplication,
+            max_hits=max_msa_hits,
+            msa_depths=msa_depths)
+    else:
+        msa_depths.update((msa_path, MsaDepth()) for msa_path in msa_paths)
+        msas = [_read_msa(msa_path, msa_format, max_msa_hits, msa_depths[msa_path])
+                for msa_path, msa_format in msa_paths.items()]
+        msa_features = _make_msa_features(
+            msas=msas, verify_deduplication=verify_deduplication)
+    _log_msa_depths(msa_depths)
 
     # Create template features
     template_features = _read_template_features(template_features_path)
@@ -154,25 +330,138 @@ def aggregate_features(
         **msa_features,
         **template_features
     }
-    with open(output_features_path, 'wb') as f:
-        pickle.dump(model_features, f, protocol=4)
+    metadata = {
+        'max_msa_hits': max_msa_hits,
+        'msa_depths': {os.path.basename(msa_path): depth.as_dict()
+                       for msa_path, depth in msa_depths.items()},
+    }
+    write_feature_bundle(
+        model_features, output_features_path, metadata=metadata,
+        compact=compact_features)
+    raw_size = sum(np.asarray(value).nbytes for value in model_features.values())
+    bundle_size = os.path.getsize(output_features_path)
+    logging.info(f'Wrote {bundle_size / 2**20:.1f} MiB of features '
+                 f'({raw_size / 2**20:.1f} MiB in memory)')
+    if feature_cache is not None:
+        feature_cache.put(cache_key, output_features_path)
     logging.info(f'Feature aggregation completed. Save to {output_features_path}')
 
+def _msa_paths(msas_path: str) -> dict:
+    """Maps the MSA files in a directory to their formats."""
+    return {str(msa_path): pathlib.Path(msa_path).suffix[1:] 
+            for msa_path in pathlib.Path(msas_path).iterdir()}
+
+
+def _read_batch_manifest(manifest_path: str) -> List[dict]:
+    """Reads the items of a batch manifest and resolves relative paths."""
+    with open(manifest_path) as f:
+        items = json.load(f)
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+    for index, item in enumerate(items):
+        missing_keys = [key for key in BATCH_ITEM_KEYS if key not in item]
+        if missing_keys:
+            raise ValueError(
+                f'Batch manifest item {index} is missing {", ".join(missing_keys)}')
+        for key in BATCH_ITEM_KEYS:
+            item[key] = os.path.join(manifest_dir, item[key])
+    return items
+
+
+def _aggregate_batch_item(item: dict, options: dict) -> float:
+    """Aggregates the features of one batch item and returns the elapsed time."""
+    t0 = time.time()
+    os.makedirs(os.path.dirname(item['output_features_path']), exist_ok=True)
+    aggregate_features(
+        sequence_path=item['sequence_path'],
+        msa_paths=_msa_paths(item['msas_path']),
+        template_features_path=item['template_features_path'],
+        output_features_path=item['output_features_path'],
+        **options)
+    return time.time() - t0
+
+
+def aggregate_features_batch(
+    manifest_path: str,
+    batch_workers: int=1,
+    overwrite: bool=False,
+    **options) -> List[str]:
+    """Aggregates the features of every item of a batch manifest.
+
+    Items whose output already is a complete feature bundle are skipped
+    unless `overwrite` is set. A failed item does not stop the batch; the
+    output paths of failed items are returned. `options` are passed on to
+    `aggregate_features`. With several batch workers each item reads its
+    MSAs serially, as the batch is already parallel.
+    """
+    items = _read_batch_manifest(manifest_path)
+    pending = [item for item in items if overwrite
+               or not is_complete_feature_bundle(item['output_features_path'])]
+    logging.info(f'Aggregating {len(pending)} of {len(items)} batch items, '
+                 f'{len(items) - len(pending)} already have valid outputs')
+
+    failed = []
+    def _log_result(item, result):
+        output_path = item['output_features_path']
+        try:
+            elapsed = result()
+        except Exception:
+            logging.exception(f'Failed to aggregate features for {output_path}')
+            failed.append(output_path)
+            return
+        logging.info(f'Aggregated {output_path} in {elapsed:.1f}s')
+
+    if batch_workers <= 1 or len(pending) <= 1:
+        for item in pending:
+            _log_result(item, lambda: _aggregate_batch_item(item, options))
+    else:
+        options = {**options, 'max_workers': 1}
+        with futures.ProcessPoolExecutor(
+            max_workers=min(batch_workers, len(pending))) as executor:
+            jobs = {executor.submit(_aggregate_batch_item, item, options): item
+                    for item in pending}
+            for job in futures.as_completed(jobs):
+                _log_result(jobs[job], job.result)
+
+    logging.info(f'Batch completed: {len(pending) - len(failed)} aggregated, '
+                 f'{len(items) - len(pending)} skipped, {len(failed)} failed')
+    if options.get('feature_cache_dir'):
+        stats = FeatureCache(options['feature_cache_dir']).stats()
+        logging.info(f'Feature cache: {stats["hits"]} hits, {stats["misses"]} '
+                     f'misses, hit rate {stats["hit_rate"]:.1%}')
+    return failed
+
+
 if __name__=='__main__':
     logging.basicConfig(format='%(asctime)s - %(message)s',
                         level=logging.INFO, 
                         datefmt='%d-%m-%y %H:%M:%S',
                         stream=sys.stdout)
 
-
-    msa_paths = {str(msa_path): pathlib.Path(msa_path).suffix[1:] 
-                 for msa_path in pathlib.Path(MSAS_PATH).iterdir()}
+    # Optional inputs
+    options = dict(
+        verify_deduplication=bool(int(os.getenv('VERIFY_MSA_DEDUP', '0'))),
+        max_workers=int(os.getenv('MAX_WORKERS', '1')),
+        compact_features=bool(int(os.getenv('COMPACT_FEATURES', '1'))),
+        # Keep at most this many hits of each MSA besides the query, 0 keeps all
+        max_msa_hits=int(os.getenv('MAX_MSA_HITS', '0')),
+        feature_cache_dir=os.getenv('FEATURE_CACHE_DIR'),
+        feature_cache_max_bytes=int(
+            float(os.getenv('FEATURE_CACHE_MAX_GB', '100')) * 2**30))
+
+    if os.getenv('BATCH_MANIFEST_PATH'):
+        failed = aggregate_features_batch(
+            manifest_path=os.environ['BATCH_MANIFEST_PATH'],
+            batch_workers=int(os.getenv('BATCH_WORKERS', '1')),
+            overwrite=bool(int(os.getenv('BATCH_OVERWRITE', '0'))),
+            **options)
+        sys.exit(1 if failed else 0)
 
     aggregate_features(
-        sequence_path=SEQUENCE_PATH,
-        msa_paths=msa_paths,
-        template_features_path=TEMPLATE_FEATURES_PATH,
-        output_features_path=OUTPUT_FEATURES_PATH)
+        sequence_path=os.environ['SEQUENCE_PATH'],
+        msa_paths=_msa_paths(os.environ['MSAS_PATH']),
+        template_features_path=os.environ['TEMPLATE_FEATURES_PATH'],
+        output_features_path=os.environ['OUTPUT_FEATURES_PATH'],
+        **options)
 
 
     
@@ -0,0 +1,117 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Mechanics shared by the caches kept in a directory.
+
+A cache directory may be shared by processes on one host or on an NFS
+mount. Updates are serialized by an fcntl lock on `.lock`, JSON files are
+replaced atomically, counts shared by every process are kept in
+`stats.json`, and the least recently modified entries are evicted once the
+entries grow beyond the size cap.
+"""
+
+import fcntl
+import json
+import os
+
+from typing import Any, Dict, Iterable
+
+
+_STATS_NAME = 'stats.json'
+_LOCK_NAME = '.lock'
+
+
+def write_json(path: str, value: Any):
+    """Atomically replaces `path` with `value` as JSON."""
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(value, f)
+    os.replace(tmp_path, path)
+
+
+class DirectoryCache:
+    """A size-capped cache directory with shared counts."""
+
+    # The counts in `stats.json` before the first update
+    STATS = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _locked(self):
+        """Returns an open lock file; closing it releases the lock.
+
+        The lock is not reentrant, so a holder must not take it again.
+        """
+        lock = open(os.path.join(self.cache_dir, _LOCK_NAME), 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def _read_json(self, name: str, default):
+        try:
+            with open(os.path.join(self.cache_dir, name)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return default
+
+    def _write_json(self, name: str, value):
+        write_json(os.path.join(self.cache_dir, name), value)
+
+    def _read_stats(self) -> Dict[str, float]:
+        stats = dict(self.STATS)
+        stats.update(self._read_json(_STATS_NAME, {}))
+        return stats
+
+    def _add_stats(self, increments: Dict[str, float]):
+        """Adds to the shared counts; the caller holds the lock."""
+        stats = self._read_stats()
+        for name, increment in increments.items():
+            stats[name] = stats.get(name, 0) + increment
+        self._write_json(_STATS_NAME, stats)
+
+    def _update_stats(self, **increments):
+        with self._locked():
+            self._add_stats(increments)
+
+    def _evict(self, entry_paths: Iterable[str]) -> int:
+        """Removes the least recently modified entries beyond the size cap.
+
+        Returns the number of entries removed, which are added to the
+        `evictions` count.
+        """
+        with self._locked():
+            entries = []
+            for entry_path in entry_paths:
+                try:
+                    stat = os.stat(entry_path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry_path))
+            entries.sort()
+            total_size = sum(size for _, size, _ in entries)
+            evictions = 0
+            for _, size, entry_path in entries:
+                if total_size <= self.max_bytes:
+                    break
+                try:
+                    os.remove(entry_path)
+                except FileNotFoundError:
+                    pass
+                total_size -= size
+                evictions += 1
+            if evictions:
+                self._add_stats({'evictions': evictions})
+        return evictions
@@ -0,0 +1,88 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Confidence-based early stopping of the predictions of a target.
+
+Predictions of a target run one after another, over models and their
+seeds. The remaining predictions are skipped once a prediction reaches
+a `ranking_confidence` of `threshold`, or once `patience` predictions in a
+row fail to improve on the best one by more than `min_delta`.
+
+`ranking_confidence` is the mean pLDDT, from 0 to 100, for monomer models
+and 0.8 ipTM + 0.2 pTM, from 0 to 1, for multimer models, so the threshold
+must match the models run.
+"""
+
+import logging
+
+from typing import Optional
+
+
+class EarlyStopping:
+    """Decides when to skip the remaining predictions of a target."""
+
+    def __init__(self,
+                 threshold: Optional[float] = None,
+                 patience: Optional[int] = None,
+                 min_delta: float = 0.0):
+        self.threshold = threshold
+        self.patience = patience
+        self.min_delta = min_delta
+        self.reset()
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold is not None or bool(self.patience)
+
+    def reset(self):
+        """Starts a new target."""
+        self.best_confidence = None
+        self.best_name = None
+        self.num_without_improvement = 0
+        self.reason = None
+
+    def update(self, name: str, ranking_confidence: float) -> bool:
+        """Records a prediction and returns whether to stop."""
+        ranking_confidence = float(ranking_confidence)
+        if (self.best_confidence is None
+                or ranking_confidence > self.best_confidence + self.min_delta):
+            self.num_without_improvement = 0
+        else:
+            self.num_without_improvement += 1
+        if self.best_confidence is None or ranking_confidence > self.best_confidence:
+            self.best_confidence = ranking_confidence
+            self.best_name = name
+
+        if self.threshold is not None and ranking_confidence >= self.threshold:
+            self.reason = (f'{name} reached ranking confidence {ranking_confidence:.2f} '
+                           f'>= {self.threshold}')
+        elif self.patience and self.num_without_improvement >= self.patience:
+            self.reason = (f'{self.num_without_improvement} predictions did not improve '
+                           f'on {self.best_name} ({self.best_confidence:.2f})')
+        return self.reason is not None
+
+    def log_stop(self, skipped):
+        """Logs the decision to skip the `skipped` predictions."""
+        logging.info(f'Stopping early: {self.reason}; skipping {len(skipped)} '
+                     f'predictions: {", ".join(skipped)}')
+
+
+def parse_early_stopping(threshold: Optional[str], patience: Optional[str],
+                         min_delta: Optional[str] = None) -> Optional[EarlyStopping]:
+    """Returns the policy configured by environment variable values, if any."""
+    early_stopping = EarlyStopping(
+        threshold=float(threshold) if threshold else None,
+        patience=int(patience) if patience else None,
+        min_delta=float(min_delta) if min_delta else 0.0)
+    return early_stopping if early_stopping.enabled else None
@@ -0,0 +1,248 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Memory-mappable on-disk format for model feature dicts.
+
+A feature bundle is a single uncompressed zip archive with one `.npy` member
+per feature and a small JSON manifest. The members are stored, not
+compressed, and their data is aligned in the file, so every array can be
+memory mapped straight from the archive. Readers only touch the pages of the
+features they use and processes on the same host share the page cache.
+
+Since the archive is a plain `.npz` file, it can also be opened with
+`np.load` for inspection.
+
+With `compact=True` integer features are stored in the narrowest integer
+dtype that holds their values, e.g. `uint8` for MSA tokens and most
+deletion counts. The manifest records both dtypes and loaded features are
+widened back to the original dtype.
+"""
+
+import json
+import os
+import pickle
+import struct
+import zipfile
+
+import numpy as np
+
+from typing import Any, Dict, Iterable, Mapping, Optional
+
+
+BUNDLE_FORMAT = 'feature-bundle'
+BUNDLE_VERSION = 2
+MANIFEST_NAME = 'manifest.json'
+
+# Array data is aligned to this many bytes within the archive
+_ALIGNMENT = 64
+# Arrays smaller than this are read into memory instead of being mapped
+_MIN_MMAP_BYTES = 64 * 2**10
+
+# Extra field used to pad local file headers, as in Android's zipalign
+_PADDING_EXTRA_ID = 0xD935
+_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+_LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+# Size of the Zip64 extra field that `zipfile` appends to local headers
+_ZIP64_EXTRA_SIZE = 20
+
+
+def _member_name(key: str) -> str:
+    return f'{key}.npy'
+
+
+def compact_dtype(array: np.ndarray) -> np.dtype:
+    """Returns the narrowest integer dtype that holds the values of `array`."""
+    if array.dtype.kind not in 'iu' or array.size == 0:
+        return array.dtype
+    dtype = np.result_type(np.min_scalar_type(array.min()),
+                           np.min_scalar_type(array.max()))
+    if dtype.itemsize >= array.dtype.itemsize:
+        return array.dtype
+    return dtype
+
+
+def _to_storable(key: str, value: Any):
+    """Returns the array to store for a feature and whether it held objects."""
+    array = np.asarray(value)
+    if array.dtype != object:
+        return array, False
+    try:
+        return array.astype(np.bytes_), True
+    except (TypeError, UnicodeEncodeError) as e:
+        raise ValueError(
+            f'Feature {key} must hold bytes to be stored in a bundle') from e
+
+
+def _aligned_zipinfo(zf: zipfile.ZipFile, name: str) -> zipfile.ZipInfo:
+    """Returns a ZipInfo whose member data will start on an aligned offset."""
+    zinfo = zipfile.ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0))
+    zinfo.compress_type = zipfile.ZIP_STORED
+    data_offset = (zf.fp.tell() + _LOCAL_HEADER.size + len(name.encode('utf-8'))
+                   + 4 + _ZIP64_EXTRA_SIZE)
+    padding = -data_offset % _ALIGNMENT
+    zinfo.extra = struct.pack('<HH', _PADDING_EXTRA_ID, padding) + b'\0' * padding
+    return zinfo
+
+
+def write_feature_bundle(features: Mapping[str, Any],
+                         path: str,
+                         metadata: Optional[Mapping[str, Any]] = None,
+                         compact: bool = False) -> Dict:
+    """Writes a feature dict to `path` and returns the bundle manifest.
+
+    Object arrays of bytes, such as `domain_name` or `sequence`, are stored
+    as fixed-width byte strings and restored as object arrays on load. With
+    `compact` integer arrays are stored in their narrowest safe dtype. The
+    bundle is written to a temporary file first and then moved into place.
+    """
+    manifest = {
+        'format': BUNDLE_FORMAT,
+        'version': BUNDLE_VERSION,
+        'features': {},
+        'metadata': dict(metadata or {}),
+    }
+    tmp_path = f'{path}.tmp'
+    with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for key, value in features.items():
+            array, is_object = _to_storable(key, value)
+            manifest['features'][key] = {
+                'dtype': 'object' if is_object else array.dtype.str,
+                'shape': list(array.shape),
+            }
+            if compact:
+                storage_dtype = compact_dtype(array)
+                if storage_dtype != array.dtype:
+                    array = array.astype(storage_dtype)
+                    manifest['features'][key]['storage_dtype'] = storage_dtype.str
+            zinfo = _aligned_zipinfo(zf, _member_name(key))
+            with zf.open(zinfo, 'w', force_zip64=True) as f:
+                np.lib.format.write_array(f, array, allow_pickle=False)
+        zf.writestr(MANIFEST_NAME, json.dumps(manifest, indent=2))
+    os.replace(tmp_path, path)
+    return manifest
+
+
+def is_feature_bundle(path: str) -> bool:
+    """Returns True if `path` is a feature bundle rather than a pickle."""
+    if not zipfile.is_zipfile(path):
+        return False
+    with zipfile.ZipFile(path) as zf:
+        return MANIFEST_NAME in zf.namelist()
+
+
+def read_manifest(path: str) -> Dict:
+    """Returns the manifest of a feature bundle."""
+    with zipfile.ZipFile(path) as zf:
+        manifest = json.loads(zf.read(MANIFEST_NAME))
+    if manifest.get('format') != BUNDLE_FORMAT:
+        raise ValueError(f'{path} is not a feature bundle')
+    if manifest.get('version', 0) > BUNDLE_VERSION:
+        raise ValueError(
+            f'Unsupported feature bundle version {manifest["version"]} in {path}')
+    return manifest
+
+
+def is_complete_feature_bundle(path: str) -> bool:
+    """Returns True if `path` is a readable bundle with every listed feature.
+
+    Bundles are moved into place only once fully written, so this is a cheap
+    check that an existing output does not have to be recomputed.
+    """
+    try:
+        manifest = read_manifest(path)
+        with zipfile.ZipFile(path) as zf:
+            names = set(zf.namelist())
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+        return False
+    return all(_member_name(key) in names for key in manifest['features'])
+
+
+def _member_data_offset(f, zinfo: zipfile.ZipInfo) -> int:
+    """Returns the file offset of a stored member's data."""
+    f.seek(zinfo.header_offset)
+    header = _LOCAL_HEADER.unpack(f.read(_LOCAL_HEADER.size))
+    if header[0] != _LOCAL_HEADER_SIGNATURE:
+        raise ValueError(f'Corrupted feature bundle member {zinfo.filename}')
+    name_length, extra_length = header[-2:]
+    return zinfo.header_offset + _LOCAL_HEADER.size + name_length + extra_length
+
+
+def _read_array_header(f):
+    """Reads a `.npy` header and returns (shape, fortran_order, dtype)."""
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        return np.lib.format.read_array_header_1_0(f)
+    return np.lib.format.read_array_header_2_0(f)
+
+
+def _load_member(path: str, f, zinfo: zipfile.ZipInfo, mmap: bool) -> np.ndarray:
+    if zinfo.compress_type != zipfile.ZIP_STORED:
+        raise ValueError(f'Feature bundle member {zinfo.filename} is compressed')
+    f.seek(_member_data_offset(f, zinfo))
+    shape, fortran_order, dtype = _read_array_header(f)
+    offset = f.tell()
+    order = 'F' if fortran_order else 'C'
+    count = int(np.prod(shape))
+    if count == 0:
+        return np.empty(shape, dtype=dtype, order=order)
+    if mmap and count * dtype.itemsize >= _MIN_MMAP_BYTES:
+        return np.memmap(path, dtype=dtype, mode='r', offset=offset,
+                         shape=shape, order=order)
+    array = np.fromfile(f, dtype=dtype, count=count)
+    return array.reshape(shape, order=order)
+
+
+def load_feature_bundle(path: str,
+                        keys: Optional[Iterable[str]] = None,
+                        mmap: bool = True,
+                        widen: bool = True) -> Dict[str, np.ndarray]:
+    """Loads the features of a bundle, optionally restricted to `keys`.
+
+    Large arrays are returned as read-only memory maps, so their pages are
+    only read when the arrays are accessed. Compacted arrays are widened
+    back to their original dtype unless `widen` is False; only the features
+    that are loaded pay for the conversion.
+    """
+    manifest = read_manifest(path)
+    feature_specs = manifest['features']
+    if keys is not None:
+        keys = set(keys)
+        feature_specs = {key: spec for key, spec in feature_specs.items()
+                         if key in keys}
+
+    features = {}
+    with zipfile.ZipFile(path) as zf, open(path, 'rb') as f:
+        for key, spec in feature_specs.items():
+            array = _load_member(path, f, zf.getinfo(_member_name(key)), mmap)
+            if spec['dtype'] == 'object':
+                array = array.astype(object)
+            elif widen and 'storage_dtype' in spec:
+                array = array.astype(spec['dtype'])
+            features[key] = array
+    return features
+
+
+def load_features(path: str,
+                  keys: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+    """Loads a feature dict written as a bundle or as a legacy pickle."""
+    if is_feature_bundle(path):
+        return load_feature_bundle(path, keys=keys)
+
+    with open(path, 'rb') as f:
+        features = pickle.load(f)
+    if keys is not None:
+        keys = set(keys)
+        features = {key: value for key, value in features.items()
+                    if key in keys}
+    return features
@@ -0,0 +1,150 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Content-addressed cache of aggregated feature bundles.
+
+Entries are keyed on a SHA-256 digest of the query sequence file, every MSA
+file in order, the template features file and the aggregation options that
+change the output. File names and locations do not contribute to the key,
+so re-running a target with unchanged search results is a cache hit.
+
+The cache is a local directory holding one feature bundle per key. Hits
+refresh an entry's modification time, and the least recently used entries
+are evicted once the cache grows beyond its size cap. Hit and miss counts
+are kept in `stats.json` next to the entries, so the hit rate covers every
+process sharing the directory.
+"""
+
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import struct
+
+from typing import Any, Dict, Mapping, Optional
+
+from directory_cache import DirectoryCache
+from feature_bundle import BUNDLE_VERSION, is_complete_feature_bundle
+
+
+# Bump when aggregation produces different features for the same inputs
+CACHE_KEY_VERSION = 1
+
+DEFAULT_MAX_BYTES = 100 * 2**30
+
+_ENTRY_SUFFIX = '.npz'
+_READ_SIZE = 2**20
+
+
+def _hash_file(hasher, label: str, path: str):
+    """Adds a labelled, length-prefixed file to `hasher`."""
+    hasher.update(label.encode('utf-8'))
+    hasher.update(struct.pack('<Q', os.path.getsize(path)))
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(_READ_SIZE), b''):
+            hasher.update(block)
+
+
+def content_key(sequence_path: str,
+                msa_paths: Mapping[str, str],
+                template_features_path: str,
+                options: Optional[Mapping[str, Any]] = None) -> str:
+    """Returns the cache key of an aggregation.
+
+    `msa_paths` maps MSA files to their formats, in aggregation order; the
+    order matters as the first occurrence of a duplicate row is kept.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(f'features-v{CACHE_KEY_VERSION}-bundle-v{BUNDLE_VERSION}'.encode())
+    _hash_file(hasher, 'sequence', sequence_path)
+    for msa_path, msa_format in msa_paths.items():
+        _hash_file(hasher, f'msa:{msa_format}', msa_path)
+    _hash_file(hasher, 'templates', template_features_path)
+    hasher.update(json.dumps(dict(options or {}), sort_keys=True).encode('utf-8'))
+    return hasher.hexdigest()
+
+
+def _place_file(source_path: str, path: str):
+    """Atomically places a copy of `source_path` at `path`.
+
+    A hard link is used where possible; bundles are never modified in place,
+    so the link and the cache entry can be removed independently.
+    """
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        os.link(source_path, tmp_path)
+    except OSError:
+        shutil.copyfile(source_path, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class FeatureCache(DirectoryCache):
+    """A size-capped, least recently used cache of feature bundles."""
+
+    def __init__(self, cache_dir: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        super().__init__(cache_dir, max_bytes)
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self) -> float:
+        """Hit rate of the lookups made through this instance."""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f'{key}{_ENTRY_SUFFIX}')
+
+    def stats(self) -> Dict[str, float]:
+        """Returns the counts of every process using the cache directory."""
+        stats = self._read_stats()
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+    def get(self, key: str, output_path: str) -> bool:
+        """Places the cached bundle of `key` at `output_path` if there is one."""
+        entry_path = self._entry_path(key)
+        hit = is_complete_feature_bundle(entry_path)
+        if hit:
+            try:
+                _place_file(entry_path, output_path)
+                os.utime(entry_path)
+            except FileNotFoundError:
+                # Evicted by another process since it was checked
+                hit = False
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        self._update_stats(hits=int(hit), misses=int(not hit))
+        return hit
+
+    def put(self, key: str, bundle_path: str):
+        """Adds a bundle to the cache and evicts entries beyond the size cap."""
+        size = os.path.getsize(bundle_path)
+        if size > self.max_bytes:
+            logging.warning(
+                f'Not caching {bundle_path}: {size} bytes exceed the cache size cap')
+            return
+        _place_file(bundle_path, self._entry_path(key))
+        self._evict()
+
+    def _evict(self):
+        evictions = super()._evict(
+            glob.glob(os.path.join(self.cache_dir, f'*{_ENTRY_SUFFIX}')))
+        if evictions:
+            logging.info(f'Evicted {evictions} feature cache entries')
@@ -0,0 +1,212 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Sequence length bucketing for monomer predictions.
+
+The jitted model function is compiled for every distinct set of input
+shapes, and the number of residues is part of every shape. Padding the
+processed features of a target to the smallest configured bucket that
+fits lets targets of similar lengths share one compiled function.
+
+Padding uses the fixed size stage of the AlphaFold input pipeline: the
+crop size is set to the bucket length instead of the sequence length, and
+the padded residues get a zero `seq_mask` and `msa_mask`, so they do not
+contribute to attention or to the real residues. The prediction is cropped
+back to the real residues before the confidence metrics are computed.
+"""
+
+import logging
+import weakref
+
+import jax
+import numpy as np
+import tensorflow.compat.v1 as tf
+
+from typing import Any, Mapping, Optional, Sequence, Tuple
+
+from alphafold.model import features
+from alphafold.model import model
+from alphafold.model.tf import input_pipeline
+from alphafold.model.tf import proteins_dataset
+
+
+# Residue axes of the prediction outputs, by path. Arrays not listed are
+# indexed by residue along their first axis.
+_RESIDUE_AXES = {
+    ('distogram', 'logits'): (0, 1),
+    ('distogram', 'bin_edges'): (),
+    ('predicted_aligned_error', 'logits'): (0, 1),
+    ('predicted_aligned_error', 'breaks'): (),
+    ('masked_msa', 'logits'): (1,),
+    ('representations', 'msa'): (1,),
+    ('representations', 'pair'): (0, 1),
+    # Stacked over the structure module layers
+    ('structure_module', 'traj'): (1,),
+    ('structure_module', 'sidechains'): (1,),
+}
+
+
+def parse_length_buckets(value: Optional[str]) -> Tuple[int, ...]:
+    """Parses a comma separated list of bucket lengths."""
+    if not value:
+        return ()
+    return tuple(sorted(int(length) for length in value.split(',')))
+
+
+def bucket_length(num_res: int, length_buckets: Sequence[int]) -> int:
+    """Returns the smallest bucket fitting `num_res` residues.
+
+    Targets longer than every bucket are not padded.
+    """
+    for length in sorted(length_buckets):
+        if length >= num_res:
+            return length
+    logging.warning(f'{num_res} residues exceed the largest length bucket')
+    return num_res
+
+
+def process_features_padded(
+    model_config,
+    raw_features: Mapping[str, np.ndarray],
+    random_seed: int,
+    padded_length: int) -> Mapping[str, np.ndarray]:
+    """Processes monomer features padded to `padded_length` residues.
+
+    Follows `features.np_example_to_features`, except for the crop size.
+    """
+    np_example = dict(raw_features)
+    num_res = int(np_example['seq_length'][0])
+    cfg, feature_names = features.make_data_config(model_config, num_res=num_res)
+    with cfg.unlocked():
+        cfg.eval.crop_size = padded_length
+
+    if 'deletion_matrix_int' in np_example:
+        np_example['deletion_matrix'] = (
+            np_example.pop('deletion_matrix_int').astype(np.float32))
+
+    tf_graph = tf.Graph()
+    with tf_graph.as_default(), tf.device('/device:CPU:0'):
+        tf.set_random_seed(random_seed)
+        tensor_dict = proteins_dataset.np_to_tensor_dict(
+            np_example=np_example, features=feature_names)
+        processed_batch = input_pipeline.process_tensors_from_config(tensor_dict, cfg)
+    tf_graph.finalize()
+
+    with tf.Session(graph=tf_graph) as sess:
+        processed_features = sess.run(processed_batch)
+
+    return {k: v for k, v in processed_features.items() if v.dtype != 'O'}
+
+
+def padding(processed_features: Mapping[str, np.ndarray]) -> Tuple[int, int]:
+    """Returns the real and the padded number of residues of processed features."""
+    num_res = int(np.ravel(processed_features['seq_length'])[0])
+    return num_res, processed_features['aatype'].shape[-1]
+
+
+def _residue_axes(path: Tuple[str, ...]) -> Tuple[int, ...]:
+    for prefix_length in range(len(path), 0, -1):
+        if path[:prefix_length] in _RESIDUE_AXES:
+            return _RESIDUE_AXES[path[:prefix_length]]
+    return (0,)
+
+
+def crop_prediction(prediction_result: Mapping[str, Any], num_res: int,
+                    padded_length: int, path: Tuple[str, ...]=()) -> Mapping[str, Any]:
+    """Crops the padded residues from the raw outputs of the model."""
+    cropped = {}
+    for key, value in prediction_result.items():
+        if isinstance(value, Mapping):
+            cropped[key] = crop_prediction(value, num_res, padded_length, path + (key,))
+            continue
+        array = np.asarray(value)
+        index = [slice(None)] * array.ndim
+        for axis in _residue_axes(path + (key,)):
+            if axis < array.ndim and array.shape[axis] == padded_length:
+                index[axis] = slice(0, num_res)
+        cropped[key] = array[tuple(index)]
+    return cropped
+
+
+def crop_features(processed_features: Mapping[str, np.ndarray],
+                  num_res: int) -> Mapping[str, np.ndarray]:
+    """Returns the features `protein.from_prediction` reads, cropped."""
+    return {key: processed_features[key][..., :num_res]
+            for key in ['aatype', 'residue_index']}
+
+
+def predict_padded(
+    model_runner: model.RunModel,
+    processed_features: Mapping[str, np.ndarray],
+    random_seed: int) -> Mapping[str, Any]:
+    """Predicts padded features and crops the outputs to the real residues.
+
+    Follows `RunModel.predict`, but computes the confidence metrics, and so
+    `ranking_confidence`, on the cropped outputs only.
+    """
+    num_res, padded_length = padding(processed_features)
+    result = model_runner.apply(
+        model_runner.params, jax.random.PRNGKey(random_seed), processed_features)
+    jax.tree_map(lambda x: x.block_until_ready(), result)
+    result = crop_prediction(jax.device_get(result), num_res, padded_length)
+    result.update(model.get_confidence_metrics(result, multimer_mode=False))
+    return result
+
+
+class CompileStats:
+    """Counts the compilations of the jitted model functions.
+
+    A model function compiles on its first call with new input shapes. The
+    duration of that call, including the prediction itself, is recorded as
+    its compile time. With an `xla_cache`, every compilation is also looked
+    up in the persistent compilation cache.
+    """
+
+    def __init__(self, xla_cache=None):
+        self.xla_cache = xla_cache
+        self.num_compiles = 0
+        self.compile_seconds = 0.0
+        self.num_cached_calls = 0
+        self.cached_seconds = 0.0
+        self._shapes = weakref.WeakKeyDictionary()
+
+    def record(self, model_runner: model.RunModel,
+               processed_features: Mapping[str, np.ndarray], seconds: float) -> bool:
+        """Records a prediction and returns whether it compiled."""
+        shapes = tuple(sorted((key, np.shape(value))
+                              for key, value in processed_features.items()))
+        seen_shapes = self._shapes.setdefault(model_runner, set())
+        if shapes in seen_shapes:
+            self.num_cached_calls += 1
+            self.cached_seconds += seconds
+            return False
+        seen_shapes.add(shapes)
+        self.num_compiles += 1
+        self.compile_seconds += seconds
+        return True
+
+    def summary(self) -> dict:
+        summary = {
+            'num_compiles': self.num_compiles,
+            'compile_seconds': self.compile_seconds,
+            'num_cached_calls': self.num_cached_calls,
+            'cached_seconds': self.cached_seconds,
+        }
+        if self.xla_cache is not None:
+            summary.update({
+                'xla_cache_hits': self.xla_cache.hits,
+                'xla_cache_misses': self.xla_cache.misses,
+                'xla_cache_seconds_saved': self.xla_cache.seconds_saved,
+            })
+        return summary
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Memory-mappable AlphaFold model parameters.
+
+The official parameters ship as one `params_<model_name>.npz` per model.
+`convert_params` converts such a file once into a directory next to it:
+
+  params_<model_name>/index.json
+  params_<model_name>/00000.npy
+  ...
+
+The index maps every flat Haiku key (`scope//name`) to its `.npy` file,
+dtype and shape. The arrays are stored uncompressed, so `load_flat_params`
+memory maps them instead of reading them; their pages are only read when
+the model moves them to the device.
+
+Run as a script to convert the parameters in PARAMS_DIR, either the models
+in the comma separated MODEL_NAMES or every `params_*.npz` file.
+"""
+
+import glob
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+
+from typing import Dict, List
+
+
+PARAMS_FORMAT = 'model-params'
+PARAMS_VERSION = 1
+INDEX_NAME = 'index.json'
+
+
+def params_npz_path(params_dir: str, model_name: str) -> str:
+    return os.path.join(params_dir, f'params_{model_name}.npz')
+
+
+def converted_params_dir(params_dir: str, model_name: str) -> str:
+    return os.path.join(params_dir, f'params_{model_name}')
+
+
+def is_converted_params(path: str) -> bool:
+    """Checks that `path` holds converted parameters of a known version."""
+    try:
+        with open(os.path.join(path, INDEX_NAME)) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return index.get('format') == PARAMS_FORMAT and index.get('version') == PARAMS_VERSION
+
+
+def convert_params(npz_path: str, output_dir: str) -> int:
+    """Converts an official parameters file and returns the bytes written.
+
+    The arrays are written to a temporary directory that replaces
+    `output_dir` once complete, so readers never see a partial conversion.
+    """
+    tmp_dir = f'{output_dir}.{os.getpid()}.tmp'
+    os.makedirs(tmp_dir)
+    index = {'format': PARAMS_FORMAT, 'version': PARAMS_VERSION, 'params': {}}
+    num_bytes = 0
+    with np.load(npz_path, allow_pickle=False) as params:
+        for i, key in enumerate(params.files):
+            array = params[key]
+            file_name = f'{i:05d}.npy'
+            np.save(os.path.join(tmp_dir, file_name), array, allow_pickle=False)
+            index['params'][key] = {
+                'file': file_name,
+                'dtype': array.dtype.str,
+                'shape': list(array.shape),
+            }
+            num_bytes += array.nbytes
+    with open(os.path.join(tmp_dir, INDEX_NAME), 'w') as f:
+        json.dump(index, f, indent=1)
+
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    os.rename(tmp_dir, output_dir)
+    return num_bytes
+
+
+def load_flat_params(
+    params_dir: str,
+    model_name: str,
+    mmap: bool=True) -> Dict[str, np.ndarray]:
+    """Loads the flat parameters of a model.
+
+    Converted parameters are memory mapped if `mmap` is true. Otherwise the
+    official `.npz` is read directly, holding a single copy of the arrays.
+    """
+    converted_dir = converted_params_dir(params_dir, model_name)
+    if is_converted_params(converted_dir):
+        with open(os.path.join(converted_dir, INDEX_NAME)) as f:
+            index = json.load(f)
+        mmap_mode = 'r' if mmap else None
+        return {key: np.load(os.path.join(converted_dir, spec['file']),
+                             mmap_mode=mmap_mode, allow_pickle=False)
+                for key, spec in index['params'].items()}
+
+    with np.load(params_npz_path(params_dir, model_name), allow_pickle=False) as params:
+        return {key: params[key] for key in params.files}
+
+
+def _model_names(params_dir: str) -> List[str]:
+    names = []
+    for path in sorted(glob.glob(os.path.join(params_dir, 'params_*.npz'))):
+        names.append(os.path.basename(path)[len('params_'):-len('.npz')])
+    return names
+
+
+if __name__=='__main__':
+    logging.basicConfig(format='%(asctime)s - %(message)s',
+                        level=logging.INFO,
+                        datefmt='%d-%m-%y %H:%M:%S',
+                        stream=sys.stdout)
+
+    params_dir = os.environ['PARAMS_DIR']
+    model_names = os.getenv('MODEL_NAMES')
+    model_names = model_names.split(',') if model_names else _model_names(params_dir)
+    if not model_names:
+        raise RuntimeError(f'No parameters to convert in {params_dir}')
+
+    for model_name in model_names:
+        t0 = time.time()
+        num_bytes = convert_params(
+            params_npz_path(params_dir, model_name),
+            converted_params_dir(params_dir, model_name))
+        logging.info(f'Converted {model_name}: {num_bytes / 2**20:.1f} MiB '
+                     f'in {time.time() - t0:.1f}s')
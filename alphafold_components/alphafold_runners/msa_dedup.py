@@ -0,0 +1,105 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cross-MSA deduplication of aligned sequences using fixed-width digests."""
+
+import hashlib
+
+import numpy as np
+
+from typing import Optional
+
+from msa_encoding import MsaRowBuffer, encode_sequence
+
+
+# 128-bit digests make an accidental collision across a few million rows
+# vanishingly unlikely.
+DEFAULT_DIGEST_SIZE = 16
+
+
+def sequence_digest(sequence: str, digest_size: int = DEFAULT_DIGEST_SIZE) -> bytes:
+    """Returns a fixed-width digest of an aligned sequence."""
+    return hashlib.blake2b(
+        sequence.encode('ascii', errors='replace'),
+        digest_size=digest_size).digest()
+
+
+class SequenceDeduplicator:
+    """Tracks the aligned sequences already added to an MSA feature matrix.
+
+    Only a digest of each accepted sequence is retained, instead of the full
+    sequence string. Digests are computed over the aligned residue bytes, so
+    the result matches deduplicating on the sequence strings themselves.
+
+    With `verify=True` the deduplicator also remembers which row each digest
+    was written to, and on a digest hit compares the encoded candidate with
+    the stored row in `rows`. A row is then only dropped if its encoding is
+    identical to a row that has already been kept. In this mode every
+    accepted sequence must be appended to `rows` right after `add` returns.
+    """
+
+    def __init__(self,
+                 digest_size: int = DEFAULT_DIGEST_SIZE,
+                 verify: bool = False,
+                 rows: Optional[MsaRowBuffer] = None):
+        if verify and rows is None:
+            raise ValueError('Verified deduplication requires the row buffer.')
+        self.digest_size = digest_size
+        self.verify = verify
+        self.num_collisions = 0
+        self._rows = rows
+        self._seen = {} if verify else set()
+
+    def __len__(self):
+        return len(self._seen)
+
+    def _is_verified_duplicate(self, digest: bytes, candidate) -> bool:
+        row_indices = self._seen.get(digest)
+        if row_indices is None:
+            self._seen[digest] = len(self._rows)
+            return False
+        if isinstance(row_indices, int):
+            row_indices = [row_indices]
+        tokens = candidate()
+        for row_index in row_indices:
+            if np.array_equal(self._rows.row(row_index), tokens):
+                return True
+        self.num_collisions += 1
+        self._seen[digest] = row_indices + [len(self._rows)]
+        return False
+
+    def add_digest(self,
+                   digest: bytes,
+                   sequence: Optional[str] = None,
+                   tokens: Optional[np.ndarray] = None) -> bool:
+        """Records a precomputed digest and returns False if it was already seen.
+
+        In verify mode either the aligned `sequence` or its encoded `tokens`
+        must be given, so that the candidate can be compared on a digest hit.
+        """
+        if self.verify:
+            if tokens is not None:
+                candidate = lambda: tokens
+            else:
+                candidate = lambda: encode_sequence(sequence, dtype=self._rows.dtype)
+            return not self._is_verified_duplicate(digest, candidate)
+        if digest in self._seen:
+            return False
+        self._seen.add(digest)
+        return True
+
+    def add(self, sequence: str) -> bool:
+        """Records a sequence and returns False if it was already seen."""
+        return self.add_digest(
+            sequence_digest(sequence, self.digest_size), sequence=sequence)
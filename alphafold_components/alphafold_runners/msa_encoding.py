@@ -0,0 +1,171 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Vectorized encoding of aligned MSA sequences into HHblits token ids."""
+
+import numpy as np
+
+from typing import Optional, Sequence
+
+from alphafold.common import residue_constants
+
+
+# Marks bytes that are not valid HHblits residues in the lookup table
+UNKNOWN_TOKEN = -1
+
+# Number of rows joined and encoded in one shot by `encode_sequences`
+_ENCODING_CHUNK_SIZE = 4096
+
+
+def _build_lookup_table() -> np.ndarray:
+    """Builds a 256-entry byte -> HHblits token id lookup table."""
+    table = np.full((256,), UNKNOWN_TOKEN, dtype=np.int16)
+    for res, token in residue_constants.HHBLITS_AA_TO_ID.items():
+        table[ord(res)] = token
+    return table
+
+
+HHBLITS_AA_LOOKUP = _build_lookup_table()
+
+
+def sequence_to_bytes(sequence: str) -> np.ndarray:
+    """Returns a read-only uint8 view of an aligned sequence."""
+    return np.frombuffer(
+        sequence.encode('ascii', errors='replace'), dtype=np.uint8)
+
+
+def _check_tokens(tokens: np.ndarray, residues: np.ndarray):
+    """Raises if any residue could not be mapped to a token."""
+    unknown = tokens == UNKNOWN_TOKEN
+    if unknown.any():
+        res = chr(residues[unknown][0])
+        raise ValueError(f'Unsupported residue in MSA sequence: {res!r}')
+
+
+def encode_bytes(
+    residues: np.ndarray,
+    out: Optional[np.ndarray] = None,
+    dtype=np.int32) -> np.ndarray:
+    """Maps an array of residue bytes to HHblits token ids."""
+    tokens = HHBLITS_AA_LOOKUP[residues]
+    _check_tokens(tokens, residues)
+    if out is None:
+        return tokens.astype(dtype)
+    out[...] = tokens
+    return out
+
+
+def encode_sequence(
+    sequence: str,
+    out: Optional[np.ndarray] = None,
+    dtype=np.int32) -> np.ndarray:
+    """Encodes a single aligned sequence, optionally into a preallocated row."""
+    return encode_bytes(sequence_to_bytes(sequence), out=out, dtype=dtype)
+
+
+def encode_sequences(
+    sequences: Sequence[str],
+    num_res: Optional[int] = None,
+    dtype=np.int32) -> np.ndarray:
+    """Encodes equal-length aligned sequences into a [num_seq, num_res] matrix.
+
+    Sequences are joined and pushed through the lookup table in chunks of
+    rows, so the only full-size allocation is the output matrix itself.
+    """
+    num_seq = len(sequences)
+    if num_res is None:
+        num_res = len(sequences[0]) if num_seq else 0
+    int_msa = np.empty((num_seq, num_res), dtype=dtype)
+
+    for start in range(0, num_seq, _ENCODING_CHUNK_SIZE):
+        chunk = sequences[start:start + _ENCODING_CHUNK_SIZE]
+        if any(len(sequence) != num_res for sequence in chunk):
+            raise ValueError(
+                f'All MSA sequences must have length {num_res}.')
+        residues = sequence_to_bytes(''.join(chunk))
+        encode_bytes(
+            residues.reshape(len(chunk), num_res),
+            out=int_msa[start:start + len(chunk)])
+
+    return int_msa
+
+
+class MsaRowBuffer:
+    """Accumulates encoded MSA rows and deletion rows in preallocated chunks.
+
+    Rows are written straight into fixed-size blocks as they arrive, so the
+    number of rows does not have to be known up front and no per-row Python
+    lists are kept.
+    """
+
+    def __init__(self, num_res: int, dtype=np.int32,
+                 chunk_size: int = _ENCODING_CHUNK_SIZE):
+        self.num_res = num_res
+        self.dtype = dtype
+        self._chunk_size = chunk_size
+        self._msa_chunks = []
+        self._deletion_chunks = []
+        self._num_rows = 0
+
+    def __len__(self):
+        return self._num_rows
+
+    def _next_row(self, num_res: int, deletion_row: Sequence[int]) -> int:
+        """Allocates a new chunk if needed and returns the next row offset."""
+        if num_res != self.num_res or len(deletion_row) != self.num_res:
+            raise ValueError(
+                f'All MSA sequences must have length {self.num_res}.')
+        offset = self._num_rows % self._chunk_size
+        if offset == 0:
+            self._msa_chunks.append(
+                np.empty((self._chunk_size, self.num_res), dtype=self.dtype))
+            self._deletion_chunks.append(
+                np.empty((self._chunk_size, self.num_res), dtype=np.int32))
+        return offset
+
+    def append(self, sequence: str, deletion_row: Sequence[int]):
+        """Encodes and stores a single aligned row."""
+        offset = self._next_row(len(sequence), deletion_row)
+        encode_sequence(sequence, out=self._msa_chunks[-1][offset])
+        self._deletion_chunks[-1][offset] = deletion_row
+        self._num_rows += 1
+
+    def append_encoded(self, tokens: np.ndarray, deletion_row: Sequence[int]):
+        """Stores a row that has already been encoded."""
+        offset = self._next_row(len(tokens), deletion_row)
+        self._msa_chunks[-1][offset] = tokens
+        self._deletion_chunks[-1][offset] = deletion_row
+        self._num_rows += 1
+
+    def row(self, index: int) -> np.ndarray:
+        """Returns the encoded row stored at `index`."""
+        if not 0 <= index < self._num_rows:
+            raise IndexError(f'Row {index} out of range.')
+        chunk, offset = divmod(index, self._chunk_size)
+        return self._msa_chunks[chunk][offset]
+
+    def _concatenate(self, chunks, dtype) -> np.ndarray:
+        if not chunks:
+            return np.zeros((0, self.num_res), dtype=dtype)
+        last_rows = self._num_rows - (len(chunks) - 1) * self._chunk_size
+        chunks[-1] = chunks[-1][:last_rows]
+        matrix = np.concatenate(chunks) if len(chunks) > 1 else chunks[0].copy()
+        chunks.clear()
+        return matrix
+
+    def finalize(self):
+        """Returns the (msa, deletion_matrix) arrays and releases the chunks."""
+        msa = self._concatenate(self._msa_chunks, self.dtype)
+        deletion_matrix = self._concatenate(self._deletion_chunks, np.int32)
+        return msa, deletion_matrix
@@ -0,0 +1,170 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Interned species and UniProt accession identifiers of MSA rows.
+
+Instead of object arrays of bytes, each identifier feature is stored as an
+int32 code per MSA row plus a deduplicated vocabulary:
+
+  msa_species_identifiers_codes       [num_alignments] int32
+  msa_species_identifiers_vocabulary  [num_unique] bytes
+
+Both arrays can be memory mapped from a feature bundle. The original byte
+arrays are rebuilt on demand with `decode_identifiers`.
+"""
+
+import numpy as np
+
+from typing import Dict, Mapping, Sequence
+
+from alphafold.data import msa_identifiers
+
+
+IDENTIFIER_FEATURES = (
+    'msa_uniprot_accession_identifiers',
+    'msa_species_identifiers',
+)
+
+# Number of descriptions parsed together by `IdentifierInterner`
+_BATCH_SIZE = 4096
+
+
+def codes_feature(name: str) -> str:
+    return f'{name}_codes'
+
+
+def vocabulary_feature(name: str) -> str:
+    return f'{name}_vocabulary'
+
+
+def description_prefix(description: str) -> str:
+    """Returns the part of a description that determines its identifiers.
+
+    `msa_identifiers.get_identifiers` only looks at the first word of a
+    description, up to an optional `/start-end` range suffix.
+    """
+    words = description.split(None, 1)
+    return words[0].partition('/')[0] if words else ''
+
+
+class Vocabulary:
+    """Assigns consecutive integer codes to unique byte strings."""
+
+    def __init__(self):
+        self._codes = {}
+
+    def __len__(self):
+        return len(self._codes)
+
+    def add(self, value: bytes) -> int:
+        return self._codes.setdefault(value, len(self._codes))
+
+    def remap(self, values: Sequence[bytes]) -> np.ndarray:
+        """Adds `values` and returns their codes in this vocabulary."""
+        return np.array([self.add(value) for value in values], dtype=np.int32)
+
+    def to_array(self) -> np.ndarray:
+        return np.array(list(self._codes), dtype=np.object_)
+
+
+class IdentifierInterner:
+    """Builds interned identifier features for a sequence of MSA rows.
+
+    Descriptions are parsed in batches, and each unique description prefix
+    is only parsed once, so rows from the same sequence share the work.
+    """
+
+    def __init__(self):
+        self.vocabularies = {name: Vocabulary() for name in IDENTIFIER_FEATURES}
+        self._prefix_codes = {}
+        self._pending = []
+        self._code_chunks = []
+
+    @property
+    def num_parsed(self) -> int:
+        """Number of unique description prefixes parsed so far."""
+        return len(self._prefix_codes)
+
+    def _codes_for_prefix(self, prefix: str):
+        identifiers = msa_identifiers.get_identifiers(prefix)
+        return (
+            self.vocabularies['msa_uniprot_accession_identifiers'].add(
+                identifiers.uniprot_accession_id.encode('utf-8')),
+            self.vocabularies['msa_species_identifiers'].add(
+                identifiers.species_id.encode('utf-8')),
+        )
+
+    def _flush(self):
+        if not self._pending:
+            return
+        prefixes = [description_prefix(description) for description in self._pending]
+        # Unique prefixes are parsed in order of first use, which keeps the
+        # vocabularies in a deterministic order
+        for prefix in dict.fromkeys(prefixes):
+            if prefix not in self._prefix_codes:
+                self._prefix_codes[prefix] = self._codes_for_prefix(prefix)
+        self._code_chunks.append(np.array(
+            [self._prefix_codes[prefix] for prefix in prefixes], dtype=np.int32))
+        self._pending.clear()
+
+    def add(self, description: str):
+        """Queues the identifiers of the next MSA row."""
+        self._pending.append(description)
+        if len(self._pending) >= _BATCH_SIZE:
+            self._flush()
+
+    def extend(self, features: Mapping[str, np.ndarray], rows: np.ndarray):
+        """Appends the identifiers of `rows` from interned `features`.
+
+        Only the vocabulary entries used by `rows` are added, in order of
+        first use, so merging gives the same codes as adding the rows'
+        descriptions one by one.
+        """
+        self._flush()
+        columns = []
+        for name in IDENTIFIER_FEATURES:
+            vocabulary = np.asarray(features[vocabulary_feature(name)], dtype=np.object_)
+            codes = np.asarray(features[codes_feature(name)])[rows]
+            unique_codes, first_rows = np.unique(codes, return_index=True)
+            used_codes = unique_codes[np.argsort(first_rows)]
+            remap = np.zeros((len(vocabulary),), dtype=np.int32)
+            remap[used_codes] = self.vocabularies[name].remap(vocabulary[used_codes])
+            columns.append(remap[codes])
+        self._code_chunks.append(np.stack(columns, axis=1))
+
+    def features(self) -> Dict[str, np.ndarray]:
+        """Returns the code and vocabulary features of all rows added so far."""
+        self._flush()
+        codes = np.concatenate(
+            self._code_chunks or [np.zeros((0, len(IDENTIFIER_FEATURES)), np.int32)])
+        features = {}
+        for column, name in enumerate(IDENTIFIER_FEATURES):
+            features[codes_feature(name)] = np.ascontiguousarray(codes[:, column])
+            features[vocabulary_feature(name)] = self.vocabularies[name].to_array()
+        return features
+
+
+def decode_identifiers(features: Mapping[str, np.ndarray], name: str) -> np.ndarray:
+    """Returns the object array of bytes of an interned identifier feature."""
+    vocabulary = np.asarray(features[vocabulary_feature(name)], dtype=np.object_)
+    return vocabulary[np.asarray(features[codes_feature(name)])]
+
+
+def with_identifier_arrays(features: Mapping[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """Returns a copy of `features` with the identifier byte arrays restored."""
+    features = dict(features)
+    for name in IDENTIFIER_FEATURES:
+        if name not in features and codes_feature(name) in features:
+            features[name] = decode_identifiers(features, name)
+    return features
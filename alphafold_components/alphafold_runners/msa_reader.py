@@ -0,0 +1,173 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Incremental Stockholm and A3M readers.
+
+The readers yield one `MsaRecord` at a time straight from the file handle and
+produce the same aligned sequences, deletion rows and descriptions as
+`parsers.parse_stockholm` and `parsers.parse_a3m`.
+
+With `max_hits` the readers cap the depth of an MSA: they yield the query
+plus the first `max_hits` rows in file order and skip the rest. Jackhmmer
+and HHblits write hits ranked by significance, so these are the best hits,
+and the result matches `parsers.Msa.truncate(max_seqs=max_hits + 1)`.
+Skipped rows are only counted, not parsed.
+"""
+
+import collections
+import string
+
+import numpy as np
+
+from typing import IO, Iterator, NamedTuple, Optional
+
+
+class MsaRecord(NamedTuple):
+    """A single aligned MSA row."""
+    sequence: str
+    deletion_row: np.ndarray
+    description: str
+
+
+class MsaDepth:
+    """Counts the rows of an MSA file and how many of them were read."""
+
+    def __init__(self):
+        self.num_rows = 0
+        self.num_kept = 0
+
+    @property
+    def num_dropped(self) -> int:
+        return self.num_rows - self.num_kept
+
+    def as_dict(self) -> dict:
+        return {'num_rows': self.num_rows, 'num_dropped': self.num_dropped}
+
+
+def _max_rows(max_hits: int) -> Optional[int]:
+    """Returns the number of rows to keep including the query, or None."""
+    return max_hits + 1 if max_hits > 0 else None
+
+
+_A3M_DELETION_TABLE = str.maketrans('', '', string.ascii_lowercase)
+_GAP = ord('-')
+
+
+def _a3m_record(description: str, a3m_sequence: str) -> MsaRecord:
+    """Converts an A3M row into an aligned sequence and its deletion row."""
+    residues = np.frombuffer(
+        a3m_sequence.encode('ascii', errors='replace'), dtype=np.uint8)
+    is_insertion = (residues >= ord('a')) & (residues <= ord('z'))
+    insertions = np.cumsum(is_insertion, dtype=np.int32)
+    deletion_row = np.diff(insertions[~is_insertion], prepend=0)
+    return MsaRecord(
+        sequence=a3m_sequence.translate(_A3M_DELETION_TABLE),
+        deletion_row=deletion_row.astype(np.int32),
+        description=description)
+
+
+def iter_a3m_records(f: IO[str],
+                     max_hits: int = 0,
+                     depth: Optional[MsaDepth] = None) -> Iterator[MsaRecord]:
+    """Yields records from an A3M file handle, one sequence at a time."""
+    max_rows = _max_rows(max_hits)
+    depth = depth if depth is not None else MsaDepth()
+    description = None
+    chunks = []
+    for line in f:
+        line = line.strip()
+        if line.startswith('>'):
+            if description is not None:
+                yield _a3m_record(description, ''.join(chunks))
+            depth.num_rows += 1
+            description = None
+            if max_rows is None or depth.num_rows <= max_rows:
+                depth.num_kept += 1
+                description = line[1:]
+            chunks = []
+        elif line and description is not None:
+            chunks.append(line)
+    if description is not None:
+        yield _a3m_record(description, ''.join(chunks))
+
+
+def iter_stockholm_records(f: IO[str],
+                           max_hits: int = 0,
+                           depth: Optional[MsaDepth] = None) -> Iterator[MsaRecord]:
+    """Yields records from a Stockholm file handle.
+
+    Stockholm alignments may be split into several blocks, so a row is only
+    complete at the end of the file. The reader keeps a single copy of the raw
+    aligned segments and releases each row as soon as it has been yielded.
+    Segments of rows beyond `max_hits` are not kept at all.
+    """
+    max_rows = _max_rows(max_hits)
+    depth = depth if depth is not None else MsaDepth()
+    name_to_segments = collections.OrderedDict()
+    dropped_names = set()
+    for line in f:
+        line = line.strip()
+        if not line or line.startswith(('#', '//')):
+            continue
+        name, sequence = line.split()
+        segments = name_to_segments.get(name)
+        if segments is None:
+            if max_rows is not None and len(name_to_segments) >= max_rows:
+                dropped_names.add(name)
+                continue
+            segments = name_to_segments[name] = []
+        segments.append(sequence)
+    depth.num_kept = len(name_to_segments)
+    depth.num_rows = depth.num_kept + len(dropped_names)
+    del dropped_names
+
+    keep_columns = None
+    query_gaps = None
+    while name_to_segments:
+        name, segments = name_to_segments.popitem(last=False)
+        residues = np.frombuffer(
+            ''.join(segments).encode('ascii', errors='replace'), dtype=np.uint8)
+        if keep_columns is None:
+            # Columns with gaps in the query are removed from all sequences
+            # and counted as deletions instead.
+            query_gaps = residues == _GAP
+            keep_columns = ~query_gaps
+        insertions = np.cumsum(
+            query_gaps & (residues != _GAP), dtype=np.int32)
+        deletion_row = np.diff(insertions[keep_columns], prepend=0)
+        yield MsaRecord(
+            sequence=residues[keep_columns].tobytes().decode('ascii'),
+            deletion_row=deletion_row.astype(np.int32),
+            description=name)
+
+
+def iter_msa_records(msa_path: str,
+                     msa_format: str,
+                     max_hits: int = 0,
+                     depth: Optional[MsaDepth] = None) -> Iterator[MsaRecord]:
+    """Yields records from an MSA file in `sto` or `a3m` format.
+
+    If `depth` is given, it holds the row counts once the records have been
+    consumed.
+    """
+    if msa_format == 'sto':
+        reader = iter_stockholm_records
+    elif msa_format == 'a3m':
+        reader = iter_a3m_records
+    else:
+        raise RuntimeError(f'Unsupported MSA format: {msa_format}')
+
+    with open(msa_path) as f:
+        yield from reader(f, max_hits=max_hits, depth=depth)
+
@@ -0,0 +1,164 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Overlaps preparing, computing and writing a stream of items.
+
+Each item goes through three stages:
+
+  prepare  runs in a prefetch thread, e.g. loading and processing features
+  compute  runs in the calling thread, e.g. running the model on the device
+  write    runs in a writer thread, e.g. building and writing outputs
+
+The prefetch thread works up to `prefetch` items ahead of the compute stage
+and the writer thread drains up to `write_queue_size` outputs behind it, so
+the device only waits when a stage is slower than compute. The time the
+compute stage is busy, and the time it waits for prepared items, are
+reported to show whether the device sits idle between items. Host work
+done within the compute stage, e.g. processing features on the CPU, is
+reported with `add_host_seconds` and not counted as busy.
+
+A failure in any stage is logged and recorded, and the other items still
+run.
+"""
+
+import logging
+import queue
+import threading
+import time
+
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+
+_DONE = object()
+
+
+class PipelinedExecutor:
+    """Runs the stages of a stream of items in three threads."""
+
+    def __init__(self,
+                 prepare: Callable[[Any], Any],
+                 compute: Callable[[Any, Any], Iterable[Any]],
+                 write: Callable[[Any, Any], None],
+                 prefetch: int = 1,
+                 write_queue_size: int = 2):
+        """`compute(item, prepared)` yields the outputs passed to `write(item, output)`."""
+        self.prepare = prepare
+        self.compute = compute
+        self.write = write
+        self.prefetch = prefetch
+        self.write_queue_size = write_queue_size
+        self.failures: List[Tuple[Any, str, BaseException]] = []
+        self.wall_seconds = 0.0
+        self.compute_seconds = 0.0
+        self.compute_host_seconds = 0.0
+        self.prepare_wait_seconds = 0.0
+        self.write_wait_seconds = 0.0
+        self.num_items = 0
+        self.num_outputs = 0
+
+    def add_host_seconds(self, seconds: float):
+        """Records time the compute stage spent on host work rather than the device."""
+        self.compute_host_seconds += seconds
+
+    def _fail(self, item, stage: str, e: BaseException):
+        logging.error(f'Failed to {stage} {item}', exc_info=e)
+        self.failures.append((item, stage, e))
+
+    def _prefetch(self, items: Iterable[Any], prepared_queue: queue.Queue,
+                  stop: threading.Event):
+        for item in items:
+            if stop.is_set():
+                break
+            try:
+                prepared, error = self.prepare(item), None
+            except Exception as e:
+                prepared, error = None, e
+            prepared_queue.put((item, prepared, error))
+        prepared_queue.put(_DONE)
+
+    def _write(self, output_queue: queue.Queue):
+        while True:
+            entry = output_queue.get()
+            if entry is _DONE:
+                return
+            item, output = entry
+            try:
+                self.write(item, output)
+            except Exception as e:
+                self._fail(item, 'write', e)
+
+    def run(self, items: Iterable[Any]) -> List[Tuple[Any, str, BaseException]]:
+        """Runs every item through the stages and returns the failures."""
+        prepared_queue = queue.Queue(maxsize=self.prefetch)
+        output_queue = queue.Queue(maxsize=self.write_queue_size)
+        stop = threading.Event()
+        prefetch_thread = threading.Thread(
+            target=self._prefetch, args=(items, prepared_queue, stop), daemon=True)
+        writer_thread = threading.Thread(
+            target=self._write, args=(output_queue,), daemon=True)
+
+        t_start = time.perf_counter()
+        prefetch_thread.start()
+        writer_thread.start()
+        try:
+            while True:
+                t0 = time.perf_counter()
+                entry = prepared_queue.get()
+                self.prepare_wait_seconds += time.perf_counter() - t0
+                if entry is _DONE:
+                    break
+                item, prepared, error = entry
+                self.num_items += 1
+                if error is not None:
+                    self._fail(item, 'prepare', error)
+                    continue
+                try:
+                    outputs = iter(self.compute(item, prepared))
+                    while True:
+                        t0 = time.perf_counter()
+                        try:
+                            output = next(outputs)
+                        except StopIteration:
+                            self.compute_seconds += time.perf_counter() - t0
+                            break
+                        self.compute_seconds += time.perf_counter() - t0
+                        t0 = time.perf_counter()
+                        output_queue.put((item, output))
+                        self.write_wait_seconds += time.perf_counter() - t0
+                        self.num_outputs += 1
+                except Exception as e:
+                    self._fail(item, 'compute', e)
+                # Drops the prepared inputs before waiting for the next item
+                entry = prepared = outputs = None
+        finally:
+            stop.set()
+            output_queue.put(_DONE)
+            writer_thread.join()
+            self.wall_seconds += time.perf_counter() - t_start
+        return self.failures
+
+    def summary(self) -> Dict[str, float]:
+        busy_seconds = self.compute_seconds - self.compute_host_seconds
+        busy_fraction = busy_seconds / self.wall_seconds if self.wall_seconds else 0.0
+        return {
+            'num_items': self.num_items,
+            'num_outputs': self.num_outputs,
+            'num_failures': len(self.failures),
+            'wall_seconds': self.wall_seconds,
+            'compute_seconds': self.compute_seconds,
+            'compute_host_seconds': self.compute_host_seconds,
+            'compute_busy_fraction': busy_fraction,
+            'prepare_wait_seconds': self.prepare_wait_seconds,
+            'write_wait_seconds': self.write_wait_seconds,
+        }
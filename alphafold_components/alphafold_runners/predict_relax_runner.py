@@ -13,7 +13,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Predict runner."""
+"""Predict runner.
+
+With FEATURES_PATHS, a comma separated list of feature files, every target
+is predicted by the models in MODEL_NAMES and its outputs are written to
+OUTPUT_DIR/<feature file stem>, with the seeds in RANDOM_SEEDS. Predictions
+are pipelined as in `predict_runner`, and finished predictions are relaxed
+in the writer thread while the models predict the next ones. Early
+stopping is configured as in `predict_runner`, and LENGTH_BUCKETS pads the
+features of every mode as there.
+
+RELAX_SETUP_CACHE=N reuses the OpenMM setup of up to N topologies across
+the relaxations, see `relax_setup_cache`.
+
+RELAX_TOP_K relaxes only the K predictions of each target with the highest
+`ranking_confidence`, once all of the target's predictions are written;
+empty or `all` relaxes every prediction as soon as it is written.
+"""
 
 import io
 import logging
@@ -33,8 +49,14 @@ from alphafold.common import residue_constants
 from alphafold.common import protein
 
 
-from predict_runner import predict
-from relax_runner import relax_protein
+from early_stopping import EarlyStopping, parse_early_stopping
+from length_bucketing import CompileStats, parse_length_buckets
+from predict_runner import (ParamsCache, num_ensemble_from_env, parse_random_seeds, predict,
+                            predict_targets, prediction_name, raw_prediction_name,
+                            target_name, write_prediction)
+import relax_setup_cache
+from relax_runner import parse_relax_top_k, relax_protein, select_top_k
+from xla_cache import XlaCache, enable_xla_cache
 
 def _main(
     model_features_path: str,
@@ -47,38 +69,146 @@ def _main(
     relax_after_predict: bool=False,
     relaxed_protein_path: str=None,
     use_gpu_for_relaxation: bool=True,
+    relax_precheck: str='off',
+    length_buckets: Sequence[int]=(),
+    xla_cache: Optional[XlaCache]=None,
+    full_prediction: bool=False,
+    float16: bool=False,
 ):
     logging.info(f'Running prediction using model {model_name}')
+    compile_stats = CompileStats(xla_cache)
     prediction_result, unrelaxed_pdbs = predict(
         model_features_path=model_features_path,
         model_params_path=model_params_path,
         model_name=model_name,
         num_ensemble=num_ensemble,
-        random_seed=random_seed
+        random_seed=random_seed,
+        length_buckets=length_buckets,
+        compile_stats=compile_stats
     )
+    logging.info(f'Compile stats: {compile_stats.summary()}')
 
-    logging.info(f'Writing model {model_name} prediction to {raw_prediction_path}') 
-    with open(raw_prediction_path, 'wb') as f:
-        pickle.dump(prediction_result, f, protocol=4)
-
-    logging.info(f'Writing unrelaxed protein generated by {model_name} to {unrelaxed_protein_path}') 
-    with open(unrelaxed_protein_path, 'w') as f:
-        f.write(unrelaxed_pdbs)
+    logging.info(f'Writing model {model_name} prediction to {raw_prediction_path} '
+                 f'and unrelaxed protein to {unrelaxed_protein_path}')
+    write_prediction(
+        prediction_result=prediction_result,
+        unrelaxed_pdbs=unrelaxed_pdbs,
+        raw_prediction_path=raw_prediction_path,
+        unrelaxed_protein_path=unrelaxed_protein_path,
+        full_prediction=full_prediction,
+        float16=float16)
 
     if not relax_after_predict:
         return
 
     logging.info(f'Starting protein relaxation')
-    relaxed_protein_pdb = relax_protein(
+    relaxed_protein_pdb, relax_stats = relax_protein(
         unrelaxed_protein_path=unrelaxed_protein_path,
         use_gpu=use_gpu_for_relaxation,
+        precheck=relax_precheck,
     )
+    logging.info(f'Relaxation stats: {relax_stats}')
  
     logging.info(f'Saving relaxed protein to {relaxed_protein_path}')
     with open(relaxed_protein_path, 'w') as f:
         f.write(relaxed_protein_pdb)
      
 
+def _main_targets(
+    model_features_paths: Sequence[str],
+    model_params_path: str,
+    model_names: Sequence[str],
+    num_ensemble: int,
+    random_seeds: Mapping[str, Sequence[int]],
+    output_dir: str,
+    params_cache_max_bytes: int,
+    relax_after_predict: bool=False,
+    use_gpu_for_relaxation: bool=True,
+    relax_precheck: str='off',
+    length_buckets: Sequence[int]=(),
+    xla_cache: Optional[XlaCache]=None,
+    full_prediction: bool=False,
+    float16: bool=False,
+    early_stopping: Optional[EarlyStopping]=None,
+    relax_top_k: Optional[int]=None,
+):
+    def relax(target_dir, name):
+        relaxed_protein_pdb, relax_stats = relax_protein(
+            unrelaxed_protein_path=os.path.join(target_dir, f'unrelaxed_{name}.pdb'),
+            use_gpu=use_gpu_for_relaxation,
+            precheck=relax_precheck,
+        )
+        logging.info(f'Relaxation stats of {name} in {target_dir}: {relax_stats}')
+        with open(os.path.join(target_dir, f'relaxed_{name}.pdb'), 'w') as f:
+            f.write(relaxed_protein_pdb)
+
+    # The ranking confidences of the predictions of the target being written
+    pending = {'target_dir': None, 'ranking_confidences': {}}
+    relax_failures = []
+
+    def relax_pending():
+        target_dir, ranking_confidences = pending['target_dir'], pending['ranking_confidences']
+        if target_dir is None:
+            return
+        # Cleared first, so that a failure is not retried for the next target
+        pending.update(target_dir=None, ranking_confidences={})
+        selected = select_top_k(ranking_confidences, relax_top_k)
+        logging.info(f'Relaxing the top {len(selected)} of {len(ranking_confidences)} '
+                     f'predictions in {target_dir}: {", ".join(selected)}')
+        for name in selected:
+            try:
+                relax(target_dir, name)
+            except Exception:
+                logging.exception(f'Relaxing {name} in {target_dir} failed')
+                relax_failures.append(os.path.join(target_dir, name))
+
+    def write_result(model_features_path, model_name, random_seed, prediction_result,
+                     unrelaxed_pdbs):
+        target_dir = os.path.join(output_dir, target_name(model_features_path))
+        os.makedirs(target_dir, exist_ok=True)
+        name = prediction_name(
+            model_name, random_seed if len(random_seeds[model_name]) > 1 else None)
+        unrelaxed_protein_path = os.path.join(target_dir, f'unrelaxed_{name}.pdb')
+        write_prediction(
+            prediction_result=prediction_result,
+            unrelaxed_pdbs=unrelaxed_pdbs,
+            raw_prediction_path=os.path.join(
+                target_dir, raw_prediction_name(name, full_prediction)),
+            unrelaxed_protein_path=unrelaxed_protein_path,
+            full_prediction=full_prediction,
+            float16=float16)
+        if not relax_after_predict:
+            return
+        if relax_top_k is None:
+            relax(target_dir, name)
+            return
+        # Outputs are written in order, so a new target ends the previous one
+        if pending['target_dir'] != target_dir:
+            relax_pending()
+            pending['target_dir'] = target_dir
+        pending['ranking_confidences'][name] = float(prediction_result['ranking_confidence'])
+
+    compile_stats = CompileStats(xla_cache)
+    executor = predict_targets(
+        model_features_paths=model_features_paths,
+        model_names=model_names,
+        num_ensemble=num_ensemble,
+        random_seeds=random_seeds,
+        params_cache=ParamsCache(model_params_path, params_cache_max_bytes),
+        write_result=write_result,
+        length_buckets=length_buckets,
+        compile_stats=compile_stats,
+        early_stopping=early_stopping)
+    relax_pending()
+    logging.info(f'Pipeline stats: {executor.summary()}')
+    logging.info(f'Compile stats: {compile_stats.summary()}')
+    if executor.failures:
+        raise RuntimeError(f'{len(executor.failures)} target predictions failed')
+    if relax_failures:
+        raise RuntimeError(f'{len(relax_failures)} relaxations failed: '
+                           f'{", ".join(relax_failures)}')
+
+
 if __name__=='__main__':
     logging.basicConfig(format='%(asctime)s - %(message)s',
                         level=logging.INFO, 
@@ -86,19 +216,54 @@ if __name__=='__main__':
                         stream=sys.stdout)
 
     random_seed = int(os.getenv('RANDOM_SEED', '0'))
+    xla_cache = enable_xla_cache(
+        os.getenv('XLA_CACHE_DIR'), int(float(os.getenv('XLA_CACHE_MAX_GB', '20')) * 2**30))
+    full_prediction = bool(int(os.getenv('FULL_PREDICTION', '0')))
+    float16 = bool(int(os.getenv('PREDICTION_FLOAT16', '0')))
+    length_buckets = parse_length_buckets(os.getenv('LENGTH_BUCKETS'))
 
-    # TODO: Do something more intelligent with random seed
-    if not random_seed:
-        random_seed = int(os.environ['MODEL_NAME'][-1])
+    if os.getenv('FEATURES_PATHS'):
+        if int(os.getenv('RELAX_SETUP_CACHE', '0')):
+            relax_setup_cache.install(int(os.environ['RELAX_SETUP_CACHE']))
+        model_names = os.getenv('MODEL_NAMES', os.getenv('MODEL_NAME', '')).split(',')
+        _main_targets(
+            model_features_paths=os.environ['FEATURES_PATHS'].split(','),
+            model_params_path=os.environ['MODEL_PARAMS_PATH'],
+            model_names=model_names,
+            num_ensemble=num_ensemble_from_env(),
+            random_seeds=parse_random_seeds(
+                os.getenv('RANDOM_SEEDS'), model_names, random_seed),
+            output_dir=os.environ['OUTPUT_DIR'],
+            params_cache_max_bytes=int(
+                float(os.getenv('PARAMS_CACHE_MAX_GB', '4')) * 2**30),
+            relax_after_predict=bool(int(os.getenv('RELAX_USE_GPU'))),
+            relax_precheck=os.getenv('RELAX_PRECHECK', 'off'),
+            length_buckets=length_buckets,
+            xla_cache=xla_cache,
+            full_prediction=full_prediction,
+            float16=float16,
+            early_stopping=parse_early_stopping(
+                os.getenv('EARLY_STOP_CONFIDENCE'), os.getenv('EARLY_STOP_PATIENCE'),
+                os.getenv('EARLY_STOP_MIN_DELTA')),
+            relax_top_k=parse_relax_top_k(os.getenv('RELAX_TOP_K')))
+    else:
+        # TODO: Do something more intelligent with random seed
+        if not random_seed:
+            random_seed = int(os.environ['MODEL_NAME'][-1])
 
-    _main(
-        model_features_path=os.environ['FEATURES_PATH'],
-        model_params_path=os.environ['MODEL_PARAMS_PATH'],
-        model_name=os.environ['MODEL_NAME'],
-        num_ensemble=int(os.getenv('NUM_ENSEMBE', '1')),
-        random_seed=random_seed,
-        raw_prediction_path=os.environ['RAW_PREDICTION_PATH'],
-        unrelaxed_protein_path=os.environ["UNRELAXED_PROTEIN_PATH"],
-        relax_after_predict=bool(int(os.getenv('RELAX_USE_GPU'))),
-        relaxed_protein_path=os.getenv('RELAXED_PROTEIN_PATH')
-    )
\ No newline at end of file
+        _main(
+            model_features_path=os.environ['FEATURES_PATH'],
+            model_params_path=os.environ['MODEL_PARAMS_PATH'],
+            model_name=os.environ['MODEL_NAME'],
+            num_ensemble=num_ensemble_from_env(),
+            random_seed=random_seed,
+            raw_prediction_path=os.environ['RAW_PREDICTION_PATH'],
+            unrelaxed_protein_path=os.environ["UNRELAXED_PROTEIN_PATH"],
+            relax_after_predict=bool(int(os.getenv('RELAX_USE_GPU'))),
+            relaxed_protein_path=os.getenv('RELAXED_PROTEIN_PATH'),
+            relax_precheck=os.getenv('RELAX_PRECHECK', 'off'),
+            length_buckets=length_buckets,
+            xla_cache=xla_cache,
+            full_prediction=full_prediction,
+            float16=float16
+        )
\ No newline at end of file
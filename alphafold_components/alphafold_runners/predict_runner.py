@@ -13,9 +13,48 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Predict runner."""
+"""Predict runner.
 
-import io
+With MODEL_NAMES, a comma separated list of models, all models run in one
+process and write `result_<model_name>.npz`, or `result_<model_name>.pkl`
+with FULL_PREDICTION=1, and `unrelaxed_<model_name>.pdb` to OUTPUT_DIR.
+The raw features are loaded once, and processed features are shared by
+models with the same data config and random seed. Haiku params are kept in
+a cache bounded by PARAMS_CACHE_MAX_GB.
+
+RANDOM_SEEDS runs every model with several seeds, given as a comma
+separated list for every model or as e.g. `model_1=0,1;model_2=5`. A model
+is built and compiled once for all its seeds, features are processed per
+seed only if the input pipeline samples with it, and the outputs of models
+with several seeds are tagged, e.g. `result_model_1_seed0.npz`. With
+RANDOM_SEEDS a single MODEL_NAME also writes to OUTPUT_DIR.
+
+EARLY_STOP_CONFIDENCE and EARLY_STOP_PATIENCE skip the remaining models and
+seeds of a target once a prediction reaches the ranking confidence, or once
+that many predictions in a row do not improve on the best by more than
+EARLY_STOP_MIN_DELTA; see `early_stopping`.
+
+With LENGTH_BUCKETS, a comma separated list of lengths, monomer features
+are padded to the smallest bucket that fits, so targets of similar lengths
+reuse compiled model functions; see `length_bucketing`.
+
+With XLA_CACHE_DIR, compiled model functions are kept in a persistent
+cache shared with later processes, bounded by XLA_CACHE_MAX_GB; see
+`xla_cache`.
+
+With FEATURES_PATHS, a comma separated list of feature files, every target
+is predicted by the models in MODEL_NAMES and written to
+OUTPUT_DIR/<feature file stem>. Loading and processing the features of the
+next target, and writing the results of the previous one, overlap with
+running the models; the fraction of time the models kept the device busy
+is logged.
+
+Predictions are written as slim bundles of the arrays used downstream, in
+float16 with PREDICTION_FLOAT16=1; FULL_PREDICTION=1 pickles the full
+`prediction_result` instead. See `prediction_output`.
+"""
+
+import collections
 import logging
 import os
 import numpy as np
@@ -24,7 +63,7 @@ import pickle
 import haiku as hk
 import time
 
-from typing import Any, Mapping, MutableMapping, Optional, Sequence, Union, Tuple
+from typing import Any, Callable, Dict, Iterator, List, Mapping, MutableMapping, Optional, Sequence, Union, Tuple
 
 from alphafold.model import config
 from alphafold.model import model
@@ -32,51 +71,204 @@ from alphafold.model import utils
 from alphafold.common import residue_constants
 from alphafold.common import protein
 
+from early_stopping import EarlyStopping, parse_early_stopping
+from feature_bundle import load_features
+from length_bucketing import (CompileStats, bucket_length, crop_features, padding,
+                              parse_length_buckets, predict_padded, process_features_padded)
+from model_params import load_flat_params
+from pipelined_executor import PipelinedExecutor
+from prediction_output import write_full_prediction, write_prediction_summary, write_slim_prediction
+from xla_cache import XlaCache, compile_key, enable_xla_cache
 
 
 def _get_model_haiku_params(model_name: str,
                             params_dir: str):
-    """Get the Haiku parameters from a model name."""
+    """Get the Haiku parameters from a model name.
 
-    path = os.path.join(params_dir, f'params_{model_name}.npz')
-    with open(path, 'rb') as f:
-        params = np.load(io.BytesIO(f.read()), allow_pickle=False)
+    Parameters converted by `model_params` are memory mapped, otherwise the
+    official `.npz` is read.
+    """
+    params = load_flat_params(params_dir, model_name)
 
     return utils.flat_params_to_haiku(params)
 
 
-def _load_features(features_path):
-    with open(features_path, 'rb') as f:
-        features = pickle.load(f)
-    return features
+# Enough for the params of all five monomer models
+DEFAULT_PARAMS_CACHE_BYTES = 4 * 2**30
 
 
-def predict(
-    model_features_path: str,
-    model_params_path: str,
+def _params_nbytes(params: Mapping[str, Mapping[str, np.ndarray]]) -> int:
+    return sum(array.nbytes for module in params.values() for array in module.values())
+
+
+class ParamsCache:
+    """Haiku params of the most recently used models within a memory budget.
+
+    The least recently used params are dropped once the budget is exceeded,
+    but the params just requested are always kept. Memory mapped params are
+    counted at their full size.
+    """
+
+    def __init__(self, params_dir: str, max_bytes: int=DEFAULT_PARAMS_CACHE_BYTES):
+        self.params_dir = params_dir
+        self.max_bytes = max_bytes
+        self.num_loads = 0
+        self._params = collections.OrderedDict()
+
+    @property
+    def nbytes(self) -> int:
+        return sum(_params_nbytes(params) for params in self._params.values())
+
+    def __contains__(self, model_name: str) -> bool:
+        return model_name in self._params
+
+    def get(self, model_name: str) -> Mapping[str, Mapping[str, np.ndarray]]:
+        if model_name in self._params:
+            self._params.move_to_end(model_name)
+            return self._params[model_name]
+        params = _get_model_haiku_params(
+            model_name=model_name, params_dir=self.params_dir)
+        self.num_loads += 1
+        self._params[model_name] = params
+        while self.nbytes > self.max_bytes and len(self._params) > 1:
+            evicted, _ = self._params.popitem(last=False)
+            logging.info(f'Dropped params of {evicted} from the params cache')
+        return params
+
+
+def _model_feature_names(model_config):
+    """Returns the raw features read by a monomer model's input pipeline."""
+    data_config = model_config.data.common
+    feature_names = set(data_config.unsupervised_features)
+    if data_config.use_templates:
+        feature_names.update(data_config.template_features)
+    # Converted to `deletion_matrix` by `process_features`
+    feature_names.add('deletion_matrix_int')
+    return feature_names
+
+
+def _load_features(features_path, feature_names=None):
+    """Loads a feature bundle or a legacy features pickle.
+
+    If `feature_names` is given only those features are loaded, so the pages
+    of the other arrays in a bundle are never touched.
+    """
+    return load_features(features_path, keys=feature_names)
+
+
+def load_model_runner(
     model_name: str,
+    model_params_path: str,
     num_ensemble: int,
-    random_seed: int,
-) -> Tuple[Mapping, Mapping]:
+) -> model.RunModel:
+    """Builds the config of a model and loads its parameters.
 
+    The returned runner keeps its jitted model function, so predictions of
+    later inputs with the same shapes skip tracing and compilation.
+    """
+    model_params = _get_model_haiku_params(
+        model_name=model_name, params_dir=model_params_path)
+    return model.RunModel(_model_config(model_name, num_ensemble), model_params)
+
+
+def _model_config(model_name: str, num_ensemble: int):
     model_config = config.model_config(model_name)
 
     # we assume  a monomer pipeline in a POC
     model_config.data.eval.num_ensemble = num_ensemble
-    model_params = _get_model_haiku_params(
-        model_name=model_name, params_dir=model_params_path)
-    model_runner = model.RunModel(model_config, model_params)
+    return model_config
 
-    features = _load_features(model_features_path)
-    processed_feature_dict = model_runner.process_features(
-        raw_features=features,
-        random_seed=random_seed
-    )
-    prediction_result = model_runner.predict(
-        feat=processed_feature_dict,
+
+def predict_with_model(
+    model_runner: model.RunModel,
+    model_features_path: str,
+    random_seed: int,
+    length_buckets: Sequence[int]=(),
+    compile_stats: Optional[CompileStats]=None,
+) -> Tuple[Mapping, Mapping]:
+    """Predicts the structure of a features file with a loaded model."""
+    feature_names = None
+    if not model_runner.multimer_mode:
+        feature_names = _model_feature_names(model_runner.config)
+    features = _load_features(model_features_path, feature_names)
+    processed_feature_dict = _process_features(
+        model_runner, features, random_seed, length_buckets)
+    return _predict_processed(
+        model_runner, processed_feature_dict, random_seed, compile_stats)
+
+
+def _process_features(
+    model_runner: model.RunModel,
+    raw_features: Mapping,
+    random_seed: int,
+    length_buckets: Sequence[int]=(),
+) -> Mapping:
+    """Processes features, padded to a length bucket if buckets are given."""
+    if length_buckets and not model_runner.multimer_mode:
+        num_res = int(raw_features['seq_length'][0])
+        padded_length = bucket_length(num_res, length_buckets)
+        if padded_length > num_res:
+            logging.info(f'Padding {num_res} residues to {padded_length}')
+            return process_features_padded(
+                model_runner.config, raw_features, random_seed, padded_length)
+    return model_runner.process_features(
+        raw_features=raw_features,
         random_seed=random_seed
     )
 
+
+def _predict_processed(
+    model_runner: model.RunModel,
+    processed_feature_dict: Mapping,
+    random_seed: int,
+    compile_stats: Optional[CompileStats]=None,
+) -> Tuple[Mapping, Mapping]:
+    prediction_result, processed_feature_dict = _run_model(
+        model_runner, processed_feature_dict, random_seed, compile_stats)
+    return prediction_result, _unrelaxed_pdb(
+        model_runner, processed_feature_dict, prediction_result)
+
+
+def _run_model(
+    model_runner: model.RunModel,
+    processed_feature_dict: Mapping,
+    random_seed: int,
+    compile_stats: Optional[CompileStats]=None,
+) -> Tuple[Mapping, Mapping]:
+    """Runs the model and returns its result and the features of the real residues."""
+    num_res = padded_length = None
+    if not model_runner.multimer_mode:
+        num_res, padded_length = padding(processed_feature_dict)
+
+    xla_cache = compile_stats.xla_cache if compile_stats is not None else None
+    xla_entries = xla_cache.entries() if xla_cache is not None else None
+    t0 = time.time()
+    if num_res != padded_length:
+        prediction_result = predict_padded(
+            model_runner, processed_feature_dict, random_seed)
+    else:
+        prediction_result = model_runner.predict(
+            feat=processed_feature_dict,
+            random_seed=random_seed
+        )
+    if compile_stats is not None:
+        seconds = time.time() - t0
+        compiled = compile_stats.record(model_runner, processed_feature_dict, seconds)
+        logging.info(f'Model function {"compiled" if compiled else "reused"} for '
+                     f'{padded_length or "multimer"} residues in {seconds:.1f}s')
+        if compiled and xla_cache is not None:
+            xla_cache.record(
+                compile_key(model_runner.config, processed_feature_dict), seconds, xla_entries)
+    if num_res != padded_length:
+        processed_feature_dict = crop_features(processed_feature_dict, num_res)
+    return prediction_result, processed_feature_dict
+
+
+def _unrelaxed_pdb(
+    model_runner: model.RunModel,
+    processed_feature_dict: Mapping,
+    prediction_result: Mapping,
+) -> str:
     plddt = prediction_result['plddt']
     plddt_b_factors = np.repeat(
         plddt[:, None], residue_constants.atom_type_num, axis=-1)
@@ -85,9 +277,316 @@ def predict(
         result=prediction_result,
         b_factors=plddt_b_factors,
         remove_leading_feature_dimension=not model_runner.multimer_mode)
-    unrelaxed_pdbs = protein.to_pdb(unrelaxed_structure)
+    return protein.to_pdb(unrelaxed_structure)
+
+
+def predict(
+    model_features_path: str,
+    model_params_path: str,
+    model_name: str,
+    num_ensemble: int,
+    random_seed: int,
+    length_buckets: Sequence[int]=(),
+    compile_stats: Optional[CompileStats]=None,
+) -> Tuple[Mapping, Mapping]:
+
+    model_runner = load_model_runner(
+        model_name=model_name,
+        model_params_path=model_params_path,
+        num_ensemble=num_ensemble)
+    return predict_with_model(
+        model_runner=model_runner,
+        model_features_path=model_features_path,
+        random_seed=random_seed,
+        length_buckets=length_buckets,
+        compile_stats=compile_stats)
+
+
+def _features_depend_on_seed(model_config, raw_features: Mapping) -> bool:
+    """Returns whether processing features for a model samples with the seed.
+
+    The monomer input pipeline samples MSA clusters, masks MSA positions and
+    samples every ensemble member. Multimer models sample inside the model,
+    from the key passed to `predict`, so their features are not processed.
+    """
+    if model_config.model.global_config.multimer_mode:
+        return False
+    eval_config = model_config.data.eval
+    if eval_config.num_ensemble > 1 or eval_config.masked_msa_replace_fraction > 0:
+        return True
+    if 'num_alignments' in raw_features:
+        num_alignments = int(np.ravel(raw_features['num_alignments'])[0])
+    else:
+        num_alignments = len(raw_features['msa'])
+    return num_alignments > eval_config.max_msa_clusters
+
 
-    return prediction_result, unrelaxed_pdbs
+def _processed_features_key(
+    model_config, random_seed: int, raw_features: Mapping) -> Tuple[str, Optional[int]]:
+    """Predictions with equal keys get the same processed features."""
+    return (model_config.data.to_json_best_effort(sort_keys=True),
+            random_seed if _features_depend_on_seed(model_config, raw_features) else None)
+
+
+def _models_feature_names(model_configs) -> Optional[set]:
+    """Returns the raw features read by any of the models, or None for all."""
+    feature_names = set()
+    for model_config in model_configs:
+        if model_config.model.global_config.multimer_mode:
+            return None
+        feature_names.update(_model_feature_names(model_config))
+    return feature_names
+
+
+def _model_seeds(
+    model_names: Sequence[str],
+    random_seeds: Mapping[str, Sequence[int]]) -> List[Tuple[str, int]]:
+    return [(model_name, random_seed)
+            for model_name in model_names for random_seed in random_seeds[model_name]]
+
+
+def _processed_keys(model_configs, model_seeds, raw_features):
+    return {
+        (model_name, random_seed): _processed_features_key(
+            model_configs[model_name], random_seed, raw_features)
+        for model_name, random_seed in model_seeds}
+
+
+def _take_processed_features(processed_features: Dict, remaining_uses: collections.Counter,
+                             key, process: Callable[[], Mapping]) -> Mapping:
+    """Returns the processed features of `key`, processing them on first use.
+
+    They are dropped from `processed_features` after their last use.
+    """
+    if key not in processed_features:
+        processed_features[key] = process()
+    processed_feature_dict = processed_features[key]
+    remaining_uses[key] -= 1
+    if not remaining_uses[key]:
+        del processed_features[key]
+    return processed_feature_dict
+
+
+def num_ensemble_from_env() -> int:
+    """Reads NUM_ENSEMBLE, or NUM_ENSEMBE which the runners used to read."""
+    return int(os.getenv('NUM_ENSEMBLE', os.getenv('NUM_ENSEMBE', '1')))
+
+
+def parse_random_seeds(
+    value: Optional[str],
+    model_names: Sequence[str],
+    default_seed: int=0) -> Dict[str, List[int]]:
+    """Parses the random seeds of every model.
+
+    `value` is either a comma separated list of seeds for every model, e.g.
+    `0,1,2`, or semicolon separated lists per model, e.g.
+    `model_1=0,1;model_2=5`. Models without seeds get `default_seed`, or
+    the digit ending their name if it is 0.
+    """
+    random_seeds = {model_name: [default_seed or int(model_name[-1])]
+                    for model_name in model_names}
+    if not value:
+        return random_seeds
+    if '=' not in value:
+        return {model_name: [int(seed) for seed in value.split(',')]
+                for model_name in model_names}
+    for model_value in value.split(';'):
+        model_name, seeds = model_value.split('=')
+        if model_name not in random_seeds:
+            raise ValueError(f'Random seeds given for unknown model {model_name}')
+        random_seeds[model_name] = [int(seed) for seed in seeds.split(',')]
+    return random_seeds
+
+
+def predict_models(
+    model_features_path: str,
+    model_names: Sequence[str],
+    num_ensemble: int,
+    random_seeds: Mapping[str, Sequence[int]],
+    params_cache: ParamsCache,
+    length_buckets: Sequence[int]=(),
+    compile_stats: Optional[CompileStats]=None,
+    early_stopping: Optional[EarlyStopping]=None,
+) -> Iterator[Tuple[str, int, Mapping, Mapping]]:
+    """Predicts with several models and seeds in one process.
+
+    Yields the model name, random seed, prediction result and unrelaxed
+    protein of every prediction as soon as it completes. Raw features are
+    loaded once, and every model is built once and reused for all its
+    seeds, so its params are loaded and its model function compiled once.
+    Processed features are computed once per data config, and per seed
+    only if processing samples with the seed, and are dropped after their
+    last prediction. With `early_stopping` the remaining predictions are
+    skipped once it decides to stop.
+    """
+    model_configs = {
+        model_name: _model_config(model_name, num_ensemble) for model_name in model_names}
+    features = _load_features(
+        model_features_path, _models_feature_names(model_configs.values()))
+
+    model_seeds = _model_seeds(model_names, random_seeds)
+    processed_keys = _processed_keys(model_configs, model_seeds, features)
+    remaining_uses = collections.Counter(processed_keys.values())
+    logging.info(f'Processing features {len(remaining_uses)} times for '
+                 f'{len(model_seeds)} predictions')
+    processed_features = {}
+
+    model_runner, runner_model_name = None, None
+    for i, (model_name, random_seed) in enumerate(model_seeds):
+        t0 = time.time()
+        if model_name != runner_model_name:
+            model_runner = model.RunModel(model_configs[model_name], params_cache.get(model_name))
+            runner_model_name = model_name
+        processed_feature_dict = _take_processed_features(
+            processed_features, remaining_uses, processed_keys[model_name, random_seed],
+            lambda: _process_features(model_runner, features, random_seed, length_buckets))
+
+        prediction_result, unrelaxed_pdbs = _predict_processed(
+            model_runner, processed_feature_dict, random_seed, compile_stats)
+        logging.info(f'Model {model_name} with seed {random_seed} completed '
+                     f'in {time.time() - t0:.1f}s')
+        yield model_name, random_seed, prediction_result, unrelaxed_pdbs
+
+        if early_stopping is not None and early_stopping.update(
+                prediction_name(model_name, random_seed), prediction_result['ranking_confidence']):
+            early_stopping.log_stop(
+                [prediction_name(*model_seed) for model_seed in model_seeds[i + 1:]])
+            return
+
+
+def predict_targets(
+    model_features_paths: Sequence[str],
+    model_names: Sequence[str],
+    num_ensemble: int,
+    random_seeds: Mapping[str, Sequence[int]],
+    params_cache: ParamsCache,
+    write_result: Callable[[str, str, int, Mapping, str], None],
+    length_buckets: Sequence[int]=(),
+    compile_stats: Optional[CompileStats]=None,
+    early_stopping: Optional[EarlyStopping]=None,
+) -> PipelinedExecutor:
+    """Predicts several targets with several models, overlapping I/O and compute.
+
+    While the models run on one target, a prefetch thread loads the features
+    of the next and processes them for its first prediction. Features for
+    the other predictions are processed when they run and dropped after
+    their last use, as in `predict_models`. A writer thread builds the
+    unrelaxed proteins of finished predictions and passes them to
+    `write_result(model_features_path, model_name, random_seed,
+    prediction_result, unrelaxed_pdbs)`. A model runner is built when its
+    model first runs and kept, with its compiled functions, across seeds
+    and targets for as long as `params_cache` keeps its params.
+    `early_stopping` is applied to every target separately. Returns the
+    executor, whose summary reports how busy the device was; building
+    runners and processing features are host work, not device time.
+    """
+    model_configs = {
+        model_name: _model_config(model_name, num_ensemble) for model_name in model_names}
+    # Runners without params only process features, so they are cheap to keep
+    feature_runners = {
+        model_name: model.RunModel(model_configs[model_name]) for model_name in model_names}
+    model_runners = {}
+    feature_names = _models_feature_names(model_configs.values())
+    model_seeds = _model_seeds(model_names, random_seeds)
+
+    def process(features, model_name, random_seed):
+        return lambda: _process_features(
+            feature_runners[model_name], features, random_seed, length_buckets)
+
+    def model_runner(model_name):
+        params = params_cache.get(model_name)
+        if model_name not in model_runners:
+            model_runners[model_name] = model.RunModel(model_configs[model_name], params)
+        # Runners of evicted params are dropped, so the params cache bounds both
+        for name in list(model_runners):
+            if name not in params_cache:
+                del model_runners[name]
+        return model_runners[model_name]
+
+    def prepare(model_features_path):
+        # Only the features of the first prediction are processed ahead;
+        # the others are processed when their model runs, so predictions
+        # skipped by early stopping are never processed
+        features = _load_features(model_features_path, feature_names)
+        processed_keys = _processed_keys(model_configs, model_seeds, features)
+        model_name, random_seed = model_seeds[0]
+        processed_features = {
+            processed_keys[model_name, random_seed]: process(features, model_name, random_seed)()}
+        return features, processed_keys, processed_features
+
+    def compute(model_features_path, prepared):
+        features, processed_keys, processed_features = prepared
+        prepared = None
+        remaining_uses = collections.Counter(processed_keys.values())
+        if early_stopping is not None:
+            early_stopping.reset()
+        for i, (model_name, random_seed) in enumerate(model_seeds):
+            t0 = time.time()
+            runner = model_runner(model_name)
+            processed_feature_dict = _take_processed_features(
+                processed_features, remaining_uses, processed_keys[model_name, random_seed],
+                process(features, model_name, random_seed))
+            executor.add_host_seconds(time.time() - t0)
+            prediction_result, processed_feature_dict = _run_model(
+                runner, processed_feature_dict, random_seed, compile_stats)
+            logging.info(f'Model {model_name} with seed {random_seed} predicted '
+                         f'{model_features_path} in {time.time() - t0:.1f}s')
+            yield runner, model_name, random_seed, prediction_result, processed_feature_dict
+            runner = None
+
+            if early_stopping is not None and early_stopping.update(
+                    prediction_name(model_name, random_seed),
+                    prediction_result['ranking_confidence']):
+                early_stopping.log_stop(
+                    [prediction_name(*model_seed) for model_seed in model_seeds[i + 1:]])
+                return
+
+    def write(model_features_path, output):
+        runner, model_name, random_seed, prediction_result, processed_feature_dict = output
+        unrelaxed_pdbs = _unrelaxed_pdb(runner, processed_feature_dict, prediction_result)
+        write_result(
+            model_features_path, model_name, random_seed, prediction_result, unrelaxed_pdbs)
+
+    executor = PipelinedExecutor(prepare, compute, write)
+    executor.run(model_features_paths)
+    return executor
+
+
+def target_name(model_features_path: str) -> str:
+    return os.path.splitext(os.path.basename(model_features_path))[0]
+
+
+def prediction_name(model_name: str, random_seed: Optional[int]=None) -> str:
+    """Names the outputs of a model, tagged with the seed if one is given."""
+    return model_name if random_seed is None else f'{model_name}_seed{random_seed}'
+
+
+def _seed_tag(random_seeds: Mapping[str, Sequence[int]],
+              model_name: str, random_seed: int) -> Optional[int]:
+    # Outputs of models run with a single seed keep their untagged names
+    return random_seed if len(random_seeds[model_name]) > 1 else None
+
+
+def raw_prediction_name(model_name: str, full_prediction: bool=False) -> str:
+    return f'result_{model_name}.{"pkl" if full_prediction else "npz"}'
+
+
+def write_prediction(
+    prediction_result: Mapping,
+    unrelaxed_pdbs: str,
+    raw_prediction_path: str,
+    unrelaxed_protein_path: str,
+    full_prediction: bool=False,
+    float16: bool=False,
+):
+    """Writes a slim prediction, or the full pickle if `full_prediction`, and its summary."""
+    if full_prediction:
+        write_full_prediction(prediction_result, raw_prediction_path)
+    else:
+        write_slim_prediction(prediction_result, raw_prediction_path, float16)
+    write_prediction_summary(prediction_result, raw_prediction_path)
+    with open(unrelaxed_protein_path, 'w') as f:
+        f.write(unrelaxed_pdbs)
 
 
 def _main(
@@ -98,25 +597,122 @@ def _main(
     random_seed: int,
     raw_prediction_path: str,
     unrelaxed_protein_path: str,
+    length_buckets: Sequence[int]=(),
+    xla_cache: Optional[XlaCache]=None,
+    full_prediction: bool=False,
+    float16: bool=False,
 ):
     logging.info(f'Running prediction using model {model_name}')
+    compile_stats = CompileStats(xla_cache)
     prediction_result, unrelaxed_pdbs = predict(
         model_features_path=model_features_path,
         model_params_path=model_params_path,
         model_name=model_name,
         num_ensemble=num_ensemble,
-        random_seed=random_seed
+        random_seed=random_seed,
+        length_buckets=length_buckets,
+        compile_stats=compile_stats
     )
+    logging.info(f'Compile stats: {compile_stats.summary()}')
 
-    logging.info(f'Writing model {model_name} prediction to {raw_prediction_path}') 
-    with open(raw_prediction_path, 'wb') as f:
-        pickle.dump(prediction_result, f, protocol=4)
-
-    logging.info(f'Writing unrelaxed protein generated by {model_name} to {unrelaxed_protein_path}') 
-    with open(unrelaxed_protein_path, 'w') as f:
-        f.write(unrelaxed_pdbs)
+    logging.info(f'Writing model {model_name} prediction to {raw_prediction_path} '
+                 f'and unrelaxed protein to {unrelaxed_protein_path}')
+    write_prediction(
+        prediction_result=prediction_result,
+        unrelaxed_pdbs=unrelaxed_pdbs,
+        raw_prediction_path=raw_prediction_path,
+        unrelaxed_protein_path=unrelaxed_protein_path,
+        full_prediction=full_prediction,
+        float16=float16)
      
 
+def _main_models(
+    model_features_path: str,
+    model_params_path: str,
+    model_names: Sequence[str],
+    num_ensemble: int,
+    random_seeds: Mapping[str, Sequence[int]],
+    output_dir: str,
+    params_cache_max_bytes: int,
+    length_buckets: Sequence[int]=(),
+    xla_cache: Optional[XlaCache]=None,
+    full_prediction: bool=False,
+    float16: bool=False,
+    early_stopping: Optional[EarlyStopping]=None,
+):
+    os.makedirs(output_dir, exist_ok=True)
+    params_cache = ParamsCache(model_params_path, params_cache_max_bytes)
+    compile_stats = CompileStats(xla_cache)
+    for model_name, random_seed, prediction_result, unrelaxed_pdbs in predict_models(
+        model_features_path=model_features_path,
+        model_names=model_names,
+        num_ensemble=num_ensemble,
+        random_seeds=random_seeds,
+        params_cache=params_cache,
+        length_buckets=length_buckets,
+        compile_stats=compile_stats,
+        early_stopping=early_stopping):
+        name = prediction_name(model_name, _seed_tag(random_seeds, model_name, random_seed))
+        raw_prediction_path = os.path.join(output_dir, raw_prediction_name(name, full_prediction))
+        unrelaxed_protein_path = os.path.join(output_dir, f'unrelaxed_{name}.pdb')
+        logging.info(f'Writing model {model_name} prediction to {raw_prediction_path} '
+                     f'and unrelaxed protein to {unrelaxed_protein_path}')
+        write_prediction(
+            prediction_result=prediction_result,
+            unrelaxed_pdbs=unrelaxed_pdbs,
+            raw_prediction_path=raw_prediction_path,
+            unrelaxed_protein_path=unrelaxed_protein_path,
+            full_prediction=full_prediction,
+            float16=float16)
+    logging.info(f'Loaded params {params_cache.num_loads} times for {len(model_names)} models '
+                 f'and {sum(len(random_seeds[name]) for name in model_names)} predictions')
+    logging.info(f'Compile stats: {compile_stats.summary()}')
+
+
+def _main_targets(
+    model_features_paths: Sequence[str],
+    model_params_path: str,
+    model_names: Sequence[str],
+    num_ensemble: int,
+    random_seeds: Mapping[str, Sequence[int]],
+    output_dir: str,
+    params_cache_max_bytes: int,
+    length_buckets: Sequence[int]=(),
+    xla_cache: Optional[XlaCache]=None,
+    full_prediction: bool=False,
+    float16: bool=False,
+    early_stopping: Optional[EarlyStopping]=None,
+):
+    def write_result(model_features_path, model_name, random_seed, prediction_result,
+                     unrelaxed_pdbs):
+        target_dir = os.path.join(output_dir, target_name(model_features_path))
+        os.makedirs(target_dir, exist_ok=True)
+        name = prediction_name(model_name, _seed_tag(random_seeds, model_name, random_seed))
+        write_prediction(
+            prediction_result=prediction_result,
+            unrelaxed_pdbs=unrelaxed_pdbs,
+            raw_prediction_path=os.path.join(target_dir, raw_prediction_name(name, full_prediction)),
+            unrelaxed_protein_path=os.path.join(target_dir, f'unrelaxed_{name}.pdb'),
+            full_prediction=full_prediction,
+            float16=float16)
+
+    compile_stats = CompileStats(xla_cache)
+    executor = predict_targets(
+        model_features_paths=model_features_paths,
+        model_names=model_names,
+        num_ensemble=num_ensemble,
+        random_seeds=random_seeds,
+        params_cache=ParamsCache(model_params_path, params_cache_max_bytes),
+        write_result=write_result,
+        length_buckets=length_buckets,
+        compile_stats=compile_stats,
+        early_stopping=early_stopping)
+    logging.info(f'Pipeline stats: {executor.summary()}')
+    logging.info(f'Compile stats: {compile_stats.summary()}')
+    if executor.failures:
+        raise RuntimeError(f'{len(executor.failures)} target predictions failed')
+
+
 if __name__=='__main__':
     logging.basicConfig(format='%(asctime)s - %(message)s',
                         level=logging.INFO, 
@@ -124,17 +720,64 @@ if __name__=='__main__':
                         stream=sys.stdout)
 
     random_seed = int(os.getenv('RANDOM_SEED', '0'))
+    full_prediction = bool(int(os.getenv('FULL_PREDICTION', '0')))
+    float16 = bool(int(os.getenv('PREDICTION_FLOAT16', '0')))
+    xla_cache = enable_xla_cache(
+        os.getenv('XLA_CACHE_DIR'), int(float(os.getenv('XLA_CACHE_MAX_GB', '20')) * 2**30))
+    early_stopping = parse_early_stopping(
+        os.getenv('EARLY_STOP_CONFIDENCE'), os.getenv('EARLY_STOP_PATIENCE'),
+        os.getenv('EARLY_STOP_MIN_DELTA'))
 
-    # TODO: Do something more intelligent with random seed
-    if not random_seed:
-        random_seed = int(os.environ['MODEL_NAME'][-1])
+    if os.getenv('FEATURES_PATHS'):
+        model_names = os.getenv('MODEL_NAMES', os.getenv('MODEL_NAME', '')).split(',')
+        _main_targets(
+            model_features_paths=os.environ['FEATURES_PATHS'].split(','),
+            model_params_path=os.environ['MODEL_PARAMS_PATH'],
+            model_names=model_names,
+            num_ensemble=num_ensemble_from_env(),
+            random_seeds=parse_random_seeds(
+                os.getenv('RANDOM_SEEDS'), model_names, random_seed),
+            output_dir=os.environ['OUTPUT_DIR'],
+            params_cache_max_bytes=int(
+                float(os.getenv('PARAMS_CACHE_MAX_GB', '4')) * 2**30),
+            length_buckets=parse_length_buckets(os.getenv('LENGTH_BUCKETS')),
+            xla_cache=xla_cache,
+            full_prediction=full_prediction,
+            float16=float16,
+            early_stopping=early_stopping)
+    elif os.getenv('MODEL_NAMES') or os.getenv('RANDOM_SEEDS'):
+        model_names = os.getenv('MODEL_NAMES', os.getenv('MODEL_NAME', '')).split(',')
+        _main_models(
+            model_features_path=os.environ['FEATURES_PATH'],
+            model_params_path=os.environ['MODEL_PARAMS_PATH'],
+            model_names=model_names,
+            num_ensemble=num_ensemble_from_env(),
+            # Same default as for a single model
+            random_seeds=parse_random_seeds(
+                os.getenv('RANDOM_SEEDS'), model_names, random_seed),
+            output_dir=os.environ['OUTPUT_DIR'],
+            params_cache_max_bytes=int(
+                float(os.getenv('PARAMS_CACHE_MAX_GB', '4')) * 2**30),
+            length_buckets=parse_length_buckets(os.getenv('LENGTH_BUCKETS')),
+            xla_cache=xla_cache,
+            full_prediction=full_prediction,
+            float16=float16,
+            early_stopping=early_stopping)
+    else:
+        # TODO: Do something more intelligent with random seed
+        if not random_seed:
+            random_seed = int(os.environ['MODEL_NAME'][-1])
 
-    _main(
-        model_features_path=os.environ['FEATURES_PATH'],
-        model_params_path=os.environ['MODEL_PARAMS_PATH'],
-        model_name=os.environ['MODEL_NAME'],
-        num_ensemble=int(os.getenv('NUM_ENSEMBE', '1')),
-        random_seed=random_seed,
-        raw_prediction_path=os.environ['RAW_PREDICTION_PATH'],
-        unrelaxed_protein_path=os.environ["UNRELAXED_PROTEIN_PATH"]
-    )
\ No newline at end of file
+        _main(
+            model_features_path=os.environ['FEATURES_PATH'],
+            model_params_path=os.environ['MODEL_PARAMS_PATH'],
+            model_name=os.environ['MODEL_NAME'],
+            num_ensemble=num_ensemble_from_env(),
+            random_seed=random_seed,
+            raw_prediction_path=os.environ['RAW_PREDICTION_PATH'],
+            unrelaxed_protein_path=os.environ["UNRELAXED_PROTEIN_PATH"],
+            length_buckets=parse_length_buckets(os.getenv('LENGTH_BUCKETS')),
+            xla_cache=xla_cache,
+            full_prediction=full_prediction,
+            float16=float16
+        )
\ No newline at end of file
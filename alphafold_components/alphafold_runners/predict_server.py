@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A long-lived predict worker.
+
+The models in MODEL_NAMES are loaded once and then serve a stream of
+feature files, so only the first input of a given shape pays for loading
+parameters and for JAX tracing and compilation. Every feature file is
+predicted by every model, and the results are written as they complete:
+
+  <output_dir>/result_<model_name>.npz
+  <output_dir>/unrelaxed_<model_name>.pdb
+
+The results are slim predictions, in float16 with PREDICTION_FLOAT16=1,
+or full `prediction_result` pickles named `result_<model_name>.pkl` with
+FULL_PREDICTION=1.
+
+Feature files are taken from one of:
+
+  WATCH_DIR    Feature bundles or pickles dropped into the directory. A
+               file is claimed by moving it to `running/`, then moved to
+               `done/` or `failed/`. Results go to OUTPUT_DIR/<file stem>.
+  SOCKET_PATH  A unix socket accepting one JSON request per line, e.g.
+               {"features_path": "...", "output_dir": "...", "random_seed": 1}
+               and answering each with one JSON line. Requests are served
+               in order of arrival; {"shutdown": true} stops the worker.
+
+With LENGTH_BUCKETS, a comma separated list of lengths, monomer features
+are padded to the smallest bucket that fits, so targets of different but
+similar lengths reuse the compiled model functions. Compile counts and
+times are logged after every request to help tune the buckets.
+
+With XLA_CACHE_DIR, compiled model functions are kept in a persistent
+cache, so a restarted server skips compilation; see `xla_cache`.
+
+Set JAX_PLATFORM_NAME=cpu to serve on a CPU-only JAX backend.
+"""
+
+import glob
+import json
+import logging
+import os
+import socketserver
+import sys
+import time
+
+from typing import Dict, Mapping, Optional, Sequence
+
+from alphafold.model import model
+
+from length_bucketing import CompileStats, parse_length_buckets
+from predict_runner import (load_model_runner, num_ensemble_from_env, predict_with_model,
+                            raw_prediction_name, write_prediction)
+from xla_cache import XlaCache, enable_xla_cache
+
+
+_FEATURE_SUFFIXES = ('.npz', '.pkl')
+
+# Files modified more recently are assumed to be still in transfer
+SETTLE_SECONDS = 2.0
+
+
+def _default_random_seed(model_name: str) -> int:
+    # The same default as `predict_runner`
+    return int(model_name[-1])
+
+
+class PredictServer:
+    """Predicts feature files with models loaded once."""
+
+    def __init__(self, model_runners: Mapping[str, model.RunModel],
+                 length_buckets: Sequence[int]=(),
+                 xla_cache: Optional[XlaCache]=None,
+                 full_prediction: bool=False,
+                 float16: bool=False):
+        self.model_runners = dict(model_runners)
+        self.length_buckets = tuple(length_buckets)
+        self.full_prediction = full_prediction
+        self.float16 = float16
+        self.compile_stats = CompileStats(xla_cache)
+        self.num_served = 0
+        self.num_failed = 0
+
+    @classmethod
+    def load(
+        cls,
+        model_names: Sequence[str],
+        model_params_path: str,
+        num_ensemble: int,
+        length_buckets: Sequence[int]=(),
+        xla_cache: Optional[XlaCache]=None,
+        full_prediction: bool=False,
+        float16: bool=False) -> 'PredictServer':
+        model_runners = {}
+        for model_name in model_names:
+            t0 = time.time()
+            model_runners[model_name] = load_model_runner(
+                model_name=model_name,
+                model_params_path=model_params_path,
+                num_ensemble=num_ensemble)
+            logging.info(f'Loaded model {model_name} in {time.time() - t0:.1f}s')
+        return cls(model_runners, length_buckets, xla_cache, full_prediction, float16)
+
+    def predict(
+        self,
+        features_path: str,
+        output_dir: str,
+        random_seed: Optional[int]=None) -> Dict[str, dict]:
+        """Predicts a feature file with every model and writes the results.
+
+        Returns the output paths and prediction time of every model.
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        outputs = {}
+        for model_name, model_runner in self.model_runners.items():
+            t0 = time.time()
+            prediction_result, unrelaxed_pdbs = predict_with_model(
+                model_runner=model_runner,
+                model_features_path=features_path,
+                random_seed=(random_seed if random_seed is not None
+                             else _default_random_seed(model_name)),
+                length_buckets=self.length_buckets,
+                compile_stats=self.compile_stats)
+            elapsed = time.time() - t0
+            raw_prediction_path = os.path.join(
+                output_dir, raw_prediction_name(model_name, self.full_prediction))
+            unrelaxed_protein_path = os.path.join(output_dir, f'unrelaxed_{model_name}.pdb')
+            write_prediction(
+                prediction_result=prediction_result,
+                unrelaxed_pdbs=unrelaxed_pdbs,
+                raw_prediction_path=raw_prediction_path,
+                unrelaxed_protein_path=unrelaxed_protein_path,
+                full_prediction=self.full_prediction,
+                float16=self.float16)
+            logging.info(f'Model {model_name} predicted {features_path} in {elapsed:.1f}s')
+            outputs[model_name] = {
+                'raw_prediction_path': raw_prediction_path,
+                'unrelaxed_protein_path': unrelaxed_protein_path,
+                'seconds': elapsed,
+            }
+        logging.info(f'Compile stats: {self.compile_stats.summary()}')
+        return outputs
+
+    def serve_request(self, request: Mapping, default_output_dir: Optional[str]=None) -> dict:
+        """Serves a JSON request and returns the JSON response.
+
+        Failures are reported in the response rather than raised, so one bad
+        input does not stop the worker.
+        """
+        try:
+            features_path = request['features_path']
+            output_dir = request.get('output_dir')
+            if not output_dir:
+                if not default_output_dir:
+                    raise ValueError('The request has no output_dir')
+                output_dir = os.path.join(default_output_dir, _stem(features_path))
+            outputs = self.predict(
+                features_path=features_path,
+                output_dir=output_dir,
+                random_seed=request.get('random_seed'))
+        except Exception as e:
+            logging.exception(f'Failed to serve {request}')
+            self.num_failed += 1
+            return {'status': 'failed', 'error': f'{type(e).__name__}: {e}'}
+        self.num_served += 1
+        return {'status': 'ok', 'output_dir': output_dir, 'outputs': outputs}
+
+    def serve_directory(
+        self,
+        watch_dir: str,
+        output_dir: str,
+        poll_interval: float=1.0,
+        max_requests: Optional[int]=None):
+        """Serves the feature files dropped into `watch_dir`, oldest first."""
+        for subdir in ['running', 'done', 'failed']:
+            os.makedirs(os.path.join(watch_dir, subdir), exist_ok=True)
+        logging.info(f'Watching {watch_dir} for feature files')
+        num_requests = 0
+        while max_requests is None or num_requests < max_requests:
+            features_path = _next_feature_file(watch_dir)
+            if features_path is None:
+                time.sleep(poll_interval)
+                continue
+            running_path = os.path.join(watch_dir, 'running', os.path.basename(features_path))
+            try:
+                # Another worker sharing the directory may have claimed it
+                os.rename(features_path, running_path)
+            except FileNotFoundError:
+                continue
+            num_requests += 1
+            response = self.serve_request(
+                {'features_path': running_path,
+                 'output_dir': os.path.join(output_dir, _stem(features_path))})
+            status_dir = os.path.join(watch_dir, 'done' if response['status'] == 'ok' else 'failed')
+            os.replace(running_path, os.path.join(status_dir, os.path.basename(features_path)))
+            with open(os.path.join(status_dir, f'{_stem(features_path)}.json'), 'w') as f:
+                json.dump(response, f, indent=2)
+
+    def serve_socket(self, socket_path: str, default_output_dir: Optional[str]=None):
+        """Serves JSON requests from a unix socket until asked to shut down."""
+        server = self
+
+        class _Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if not line.strip():
+                        continue
+                    try:
+                        request = json.loads(line)
+                    except ValueError as e:
+                        response = {'status': 'failed', 'error': f'Invalid request: {e}'}
+                    else:
+                        if request.get('shutdown'):
+                            self.wfile.write(b'{"status": "shutdown"}\n')
+                            self.server.shutdown_requested = True
+                            return
+                        response = server.serve_request(request, default_output_dir)
+                    self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        with socketserver.UnixStreamServer(socket_path, _Handler) as socket_server:
+            socket_server.shutdown_requested = False
+            logging.info(f'Serving predictions on {socket_path}')
+            while not socket_server.shutdown_requested:
+                socket_server.handle_request()
+        os.remove(socket_path)
+
+
+def _stem(path: str) -> str:
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def _next_feature_file(watch_dir: str) -> Optional[str]:
+    """Returns the oldest complete feature file in `watch_dir`."""
+    candidates = []
+    now = time.time()
+    for path in glob.glob(os.path.join(watch_dir, '*')):
+        if not path.endswith(_FEATURE_SUFFIXES) or not os.path.isfile(path):
+            continue
+        try:
+            mtime = os.path.getmtime(path)
+        except FileNotFoundError:
+            continue
+        if now - mtime >= SETTLE_SECONDS:
+            candidates.append((mtime, path))
+    return min(candidates)[1] if candidates else None
+
+
+if __name__=='__main__':
+    logging.basicConfig(format='%(asctime)s - %(message)s',
+                        level=logging.INFO,
+                        datefmt='%d-%m-%y %H:%M:%S',
+                        stream=sys.stdout)
+
+    predict_server = PredictServer.load(
+        model_names=os.environ['MODEL_NAMES'].split(','),
+        model_params_path=os.environ['MODEL_PARAMS_PATH'],
+        num_ensemble=num_ensemble_from_env(),
+        length_buckets=parse_length_buckets(os.getenv('LENGTH_BUCKETS')),
+        xla_cache=enable_xla_cache(
+            os.getenv('XLA_CACHE_DIR'), int(float(os.getenv('XLA_CACHE_MAX_GB', '20')) * 2**30)),
+        full_prediction=bool(int(os.getenv('FULL_PREDICTION', '0'))),
+        float16=bool(int(os.getenv('PREDICTION_FLOAT16', '0'))))
+
+    if os.getenv('SOCKET_PATH'):
+        predict_server.serve_socket(
+            socket_path=os.environ['SOCKET_PATH'],
+            default_output_dir=os.getenv('OUTPUT_DIR'))
+    else:
+        predict_server.serve_directory(
+            watch_dir=os.environ['WATCH_DIR'],
+            output_dir=os.environ['OUTPUT_DIR'],
+            poll_interval=float(os.getenv('POLL_INTERVAL', '1')))
+
+    logging.info(f'Served {predict_server.num_served} requests, '
+                 f'{predict_server.num_failed} failed')
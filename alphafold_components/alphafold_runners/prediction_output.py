@@ -0,0 +1,213 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Slim prediction outputs.
+
+The full `prediction_result` of a model holds the distogram and masked MSA
+logits, the representations and the structure module trajectory, which
+together reach hundreds of MB for long targets. A slim prediction keeps
+only the arrays used downstream:
+
+  plddt, ranking_confidence
+  predicted_aligned_error, max_predicted_aligned_error, ptm, iptm (if present)
+  structure_module/final_atom_positions, structure_module/final_atom_mask
+
+It is written as a feature bundle, so every array can be memory mapped and
+the file opens with `np.load`. Nested keys are joined with `/`. With
+`float16` the per-residue float arrays are stored at half precision, while
+scalars such as `ranking_confidence` keep their dtype so rankings do not
+change.
+
+Next to every prediction, slim or full, a `<prediction>.summary.json`
+sidecar holds its ranking scalars and pLDDT statistics, so predictions can
+be ranked without loading them. The sidecar records the size and SHA-256
+digest of its prediction and is ignored once the prediction is rewritten.
+Copies, e.g. through GCS, keep both, so the sidecar of a copied
+prediction still applies.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+
+import numpy as np
+
+from typing import Any, Dict, Iterable, Mapping, Optional
+
+from feature_bundle import is_feature_bundle, load_feature_bundle, read_manifest, write_feature_bundle
+
+
+PREDICTION_CONTENT = 'slim-prediction'
+SUMMARY_SUFFIX = '.summary.json'
+
+_DIGEST_CHUNK_BYTES = 2**20
+
+# Outputs written next to predictions, or while writing them
+_NON_PREDICTION_SUFFIXES = (SUMMARY_SUFFIX, '.pdb', '.tmp', '.json')
+
+_SUMMARY_SCALARS = ('ranking_confidence', 'ptm', 'iptm', 'max_predicted_aligned_error')
+
+SLIM_KEYS = (
+    'plddt',
+    'ranking_confidence',
+    'predicted_aligned_error',
+    'max_predicted_aligned_error',
+    'ptm',
+    'iptm',
+    'structure_module/final_atom_positions',
+    'structure_module/final_atom_mask',
+)
+
+
+def _lookup(prediction_result: Mapping[str, Any], key: str) -> Optional[Any]:
+    value = prediction_result
+    for part in key.split('/'):
+        if not isinstance(value, Mapping) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+def slim_prediction(prediction_result: Mapping[str, Any],
+                    float16: bool = False) -> Dict[str, np.ndarray]:
+    """Returns the flat slim arrays of a prediction result."""
+    slim = {}
+    for key in SLIM_KEYS:
+        value = _lookup(prediction_result, key)
+        if value is None:
+            continue
+        array = np.asarray(value)
+        if float16 and array.ndim and array.dtype.kind == 'f':
+            array = array.astype(np.float16)
+        slim[key] = array
+    return slim
+
+
+def write_slim_prediction(prediction_result: Mapping[str, Any],
+                          path: str,
+                          float16: bool = False) -> Dict:
+    """Writes the slim arrays of a prediction result and returns the manifest."""
+    return write_feature_bundle(
+        slim_prediction(prediction_result, float16),
+        path,
+        metadata={'content': PREDICTION_CONTENT, 'float16': float16})
+
+
+def write_full_prediction(prediction_result: Mapping[str, Any], path: str):
+    """Pickles the full prediction result, as AlphaFold does."""
+    # Written aside and moved into place, so a partial pickle is never ranked
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(prediction_result, f, protocol=4)
+    os.replace(tmp_path, path)
+
+
+def prediction_summary(prediction_result: Mapping[str, Any]) -> Dict[str, float]:
+    """Returns the ranking scalars and pLDDT statistics of a prediction."""
+    summary = {}
+    for key in _SUMMARY_SCALARS:
+        if key in prediction_result:
+            summary[key] = float(prediction_result[key])
+    if 'plddt' not in prediction_result:
+        return summary
+    plddt = np.asarray(prediction_result['plddt'], dtype=np.float32)
+    summary.update({
+        'num_residues': int(plddt.shape[0]),
+        'mean_plddt': float(plddt.mean()),
+        'min_plddt': float(plddt.min()),
+        'max_plddt': float(plddt.max()),
+        'fraction_plddt_above_70': float((plddt >= 70).mean()),
+        'fraction_plddt_above_90': float((plddt >= 90).mean()),
+    })
+    return summary
+
+
+def summary_path(path: str) -> str:
+    return f'{path}{SUMMARY_SUFFIX}'
+
+
+def is_summary_path(path: str) -> bool:
+    return path.endswith(SUMMARY_SUFFIX)
+
+
+def is_prediction_name(file_name: str) -> bool:
+    """Whether a file among predictions is one, rather than a known other output.
+
+    Summaries, PDBs, temporary files and JSON outputs such as a ranking are
+    not predictions; any other file is, whatever its name.
+    """
+    return not file_name.endswith(_NON_PREDICTION_SUFFIXES)
+
+
+def _file_digest(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_DIGEST_CHUNK_BYTES), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def write_prediction_summary(prediction_result: Mapping[str, Any], path: str) -> Dict:
+    """Writes the summary sidecar of the prediction written to `path`."""
+    summary = prediction_summary(prediction_result)
+    summary['prediction_bytes'] = os.path.getsize(path)
+    summary['prediction_sha256'] = _file_digest(path)
+    with open(f'{summary_path(path)}.{os.getpid()}.tmp', 'w') as f:
+        json.dump(summary, f, indent=2)
+    os.replace(f'{summary_path(path)}.{os.getpid()}.tmp', summary_path(path))
+    return summary
+
+
+def load_prediction_summary(path: str) -> Optional[Dict[str, float]]:
+    """Returns the sidecar summary of a prediction, or None if it is missing or stale."""
+    try:
+        with open(summary_path(path)) as f:
+            summary = json.load(f)
+        # The size is compared first, so most rewrites are caught unread
+        if (summary.get('prediction_bytes') != os.path.getsize(path)
+                or summary.get('prediction_sha256') != _file_digest(path)):
+            return None
+    except (OSError, ValueError):
+        return None
+    return summary
+
+
+def load_prediction(path: str,
+                    keys: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+    """Loads a slim prediction or a full prediction pickle.
+
+    Slim arrays are returned nested as in the full result, e.g.
+    `result['structure_module']['final_atom_positions']`. `keys` restricts
+    the top-level keys that are returned.
+    """
+    keys = set(keys) if keys is not None else None
+    if is_feature_bundle(path):
+        flat_keys = read_manifest(path)['features']
+        if keys is not None:
+            flat_keys = [key for key in flat_keys if key.split('/')[0] in keys]
+        prediction = {}
+        for key, array in load_feature_bundle(path, keys=flat_keys).items():
+            *scopes, name = key.split('/')
+            scope = prediction
+            for part in scopes:
+                scope = scope.setdefault(part, {})
+            scope[name] = array
+        return prediction
+
+    with open(path, 'rb') as f:
+        prediction = pickle.load(f)
+    if keys is not None:
+        prediction = {key: value for key, value in prediction.items() if key in keys}
+    return prediction
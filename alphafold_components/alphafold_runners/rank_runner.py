@@ -13,7 +13,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Predict runner."""
+"""Rank runner.
+
+Ranks predictions by the `ranking_confidence` in their summary sidecars,
+loading a prediction itself only when its sidecar is missing or stale.
+"""
 
 import json 
 import logging
@@ -23,18 +27,26 @@ import sys
 import pickle
 
 
-from typing import Any, List, Tuple
+from typing import Any, Dict, List, Tuple
+
+from prediction_output import is_prediction_name, load_prediction, load_prediction_summary
 
 
 def rank(
     prediction_result_paths: List[str], 
 ) -> Tuple[dict]:
     ranking_confidences = {} 
+    num_loaded = 0
     for prediction_path in prediction_result_paths:
         file_name = os.path.split(prediction_path)[-1] 
-        with open(prediction_path, 'rb') as f:
-            prediction = pickle.load(f)
-        ranking_confidences[file_name] = prediction['ranking_confidence']
+        summary = load_prediction_summary(prediction_path)
+        if summary is None:
+            logging.info(f'No summary of {file_name}, loading the prediction')
+            summary = load_prediction(prediction_path, keys=['ranking_confidence'])
+            num_loaded += 1
+        ranking_confidences[file_name] = float(summary['ranking_confidence'])
+    logging.info(f'Ranked {len(prediction_result_paths) - num_loaded} predictions by '
+                 f'their summaries and {num_loaded} by loading them')
  
     ranked_order = []
     for idx, (model_name, _) in enumerate(
@@ -48,6 +60,27 @@ def rank(
     return ranking_confidences, ranked_order 
 
 
+def prediction_paths(prediction_results_path: str) -> List[str]:
+    """Lists the predictions in a directory, skipping their summaries and other outputs."""
+    return [os.path.join(prediction_results_path, filename) for
+            filename in os.listdir(prediction_results_path)
+            if is_prediction_name(filename)]
+
+
+def write_ranking(ranking_confidences: Dict[str, float], ranked_order: List[str],
+                  ranking_output_path: str):
+    with open(ranking_output_path, 'w') as f:
+        label = 'plddts'
+        f.write(json.dumps(
+            {label: ranking_confidences, 'order': ranked_order}, indent=4))
+
+
+def load_ranking(ranking_path: str) -> Dict[str, float]:
+    """Returns the ranking confidences of the predictions in a ranking."""
+    with open(ranking_path) as f:
+        return json.load(f)['plddts']
+
+
 def _main(
     prediction_result_paths: List[str],
     ranking_output_path: str,
@@ -57,10 +90,7 @@ def _main(
     ranking_confidences, ranked_order = rank(prediction_result_paths)
     logging.info(f'Writing ranking to {ranking_output_path}')
 
-    with open(ranking_output_path, 'w') as f:
-        label = 'plddts'
-        f.write(json.dumps(
-            {label: ranking_confidences, 'order': ranked_order}, indent=4))
+    write_ranking(ranking_confidences, ranked_order, ranking_output_path)
     
 
 if __name__=='__main__':
@@ -70,8 +100,7 @@ if __name__=='__main__':
                         stream=sys.stdout)
 
     prediction_results_path = os.environ['PREDICTION_RESULTS_PATH']
-    prediction_result_paths = [os.path.join(prediction_results_path, filename) for
-                               filename in os.listdir(prediction_results_path)]
+    prediction_result_paths = prediction_paths(prediction_results_path)
 
     if not prediction_result_paths:
         raise RuntimeError(f'No predictions to rank in {prediction_results_path}')
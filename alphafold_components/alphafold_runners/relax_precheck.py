@@ -0,0 +1,193 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Violation pre-check of unrelaxed structures.
+
+Amber relaxation exists to remove the clashes and broken peptide bonds of
+a prediction. Many confident predictions have none, so the unrelaxed
+coordinates are checked first, with the checks and tolerances of
+AlphaFold's own structural violation check, which decides the
+`num_residue_violations` of a relaxation:
+
+  clash   two heavy atoms of different residues, other than a peptide bond
+          or a disulfide, closer than the sum of their van der Waals radii
+          minus `clash_tolerance`
+  bond    a peptide C-N bond deviating from its ideal length by more than
+          `bond_tolerance_factor` standard deviations
+  angle   a CA-C-N or C-N-CA angle of a peptide bond whose cosine deviates
+          from its ideal by more than `bond_tolerance_factor` standard
+          deviations
+  within  two atoms of a residue whose distance is outside the bounds of
+          `residue_constants.make_atom14_dists_bounds`: the ideal length of
+          a bond, or a bond angle, within `bond_tolerance_factor` standard
+          deviations, and no clash of other atoms
+
+Clashes are found with a k-d tree rather than AlphaFold's all-pairs
+distances. Structures without violations skip relaxation, or get a single
+short minimization, depending on the relax runner's mode.
+"""
+
+import functools
+
+from typing import Any, Dict
+
+import numpy as np
+from scipy import spatial
+
+from alphafold.common import residue_constants
+
+
+PRECHECK_MODES = ('off', 'skip', 'short')
+
+# The tolerances of AlphaFold's structural violation check
+DEFAULT_CLASH_TOLERANCE = 1.5
+DEFAULT_BOND_TOLERANCE_FACTOR = 12.0
+
+_ATOM_RADII = np.array([residue_constants.van_der_waals_radius[name[0]]
+                        for name in residue_constants.atom_types])
+_N = residue_constants.atom_order['N']
+_CA = residue_constants.atom_order['CA']
+_C = residue_constants.atom_order['C']
+_SG = residue_constants.atom_order['SG']
+_PRO = residue_constants.restype_order['P']
+_CYS = residue_constants.restype_order['C']
+
+
+def _make_atom14_to_atom37():
+    """Returns the atom37 index and existence of the atom14 atoms of each restype."""
+    atom14_to_atom37 = np.zeros((residue_constants.restype_num + 1, 14), dtype=np.int64)
+    atom14_exists = np.zeros((residue_constants.restype_num + 1, 14), dtype=bool)
+    resnames = [residue_constants.restype_1to3[restype]
+                for restype in residue_constants.restypes] + ['UNK']
+    for restype, resname in enumerate(resnames):
+        for atom14, name in enumerate(residue_constants.restype_name_to_atom14_names[resname]):
+            if name:
+                atom14_to_atom37[restype, atom14] = residue_constants.atom_order[name]
+                atom14_exists[restype, atom14] = True
+    return atom14_to_atom37, atom14_exists
+
+
+_ATOM14_TO_ATOM37, _ATOM14_EXISTS = _make_atom14_to_atom37()
+
+
+@functools.lru_cache(maxsize=None)
+def _atom14_dists_bounds(clash_tolerance: float, bond_tolerance_factor: float):
+    # Reads AlphaFold's stereo_chemical_props.txt, so it is loaded on first use
+    bounds = residue_constants.make_atom14_dists_bounds(
+        overlap_tolerance=clash_tolerance,
+        bond_length_tolerance_factor=bond_tolerance_factor)
+    return bounds['lower_bound'], bounds['upper_bound']
+
+
+def _chain_index(prot) -> np.ndarray:
+    chain_index = getattr(prot, 'chain_index', None)
+    if chain_index is None:
+        return np.zeros_like(prot.residue_index)
+    return np.asarray(chain_index)
+
+
+def _unit(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.sqrt(1e-6 + np.sum(vectors**2, axis=-1, keepdims=True))
+
+
+def structure_violations(prot,
+                         clash_tolerance: float = DEFAULT_CLASH_TOLERANCE,
+                         bond_tolerance_factor: float = DEFAULT_BOND_TOLERANCE_FACTOR
+                         ) -> Dict[str, Any]:
+    """Returns the clash, peptide bond and within-residue violations of a structure."""
+    positions = np.asarray(prot.atom_positions, dtype=np.float64)
+    mask = np.asarray(prot.atom_mask) > 0.5
+    aatype = np.asarray(prot.aatype)
+    residue_index = np.asarray(prot.residue_index)
+    chain_index = _chain_index(prot)
+
+    # Peptide bonds join consecutive residues of a chain
+    bonded = ((chain_index[1:] == chain_index[:-1])
+              & (residue_index[1:] == residue_index[:-1] + 1))
+    c_n = positions[1:, _N] - positions[:-1, _C]
+    c_n_length = np.linalg.norm(c_n, axis=-1)
+    is_proline = aatype[1:] == _PRO
+    ideal = np.where(is_proline, residue_constants.between_res_bond_length_c_n[1],
+                     residue_constants.between_res_bond_length_c_n[0])
+    stddev = np.where(is_proline, residue_constants.between_res_bond_length_stddev_c_n[1],
+                      residue_constants.between_res_bond_length_stddev_c_n[0])
+    bond_mask = bonded & mask[1:, _N] & mask[:-1, _C]
+    bond_deviation = np.where(bond_mask, np.abs(c_n_length - ideal), 0.0)
+    bond_violations = bond_deviation > bond_tolerance_factor * stddev
+
+    # The angles of the peptide bonds, compared by their cosines
+    c_n_unit = _unit(c_n)
+    ca_c_n_cos = np.sum(_unit(positions[:-1, _CA] - positions[:-1, _C]) * c_n_unit, axis=-1)
+    c_n_ca_cos = np.sum(-c_n_unit * _unit(positions[1:, _CA] - positions[1:, _N]), axis=-1)
+    angle_violations = np.zeros(len(bond_mask), dtype=bool)
+    for cos, angle_mask, (ideal_cos, stddev_cos) in [
+            (ca_c_n_cos, bond_mask & mask[:-1, _CA], residue_constants.between_res_cos_angles_ca_c_n),
+            (c_n_ca_cos, bond_mask & mask[1:, _CA], residue_constants.between_res_cos_angles_c_n_ca)]:
+        angle_violations |= angle_mask & (
+            np.abs(cos - ideal_cos) > bond_tolerance_factor * stddev_cos)
+
+    # The distances of the atoms within each residue
+    lower_bound, upper_bound = _atom14_dists_bounds(clash_tolerance, bond_tolerance_factor)
+    atom14 = _ATOM14_TO_ATOM37[aatype]
+    atom14_positions = np.take_along_axis(positions, atom14[..., None], axis=1)
+    atom14_mask = np.take_along_axis(mask, atom14, axis=1) & _ATOM14_EXISTS[aatype]
+    dists = np.linalg.norm(
+        atom14_positions[:, :, None] - atom14_positions[:, None, :], axis=-1)
+    dists_mask = atom14_mask[:, :, None] & atom14_mask[:, None, :] & ~np.eye(14, dtype=bool)
+    within_violations = dists_mask & ((dists < lower_bound[aatype])
+                                      | (dists > upper_bound[aatype]))
+
+    residues, atoms = np.nonzero(mask)
+    coords = positions[residues, atoms]
+    radii = _ATOM_RADII[atoms]
+    max_distance = 2 * _ATOM_RADII.max() - clash_tolerance
+    pairs = spatial.cKDTree(coords).query_pairs(
+        max_distance, output_type='ndarray')
+    i, j = pairs[:, 0], pairs[:, 1]
+    keep = residues[i] != residues[j]
+    i, j = i[keep], j[keep]
+    # Orders each pair so that residue i precedes residue j
+    swap = residues[i] > residues[j]
+    i, j = np.where(swap, j, i), np.where(swap, i, j)
+    bonded_to_next = np.append(bonded, False)
+    peptide = ((residues[j] == residues[i] + 1) & (atoms[i] == _C) & (atoms[j] == _N)
+               & bonded_to_next[residues[i]])
+    disulfide = ((atoms[i] == _SG) & (atoms[j] == _SG)
+                 & (aatype[residues[i]] == _CYS) & (aatype[residues[j]] == _CYS))
+    keep = ~(peptide | disulfide)
+    i, j = i[keep], j[keep]
+    distance = np.linalg.norm(coords[i] - coords[j], axis=-1)
+    overlap = radii[i] + radii[j] - clash_tolerance - distance
+    clashes = overlap > 0
+
+    violating_residues = within_violations.any(axis=(1, 2))
+    violating_residues[residues[i][clashes]] = True
+    violating_residues[residues[j][clashes]] = True
+    peptide_violations = bond_violations | angle_violations
+    violating_residues[:-1] |= peptide_violations
+    violating_residues[1:] |= peptide_violations
+    return {
+        'num_clashes': int(clashes.sum()),
+        'max_clash_overlap': float(overlap[clashes].max()) if clashes.any() else 0.0,
+        'num_bond_violations': int(bond_violations.sum()),
+        'max_bond_deviation': float(bond_deviation.max()) if len(bond_deviation) else 0.0,
+        'num_angle_violations': int(angle_violations.sum()),
+        # Every violating pair of atoms is counted once
+        'num_within_residue_violations': int(within_violations.sum()) // 2,
+        'num_violating_residues': int(violating_residues.sum()),
+    }
+
+
+def is_violation_free(violations: Dict[str, Any]) -> bool:
+    return violations['num_violating_residues'] == 0
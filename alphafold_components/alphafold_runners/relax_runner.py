@@ -13,17 +13,140 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Predict runner."""
+"""Relax runner.
 
+With UNRELAXED_PROTEINS_DIR, or a comma separated list of
+UNRELAXED_PROTEIN_PATHS, every unrelaxed PDB is relaxed in a process pool
+and written to RELAXED_PROTEINS_DIR, together with `relax_stats.json`
+holding the timing, energies and violations of every structure. On CPU
+the pool has one worker per core (RELAX_WORKERS overrides it), and every
+worker runs OpenMM on a single thread, so throughput scales with the
+number of cores instead of contending for them.
+
+With RANKING_RESULTS_PATH, a ranking written by `rank_runner`, only the
+unrelaxed PDBs of the RELAX_TOP_K predictions with the highest
+`ranking_confidence` are relaxed; empty or `all` relaxes all of them.
+"""
+
+import json
 import logging
+import multiprocessing
 import os
 import sys
+import time
 
-from typing import Any, Mapping, MutableMapping, Optional, Sequence, Union, Tuple
+import numpy as np
+
+from typing import Any, Dict, List, Mapping, MutableMapping, Optional, Sequence, Union, Tuple
 
 from alphafold.common import protein
 from alphafold.relax import relax
 
+from rank_runner import load_ranking
+import relax_setup_cache
+from relax_precheck import PRECHECK_MODES, is_violation_free, structure_violations
+
+
+RELAX_STATS_NAME = 'relax_stats.json'
+
+# Relaxers built by this process, by their options
+_relaxers = {}
+
+
+def _amber_relaxer(**options) -> relax.AmberRelaxation:
+    """Returns a relaxer with `options`, built once per process."""
+    key = json.dumps(options, sort_keys=True)
+    if key not in _relaxers:
+        _relaxers[key] = relax.AmberRelaxation(**options)
+    return _relaxers[key]
+
+
+def _relax_options(
+    max_iterations: int=0,
+    tolerance: float=2.39,
+    stiffness: float=10.0,
+    exclude_residues: list=[],
+    max_outer_iterations: int=3,
+    use_gpu=False,
+) -> Dict[str, Any]:
+    return {
+        'max_iterations': max_iterations,
+        'tolerance': tolerance,
+        'stiffness': stiffness,
+        'exclude_residues': list(exclude_residues),
+        'max_outer_iterations': max_outer_iterations,
+        'use_gpu': bool(use_gpu),
+    }
+
+
+# Seconds and residues of the full relaxations of this process, to estimate
+# the time a skipped or short relaxation saves
+_full_relaxations = {'seconds': 0.0, 'num_residues': 0}
+
+# Rough seconds per residue of a full relaxation on a GPU and on CPU, used
+# until this process has timed a full relaxation of its own
+DEFAULT_SECONDS_PER_RESIDUE = {True: 0.05, False: 0.25}
+
+
+def relax_structure(
+    unrelaxed_protein_pdb: str,
+    precheck: str='off',
+    short_max_iterations: int=100,
+    **options) -> Tuple[str, Dict[str, Any]]:
+    """Relaxes a PDB string and returns the relaxed PDB and its stats.
+
+    With `precheck` set to `skip` a structure without any of the violations
+    of AlphaFold's structural violation check is returned unrelaxed, and
+    with `short` it gets a single minimization of at most
+    `short_max_iterations` steps.
+    """
+    if precheck not in PRECHECK_MODES:
+        raise ValueError(f'Unknown relax precheck mode {precheck}, expected one of {PRECHECK_MODES}')
+    t0 = time.time()
+    unrelaxed_structure = protein.from_pdb_string(unrelaxed_protein_pdb)
+    num_residues = len(unrelaxed_structure.aatype)
+    stats = {'num_residues': num_residues, 'relax_mode': 'full'}
+    options = _relax_options(**options)
+
+    if precheck != 'off':
+        precheck_violations = structure_violations(unrelaxed_structure)
+        stats['precheck_seconds'] = time.time() - t0
+        stats['precheck_violations'] = precheck_violations
+        if is_violation_free(precheck_violations):
+            stats['relax_mode'] = 'skipped' if precheck == 'skip' else 'short'
+
+    if stats['relax_mode'] == 'skipped':
+        relaxed_protein_pdb = unrelaxed_protein_pdb
+        stats['num_violating_residues'] = 0
+    else:
+        if stats['relax_mode'] == 'short':
+            options.update(max_iterations=short_max_iterations, max_outer_iterations=1)
+        amber_relaxer = _amber_relaxer(**options)
+        setup_cache = relax_setup_cache.installed()
+        setup_stats = setup_cache.stats() if setup_cache else None
+        relaxed_protein_pdb, debug_data, violations = amber_relaxer.process(
+            prot=unrelaxed_structure)
+        if setup_cache:
+            stats.update({key: value - setup_stats[key]
+                          for key, value in setup_cache.stats().items()})
+        stats['num_violating_residues'] = int(np.sum(violations))
+        stats.update({key: float(value) for key, value in debug_data.items()})
+    stats['seconds'] = time.time() - t0
+
+    if stats['relax_mode'] == 'full':
+        _full_relaxations['seconds'] += stats['seconds']
+        _full_relaxations['num_residues'] += num_residues
+    else:
+        if _full_relaxations['num_residues']:
+            seconds_per_residue = _full_relaxations['seconds'] / _full_relaxations['num_residues']
+        else:
+            seconds_per_residue = DEFAULT_SECONDS_PER_RESIDUE[options['use_gpu']]
+        stats['estimated_seconds_saved'] = max(
+            seconds_per_residue * num_residues - stats['seconds'], 0.0)
+        logging.info(f'Structure of {num_residues} residues is violation free, '
+                     f'relaxation {stats["relax_mode"]} in {stats["seconds"]:.1f}s')
+    return relaxed_protein_pdb, stats
+
 
 def relax_protein(
     unrelaxed_protein_path: str,
@@ -32,49 +155,254 @@ def relax_protein(
     stiffness: float=10.0,
     exclude_residues: list=[],
     max_outer_iterations: int=3,
-    use_gpu=False
-) -> Mapping:
+    use_gpu=False,
+    precheck: str='off'
+) -> Tuple[str, Dict[str, Any]]:
+    """Relaxes a PDB file and returns the relaxed PDB and its stats."""
 
     with open(unrelaxed_protein_path, 'r') as f:
         unrelaxed_protein_pdb=f.read();
 
-    unrelaxed_structure = protein.from_pdb_string(unrelaxed_protein_pdb)
-    amber_relaxer = relax.AmberRelaxation(
+    return relax_structure(
+        unrelaxed_protein_pdb,
         max_iterations=max_iterations,
         tolerance=tolerance,
         stiffness=stiffness,
         exclude_residues=exclude_residues,
         max_outer_iterations=max_outer_iterations,
-        use_gpu=use_gpu)
-    relaxed_protein_pdb, _, _ = amber_relaxer.process(prot=unrelaxed_structure)
+        use_gpu=use_gpu,
+        precheck=precheck)
 
-    return relaxed_protein_pdb
+
+def parse_relax_top_k(value: Optional[str]) -> Optional[int]:
+    """Parses RELAX_TOP_K; empty or `all` relaxes every prediction."""
+    if not value or value.lower() == 'all':
+        return None
+    return int(value)
+
+
+def select_top_k(ranking_confidences: Mapping[str, float],
+                 top_k: Optional[int]) -> List[str]:
+    """Returns the names of the `top_k` most confident predictions, best first."""
+    names = sorted(ranking_confidences, key=lambda name: -float(ranking_confidences[name]))
+    return names if top_k is None else names[:max(top_k, 0)]
+
+
+def relaxed_name(unrelaxed_protein_path: str) -> str:
+    """Names the relaxed PDB of e.g. `unrelaxed_model_1.pdb` `relaxed_model_1.pdb`."""
+    name = os.path.basename(unrelaxed_protein_path)
+    if name.startswith('unrelaxed_'):
+        return name[len('un'):]
+    return f'relaxed_{name}'
+
+
+def _strip(name: str, prefix: str) -> str:
+    name = os.path.splitext(os.path.basename(name))[0]
+    return name[len(prefix):] if name.startswith(prefix) else name
+
+
+def top_k_unrelaxed_paths(unrelaxed_protein_paths: Sequence[str],
+                          ranking_confidences: Mapping[str, float],
+                          top_k: Optional[int]) -> List[str]:
+    """Returns the unrelaxed PDBs of the `top_k` most confident predictions, best first.
+
+    Predictions of a ranking are matched to PDBs by name, e.g.
+    `result_model_1.npz` to `unrelaxed_model_1.pdb`.
+    """
+    paths = {_strip(path, 'unrelaxed_'): path for path in unrelaxed_protein_paths}
+    selected = [_strip(name, 'result_') for name in select_top_k(ranking_confidences, top_k)]
+    missing = [name for name in selected if name not in paths]
+    if missing:
+        raise RuntimeError(f'No unrelaxed proteins of the predictions {", ".join(missing)}')
+    return [paths[name] for name in selected]
+
+
+def _init_worker(num_threads: int, setup_cache_entries: int=0):
+    # Read by OpenMM when the CPU platform creates a context
+    os.environ['OPENMM_CPU_THREADS'] = str(num_threads)
+    if setup_cache_entries:
+        relax_setup_cache.install(setup_cache_entries)
+
+
+def _relax_file(args) -> Dict[str, Any]:
+    """Relaxes one PDB file in a worker; failures are returned as stats."""
+    unrelaxed_protein_path, relaxed_protein_path, options = args
+    stats = {'unrelaxed_protein_path': unrelaxed_protein_path,
+             'relaxed_protein_path': relaxed_protein_path}
+    try:
+        with open(unrelaxed_protein_path) as f:
+            relaxed_protein_pdb, relax_stats = relax_structure(f.read(), **options)
+        with open(relaxed_protein_path, 'w') as f:
+            f.write(relaxed_protein_pdb)
+    except Exception as e:
+        logging.exception(f'Failed to relax {unrelaxed_protein_path}')
+        stats.update({'status': 'failed', 'error': f'{type(e).__name__}: {e}'})
+        return stats
+    stats.update(relax_stats)
+    stats['status'] = 'ok'
+    return stats
+
+
+def default_num_workers(use_gpu: bool=False) -> int:
+    """One worker per available core, or a single worker sharing the GPU."""
+    if use_gpu:
+        return 1
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def relax_batch(
+    unrelaxed_protein_paths: Sequence[str],
+    output_dir: str,
+    num_workers: Optional[int]=None,
+    setup_cache_entries: int=0,
+    **options) -> Dict[str, Any]:
+    """Relaxes PDB files in a process pool and returns the batch stats.
+
+    Every worker builds its relaxer once and relaxes its structures on one
+    OpenMM thread. With `setup_cache_entries` every worker also reuses the
+    OpenMM setup of that many topologies, see `relax_setup_cache`. The stats
+    of every structure and of the batch are also written to
+    `relax_stats.json` in `output_dir`.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    num_workers = num_workers or default_num_workers(options.get('use_gpu', False))
+    num_workers = min(num_workers, len(unrelaxed_protein_paths)) or 1
+    tasks = [(path, os.path.join(output_dir, relaxed_name(path)), options)
+             for path in unrelaxed_protein_paths]
+
+    t0 = time.time()
+    if num_workers == 1:
+        if setup_cache_entries:
+            relax_setup_cache.install(setup_cache_entries)
+        structures = [_relax_file(task) for task in tasks]
+    else:
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(num_workers, initializer=_init_worker,
+                          initargs=(1, setup_cache_entries)) as pool:
+            structures = []
+            for stats in pool.imap_unordered(_relax_file, tasks):
+                logging.info(f'Relaxed {stats["unrelaxed_protein_path"]}: {stats["status"]}')
+                structures.append(stats)
+        structures.sort(key=lambda stats: stats['unrelaxed_protein_path'])
+    wall_seconds = time.time() - t0
+
+    relax_seconds = sum(stats.get('seconds', 0.0) for stats in structures)
+    relax_modes = [stats.get('relax_mode') for stats in structures]
+    batch_stats = {
+        'num_workers': num_workers,
+        'num_structures': len(structures),
+        'num_failed': sum(stats['status'] != 'ok' for stats in structures),
+        'wall_seconds': wall_seconds,
+        'relax_seconds': relax_seconds,
+        # The fraction of the workers' time spent relaxing. Workers relax on
+        # one thread, so this is not a speedup over sequential relaxation
+        # with multi-threaded OpenMM; performance_tests/relax_batch_benchmark.py
+        # measures that.
+        'parallel_efficiency': (relax_seconds / (wall_seconds * num_workers)
+                                if wall_seconds else 0.0),
+        'num_skipped': relax_modes.count('skipped'),
+        'num_short': relax_modes.count('short'),
+        'estimated_seconds_saved': sum(
+            stats.get('estimated_seconds_saved', 0.0) for stats in structures),
+        'setup_seconds': sum(stats.get('setup_seconds', 0.0) for stats in structures),
+        'structures': structures,
+    }
+    with open(os.path.join(output_dir, RELAX_STATS_NAME), 'w') as f:
+        json.dump(batch_stats, f, indent=2)
+    return batch_stats
 
 
 def _main(
     unrelaxed_protein_path: str,
     relaxed_protein_path: str,
-    use_gpu=False
+    use_gpu=False,
+    precheck: str='off'
 ):
     logging.info(f'Starting protein relaxation')
-    relaxed_protein_pdb = relax_protein(
-        unrelaxed_protein_path=unrelaxed_protein_path,
-        use_gpu=use_gpu
-    )
+    with open(unrelaxed_protein_path, 'r') as f:
+        relaxed_protein_pdb, stats = relax_structure(
+            f.read(), use_gpu=use_gpu, precheck=precheck)
+    logging.info(f'Relaxation stats: {stats}')
  
     logging.info(f'Saving relaxed protein to {relaxed_protein_path}')
     with open(relaxed_protein_path, 'w') as f:
         f.write(relaxed_protein_pdb)
      
 
+def _unrelaxed_protein_paths(
+    unrelaxed_proteins_dir: Optional[str],
+    unrelaxed_protein_paths: Optional[str]) -> List[str]:
+    if unrelaxed_protein_paths:
+        return unrelaxed_protein_paths.split(',')
+    return sorted(
+        os.path.join(unrelaxed_proteins_dir, name)
+        for name in os.listdir(unrelaxed_proteins_dir) if name.endswith('.pdb'))
+
+
+def _main_batch(
+    unrelaxed_protein_paths: Sequence[str],
+    relaxed_proteins_dir: str,
+    num_workers: Optional[int]=None,
+    use_gpu=False,
+    precheck: str='off',
+    setup_cache_entries: int=0,
+    ranking_confidences: Optional[Mapping[str, float]]=None,
+    top_k: Optional[int]=None,
+):
+    if not unrelaxed_protein_paths:
+        raise RuntimeError('No unrelaxed proteins to relax')
+    if ranking_confidences is not None:
+        num_unrelaxed = len(unrelaxed_protein_paths)
+        unrelaxed_protein_paths = top_k_unrelaxed_paths(
+            unrelaxed_protein_paths, ranking_confidences, top_k)
+        logging.info(f'Selected the top {len(unrelaxed_protein_paths)} of '
+                     f'{num_unrelaxed} proteins by ranking confidence')
+    logging.info(f'Relaxing {len(unrelaxed_protein_paths)} proteins')
+    batch_stats = relax_batch(
+        unrelaxed_protein_paths=unrelaxed_protein_paths,
+        output_dir=relaxed_proteins_dir,
+        num_workers=num_workers,
+        setup_cache_entries=setup_cache_entries,
+        use_gpu=use_gpu,
+        precheck=precheck)
+    logging.info(f'Relaxed {batch_stats["num_structures"]} proteins with '
+                 f'{batch_stats["num_workers"]} workers in {batch_stats["wall_seconds"]:.1f}s, '
+                 f'parallel efficiency {batch_stats["parallel_efficiency"]:.0%}; '
+                 f'{batch_stats["num_failed"]} failed')
+    if batch_stats['num_skipped'] or batch_stats['num_short']:
+        logging.info(f'Violation-free structures: {batch_stats["num_skipped"]} skipped, '
+                     f'{batch_stats["num_short"]} short, an estimated '
+                     f'{batch_stats["estimated_seconds_saved"]:.1f}s saved')
+    if batch_stats['num_failed']:
+        raise RuntimeError(f'{batch_stats["num_failed"]} relaxations failed')
+
+
 if __name__=='__main__':
     logging.basicConfig(format='%(asctime)s - %(message)s',
                         level=logging.INFO, 
                         datefmt='%d-%m-%y %H:%M:%S',
                         stream=sys.stdout)
 
-    _main(
-        unrelaxed_protein_path=os.environ['UNRELAXED_PROTEIN_PATH'],
-        relaxed_protein_path=os.environ['RELAXED_PROTEIN_PATH'],
-        use_gpu=bool(os.environ['RELAX_USE_GPU']),
-    )
\ No newline at end of file
+    if os.getenv('UNRELAXED_PROTEINS_DIR') or os.getenv('UNRELAXED_PROTEIN_PATHS'):
+        _main_batch(
+            unrelaxed_protein_paths=_unrelaxed_protein_paths(
+                os.getenv('UNRELAXED_PROTEINS_DIR'), os.getenv('UNRELAXED_PROTEIN_PATHS')),
+            relaxed_proteins_dir=os.environ['RELAXED_PROTEINS_DIR'],
+            num_workers=int(os.getenv('RELAX_WORKERS', '0')) or None,
+            use_gpu=bool(int(os.getenv('RELAX_USE_GPU', '0'))),
+            precheck=os.getenv('RELAX_PRECHECK', 'off'),
+            setup_cache_entries=int(os.getenv('RELAX_SETUP_CACHE', '0')),
+            ranking_confidences=(load_ranking(os.environ['RANKING_RESULTS_PATH'])
+                                 if os.getenv('RANKING_RESULTS_PATH') else None),
+            top_k=parse_relax_top_k(os.getenv('RELAX_TOP_K')),
+        )
+    else:
+        _main(
+            unrelaxed_protein_path=os.environ['UNRELAXED_PROTEIN_PATH'],
+            relaxed_protein_path=os.environ['RELAXED_PROTEIN_PATH'],
+            use_gpu=bool(os.environ['RELAX_USE_GPU']),
+            precheck=os.getenv('RELAX_PRECHECK', 'off'),
+        )
\ No newline at end of file
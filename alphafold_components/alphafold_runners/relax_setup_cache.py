@@ -0,0 +1,204 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Reuse of the OpenMM setup of relaxations within a process.
+
+Every minimization of AlphaFold's `amber_minimize` parses the amber99sb
+force field, creates the system of the topology, which matches every
+residue to its force field template, and creates the OpenMM context. The
+models and seeds of one sequence mostly share that setup, so this cache
+keeps
+
+  the force field, parsed once per process
+  a simulation per topology and relax options, whose restraint reference
+  positions are updated for every new structure
+
+Topologies are keyed on their chains, residues, atoms and bonds after
+pdbfixer added hydrogens and PDB parsing added disulfide bonds, so
+structures whose histidine protonation or disulfides differ never share a
+system. The options in the key are the force field, constraints,
+stiffness, restraint set, excluded residues and platform.
+
+`install` replaces `amber_minimize._openmm_minimize`, which every relax
+attempt calls, with a cached version of the same minimization.
+"""
+
+import collections
+import hashlib
+import io
+import logging
+import time
+
+from typing import Any, Dict, Optional, Sequence
+
+from alphafold.relax import amber_minimize
+
+
+FORCE_FIELD = 'amber99sb.xml'
+DEFAULT_MAX_ENTRIES = 8
+
+openmm = amber_minimize.openmm
+openmm_app = amber_minimize.openmm_app
+ENERGY = amber_minimize.ENERGY
+LENGTH = amber_minimize.LENGTH
+
+
+def topology_key(topology) -> str:
+    """Returns a key identifying the system a topology creates."""
+    hasher = hashlib.sha256()
+    for chain in topology.chains():
+        hasher.update(b'chain')
+        for residue in chain.residues():
+            atom_names = ','.join(atom.name for atom in residue.atoms())
+            hasher.update(f'{residue.name}:{atom_names};'.encode())
+    for atom1, atom2 in topology.bonds():
+        hasher.update(f'{atom1.index}-{atom2.index};'.encode())
+    return hasher.hexdigest()
+
+
+class _Entry:
+    """A simulation and its restraint force."""
+
+    def __init__(self, simulation, restraints, restrained_atoms):
+        self.simulation = simulation
+        self.restraints = restraints
+        self.restrained_atoms = restrained_atoms
+
+
+class RelaxSetupCache:
+    """Caches force fields and simulations of the minimizations of a process."""
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._force_fields = {}
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.setup_seconds = 0.0
+
+    def force_field(self, name: str = FORCE_FIELD):
+        if name not in self._force_fields:
+            self._force_fields[name] = openmm_app.ForceField(name)
+        return self._force_fields[name]
+
+    def _create(self, pdb, stiffness, restraint_set: str,
+                exclude_residues: Sequence[int], use_gpu: bool) -> _Entry:
+        """Creates the simulation AlphaFold's `_openmm_minimize` would."""
+        system = self.force_field().createSystem(
+            pdb.topology, constraints=openmm_app.HBonds)
+        restraints, restrained_atoms = None, []
+        if stiffness > 0 * ENERGY / (LENGTH**2):
+            restraints = openmm.CustomExternalForce(
+                '0.5 * k * ((x-x0)^2 + (y-y0)^2 + (z-z0)^2)')
+            restraints.addGlobalParameter('k', stiffness)
+            for p in ['x0', 'y0', 'z0']:
+                restraints.addPerParticleParameter(p)
+            for i, atom in enumerate(pdb.topology.atoms()):
+                if atom.residue.index in exclude_residues:
+                    continue
+                if amber_minimize.will_restrain(atom, restraint_set):
+                    restraints.addParticle(i, pdb.positions[i])
+                    restrained_atoms.append(i)
+            logging.info(f'Restraining {len(restrained_atoms)} / '
+                         f'{system.getNumParticles()} particles.')
+            system.addForce(restraints)
+        integrator = openmm.LangevinIntegrator(0, 0.01, 0.0)
+        platform = openmm.Platform.getPlatformByName('CUDA' if use_gpu else 'CPU')
+        simulation = openmm_app.Simulation(pdb.topology, system, integrator, platform)
+        return _Entry(simulation, restraints, restrained_atoms)
+
+    def simulation(self, pdb, stiffness, restraint_set: str,
+                   exclude_residues: Sequence[int], use_gpu: bool) -> _Entry:
+        """Returns a simulation of `pdb`, restrained to its positions."""
+        t0 = time.time()
+        key = (topology_key(pdb.topology), FORCE_FIELD, str(stiffness), restraint_set,
+               tuple(sorted(exclude_residues)), use_gpu)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            entry = self._create(pdb, stiffness, restraint_set, exclude_residues, use_gpu)
+            self._entries[key] = entry
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            if entry.restraints is not None:
+                for index, i in enumerate(entry.restrained_atoms):
+                    entry.restraints.setParticleParameters(index, i, pdb.positions[i])
+                entry.restraints.updateParametersInContext(entry.simulation.context)
+        self.setup_seconds += time.time() - t0
+        return entry
+
+    def discard(self, entry: _Entry):
+        """Drops a simulation whose minimization failed."""
+        for key, cached in list(self._entries.items()):
+            if cached is entry:
+                del self._entries[key]
+
+    def minimize(self, pdb_str: str, max_iterations: int, tolerance, stiffness,
+                 restraint_set: str, exclude_residues: Sequence[int],
+                 use_gpu: bool) -> Dict[str, Any]:
+        """Minimizes as `amber_minimize._openmm_minimize`, reusing the setup."""
+        pdb = openmm_app.PDBFile(io.StringIO(pdb_str))
+        entry = self.simulation(pdb, stiffness, restraint_set, exclude_residues, use_gpu)
+        simulation = entry.simulation
+        try:
+            simulation.context.setPositions(pdb.positions)
+            ret = {}
+            state = simulation.context.getState(getEnergy=True, getPositions=True)
+            ret['einit'] = state.getPotentialEnergy().value_in_unit(ENERGY)
+            ret['posinit'] = state.getPositions(asNumpy=True).value_in_unit(LENGTH)
+            simulation.minimizeEnergy(maxIterations=max_iterations, tolerance=tolerance)
+            state = simulation.context.getState(getEnergy=True, getPositions=True)
+            ret['efinal'] = state.getPotentialEnergy().value_in_unit(ENERGY)
+            ret['pos'] = state.getPositions(asNumpy=True).value_in_unit(LENGTH)
+            ret['min_pdb'] = amber_minimize._get_pdb_string(
+                simulation.topology, state.getPositions())
+        except Exception:
+            self.discard(entry)
+            raise
+        return ret
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'setup_hits': self.hits,
+            'setup_misses': self.misses,
+            'setup_seconds': self.setup_seconds,
+        }
+
+
+_cache: Optional[RelaxSetupCache] = None
+_uncached_minimize = amber_minimize._openmm_minimize
+
+
+def install(max_entries: int = DEFAULT_MAX_ENTRIES) -> RelaxSetupCache:
+    """Makes the relaxations of this process reuse their setup."""
+    global _cache
+    if _cache is None:
+        _cache = RelaxSetupCache(max_entries)
+        amber_minimize._openmm_minimize = _cache.minimize
+        logging.info(f'Caching the OpenMM setup of up to {max_entries} topologies')
+    return _cache
+
+
+def uninstall():
+    """Restores AlphaFold's uncached minimization."""
+    global _cache
+    amber_minimize._openmm_minimize = _uncached_minimize
+    _cache = None
+
+
+def installed() -> Optional[RelaxSetupCache]:
+    return _cache
@@ -0,0 +1,147 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Persistent XLA compilation cache shared by predict processes.
+
+JAX writes compiled executables to `<cache_dir>/xla` and reads them back
+instead of compiling when a later process traces the same computation. The
+executables are keyed by JAX on the computation itself, which is fixed by
+the model config and the shapes of the processed features. This module
+keeps an index from that model key to the entries written by its first
+compilation, so runners can log hits, misses and the compile time saved.
+
+The cache directory may be shared by processes on one host or on an NFS
+mount. Hits refresh the modification time of their entries, and the least
+recently used entries are evicted once the cache grows beyond its size cap.
+Counts are kept in `stats.json`, covering every process sharing the cache.
+"""
+
+import hashlib
+import logging
+import os
+
+from typing import Dict, Mapping, Optional, Set
+
+import numpy as np
+
+from directory_cache import DirectoryCache
+
+
+DEFAULT_MAX_BYTES = 20 * 2**30
+
+_XLA_DIR = 'xla'
+_INDEX_NAME = 'index.json'
+
+
+def compile_key(model_config, processed_features: Mapping[str, np.ndarray]) -> str:
+    """Returns the key of the model function compiled for `processed_features`."""
+    import jax
+
+    hasher = hashlib.sha256()
+    hasher.update(f'jax-{jax.__version__}-{jax.default_backend()}'.encode())
+    hasher.update(model_config.to_json_best_effort(sort_keys=True).encode('utf-8'))
+    for key, value in sorted(processed_features.items()):
+        value = np.asarray(value)
+        hasher.update(f'{key}:{value.dtype.str}:{value.shape}'.encode('utf-8'))
+    return hasher.hexdigest()
+
+
+class XlaCache(DirectoryCache):
+    """Tracks the entries of a size-capped persistent compilation cache."""
+
+    STATS = {'hits': 0, 'misses': 0, 'evictions': 0, 'seconds_saved': 0.0}
+
+    def __init__(self, cache_dir: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        super().__init__(cache_dir, max_bytes)
+        self.xla_dir = os.path.join(cache_dir, _XLA_DIR)
+        self.hits = 0
+        self.misses = 0
+        self.seconds_saved = 0.0
+        os.makedirs(self.xla_dir, exist_ok=True)
+
+    def stats(self) -> Dict[str, float]:
+        """Returns the counts of every process using the cache directory."""
+        return self._read_stats()
+
+    def entries(self) -> Set[str]:
+        """Returns the names of the executables in the cache."""
+        return {name for name in os.listdir(self.xla_dir)
+                if os.path.isfile(os.path.join(self.xla_dir, name))}
+
+    def record(self, key: str, seconds: float, entries_before: Set[str]) -> bool:
+        """Records the first call of a model function and returns whether it hit.
+
+        `entries_before` are the cache entries before the call; a call that
+        compiled leaves JAX's new entries behind. Entries written at the same
+        time by another process sharing the cache are attributed to the key
+        as well, which only makes its later hits refresh more entries.
+        """
+        new_entries = self.entries() - entries_before
+        with self._locked():
+            index = self._read_json(_INDEX_NAME, {})
+            cached = index.get(key)
+            hit = not new_entries and cached is not None and all(
+                os.path.exists(os.path.join(self.xla_dir, name)) for name in cached['entries'])
+            if hit:
+                seconds_saved = max(cached['compile_seconds'] - seconds, 0.0)
+                for name in cached['entries']:
+                    try:
+                        os.utime(os.path.join(self.xla_dir, name))
+                    except OSError:
+                        pass
+                self._add_stats({'hits': 1, 'seconds_saved': seconds_saved})
+            else:
+                index[key] = {'compile_seconds': seconds, 'entries': sorted(new_entries)}
+                self._write_json(_INDEX_NAME, index)
+                self._add_stats({'misses': 1})
+
+        if hit:
+            self.hits += 1
+            self.seconds_saved += seconds_saved
+            logging.info(f'XLA cache hit for {key[:12]}: {seconds:.1f}s, '
+                         f'{seconds_saved:.1f}s saved')
+        else:
+            self.misses += 1
+            logging.info(f'XLA cache miss for {key[:12]}: compiled in {seconds:.1f}s')
+            if not new_entries:
+                logging.warning('JAX wrote no XLA cache entry; the backend may not '
+                                'support the persistent compilation cache')
+            self._evict()
+        return hit
+
+    def _evict(self):
+        evictions = super()._evict(
+            os.path.join(self.xla_dir, name) for name in self.entries())
+        if evictions:
+            logging.info(f'Evicted {evictions} XLA cache entries')
+
+
+def enable_xla_cache(cache_dir: Optional[str],
+                     max_bytes: int = DEFAULT_MAX_BYTES) -> Optional[XlaCache]:
+    """Points JAX's persistent compilation cache at `cache_dir`.
+
+    Returns None, leaving compilation uncached, if `cache_dir` is empty or
+    this JAX release has no persistent compilation cache.
+    """
+    if not cache_dir:
+        return None
+    xla_cache = XlaCache(cache_dir, max_bytes)
+    try:
+        from jax.experimental.compilation_cache import compilation_cache
+        compilation_cache.initialize_cache(xla_cache.xla_dir)
+    except (ImportError, AttributeError, AssertionError) as e:
+        logging.warning(f'Persistent XLA compilation cache unavailable: {e}')
+        return None
+    logging.info(f'Using the persistent XLA compilation cache in {xla_cache.xla_dir}')
+    return xla_cache
@@ -34,16 +34,32 @@ def predict(
     num_ensemble: int,
     random_seed: int,
     raw_prediction: Output[Artifact],
-    unrelaxed_protein: Output[Artifact]
+    unrelaxed_protein: Output[Artifact],
+    full_prediction: bool=False,
+    prediction_float16: bool=False,
+    predictions_dir: str='',
 ):
-    
-    import io
+    """Predicts the structure of a target with one model.
+
+    `raw_prediction` is a slim feature bundle of the arrays used downstream,
+    in float16 if `prediction_float16`, or the pickled `prediction_result`
+    if `full_prediction`. With `predictions_dir`, the raw prediction, its
+    summary sidecar and the unrelaxed protein are also written there as
+    `result_<model_name>_seed<random_seed>` and
+    `unrelaxed_<model_name>_seed<random_seed>.pdb`, for the rank step.
+    """
+
+    import json
     import os
     import logging
     import numpy as np
     import pickle
     import haiku as hk
+    import shutil
+    import struct
+    import sys
     import time
+    import zipfile
 
     from alphafold.model import config
     from alphafold.model import model
@@ -53,19 +69,112 @@ def predict(
 
     def _get_model_haiku_params(model_name: str,
                                 params_dir: str):
-        """Get the Haiku parameters from a model name."""
+        """Get the Haiku parameters from a model name.
 
-        path = os.path.join(params_dir, f'params_{model_name}.npz')
-        with open(path, 'rb') as f:
-            params = np.load(io.BytesIO(f.read()), allow_pickle=False)
+        Parameters converted by `alphafold_runners/model_params.py` are
+        memory mapped, otherwise the official `.npz` is read.
+        """
+        converted_dir = os.path.join(params_dir, f'params_{model_name}')
+        index_path = os.path.join(converted_dir, 'index.json')
+        index = None
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                index = json.load(f)
+        if index and index.get('format') == 'model-params' and index.get('version') == 1:
+            logging.info(f'Memory mapping converted parameters in {converted_dir}')
+            params = {key: np.load(os.path.join(converted_dir, spec['file']),
+                                   mmap_mode='r', allow_pickle=False)
+                      for key, spec in index['params'].items()}
+        else:
+            path = os.path.join(params_dir, f'params_{model_name}.npz')
+            with np.load(path, allow_pickle=False) as npz:
+                params = {key: npz[key] for key in npz.files}
 
         return utils.flat_params_to_haiku(params)
 
-    def _load_features(features_path):
+    def _model_feature_names(model_config):
+        """Returns the raw features read by a monomer model's input pipeline."""
+        data_config = model_config.data.common
+        feature_names = set(data_config.unsupervised_features)
+        if data_config.use_templates:
+            feature_names.update(data_config.template_features)
+        # Converted to `deletion_matrix` by `process_features`
+        feature_names.add('deletion_matrix_int')
+        return feature_names
+
+    def _load_feature_bundle(features_path, feature_names):
+        """Memory maps the arrays of a feature bundle written by aggregation."""
+        features = {}
+        with zipfile.ZipFile(features_path) as zf, open(features_path, 'rb') as f:
+            manifest = json.loads(zf.read('manifest.json'))
+            for key, spec in manifest['features'].items():
+                if feature_names is not None and key not in feature_names:
+                    continue
+                zinfo = zf.getinfo(f'{key}.npy')
+                f.seek(zinfo.header_offset)
+                name_length, extra_length = struct.unpack('<2H', f.read(30)[26:])
+                f.seek(zinfo.header_offset + 30 + name_length + extra_length)
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+                else:
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+                order = 'F' if fortran_order else 'C'
+                if int(np.prod(shape)) == 0:
+                    array = np.empty(shape, dtype=dtype, order=order)
+                else:
+                    array = np.memmap(features_path, dtype=dtype, mode='r',
+                                      offset=f.tell(), shape=shape, order=order)
+                if spec['dtype'] == 'object':
+                    array = array.astype(object)
+                elif 'storage_dtype' in spec:
+                    # Compacted integer features are widened back
+                    array = array.astype(spec['dtype'])
+                features[key] = array
+        return features
+
+    def _load_features(features_path, feature_names=None):
+        """Loads a feature bundle or a legacy features pickle."""
+        if zipfile.is_zipfile(features_path):
+            return _load_feature_bundle(features_path, feature_names)
         with open(features_path, 'rb') as f:
             features = pickle.load(f)
         return features
 
+    def _write_slim_prediction(prediction_result, path, float16):
+        """Writes the arrays used downstream as a feature bundle.
+
+        The same format as `alphafold_runners/prediction_output.py`; members
+        are stored uncompressed so they can be memory mapped.
+        """
+        slim_keys = ['plddt', 'ranking_confidence', 'predicted_aligned_error',
+                     'max_predicted_aligned_error', 'ptm', 'iptm',
+                     'structure_module/final_atom_positions',
+                     'structure_module/final_atom_mask']
+        arrays = {}
+        for key in slim_keys:
+            value = prediction_result
+            for part in key.split('/'):
+                value = value.get(part) if isinstance(value, dict) else None
+            if value is None:
+                continue
+            array = np.asarray(value)
+            if float16 and array.ndim and array.dtype.kind == 'f':
+                array = array.astype(np.float16)
+            arrays[key] = array
+        manifest = {
+            'format': 'feature-bundle',
+            'version': 2,
+            'features': {key: {'dtype': array.dtype.str, 'shape': list(array.shape)}
+                         for key, array in arrays.items()},
+            'metadata': {'content': 'slim-prediction', 'float16': float16},
+        }
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED, allowZip64=True) as zf:
+            for key, array in arrays.items():
+                with zf.open(f'{key}.npy', 'w', force_zip64=True) as f:
+                    np.lib.format.write_array(f, array, allow_pickle=False)
+            zf.writestr('manifest.json', json.dumps(manifest, indent=2))
+
 
     t0 = time.time()
     logging.info('Starting model predict ...')
@@ -78,7 +187,10 @@ def predict(
         model_name=model_name, params_dir=model_params.path)
     model_runner = model.RunModel(model_config, model_params)
 
-    features = _load_features(model_features.path)
+    feature_names = None
+    if not model_runner.multimer_mode:
+        feature_names = _model_feature_names(model_config)
+    features = _load_features(model_features.path, feature_names)
     logging.info(f'Running prediction using model {model_name}')
     processed_feature_dict = model_runner.process_features(
         raw_features=features,
@@ -90,10 +202,22 @@ def predict(
     )
 
     logging.info(f'Writing model {model_name} prediction to {raw_prediction.path}') 
-    with open(raw_prediction.path, 'wb') as f:
-        pickle.dump(prediction_result, f, protocol=4)
-    raw_prediction.metadata['ranking_confidence']=prediction_result['ranking_confidence']
-    raw_prediction.metadata['data_format']='pkl'
+    if full_prediction:
+        with open(raw_prediction.path, 'wb') as f:
+            pickle.dump(prediction_result, f, protocol=4)
+        raw_prediction.metadata['data_format']='pkl'
+    else:
+        _write_slim_prediction(prediction_result, raw_prediction.path, prediction_float16)
+        raw_prediction.metadata['data_format']='npz'
+    # The summary of `alphafold_runners/prediction_output.py`, so predictions
+    # can be ranked from the metadata without reading them
+    raw_prediction.metadata['ranking_confidence']=float(prediction_result['ranking_confidence'])
+    for key in ['ptm', 'iptm', 'max_predicted_aligned_error']:
+        if key in prediction_result:
+            raw_prediction.metadata[key]=float(prediction_result[key])
+    plddt = np.asarray(prediction_result['plddt'], dtype=np.float32)
+    raw_prediction.metadata['mean_plddt']=float(plddt.mean())
+    raw_prediction.metadata['fraction_plddt_above_70']=float((plddt >= 70).mean())
 
     plddt = prediction_result['plddt']
     plddt_b_factors = np.repeat(
@@ -110,6 +234,20 @@ def predict(
         f.write(unrelaxed_pdbs)
     unrelaxed_protein.metadata['data_format']='pdb'
 
+    if predictions_dir:
+        sys.path.append('/scripts/alphafold_runners')
+        from prediction_output import write_prediction_summary
+
+        name = f'{model_name}_seed{random_seed}'
+        shared_prediction_path = os.path.join(
+            predictions_dir, f'result_{name}.{raw_prediction.metadata["data_format"]}')
+        logging.info(f'Copying the prediction to {shared_prediction_path}')
+        os.makedirs(predictions_dir, exist_ok=True)
+        shutil.copyfile(raw_prediction.path, shared_prediction_path)
+        write_prediction_summary(prediction_result, shared_prediction_path)
+        shutil.copyfile(unrelaxed_protein.path,
+                        os.path.join(predictions_dir, f'unrelaxed_{name}.pdb'))
+
     t1 = time.time()
     logging.info(f'Model completed. Elapsed time: {t1-t0}')
 
@@ -0,0 +1,54 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A component ranking the predictions of a pipeline run"""
+
+import os
+
+from kfp.v2 import dsl
+from kfp.v2.dsl import Output, Artifact
+
+import config
+
+
+@dsl.component(
+    base_image=config.ALPHAFOLD_COMPONENTS_IMAGE,
+    output_component_file='component_rank.yaml'
+)
+def rank(
+    predictions_dir: str,
+    ranking: Output[Artifact],
+):
+    """Ranks the predictions in `predictions_dir` by `ranking_confidence`.
+
+    The loop over models has no fan-in, so the predict steps write their
+    predictions to `predictions_dir` as well. The ranking is that of
+    `alphafold_runners/rank_runner.py`.
+    """
+    import logging
+    import sys
+
+    sys.path.append('/scripts/alphafold_runners')
+    from rank_runner import prediction_paths, write_ranking
+    from rank_runner import rank as rank_predictions
+
+
+    prediction_result_paths = prediction_paths(predictions_dir)
+    if not prediction_result_paths:
+        raise RuntimeError(f'No predictions to rank in {predictions_dir}')
+
+    ranking_confidences, ranked_order = rank_predictions(prediction_result_paths)
+    logging.info(f'Writing ranking to {ranking.path}')
+    write_ranking(ranking_confidences, ranked_order, ranking.path)
+    ranking.metadata['data_format']='json'
+    ranking.metadata['order']=ranked_order
@@ -36,13 +36,24 @@ def relax(
     exclude_residues: list=[],
     max_outer_iterations: int=3,
     use_gpu: bool=True,
+    precheck: str='off',
+    short_max_iterations: int=100,
 ):
+    """Relaxes a structure.
+
+    With `precheck` set to `skip` a structure without structural violations
+    is passed through unrelaxed, and with `short` it gets a single
+    minimization of at most `short_max_iterations` steps. The check, and the
+    stats recorded in the artifact metadata, are those of
+    `alphafold_runners/relax_runner.py`.
+    """
     import logging
     import os
+    import sys
     import time
 
-    from alphafold.common import protein
-    from alphafold.relax import relax
+    sys.path.append('/scripts/alphafold_runners')
+    from relax_runner import relax_structure
 
 
     if not os.path.exists(unrelaxed_protein.path):
@@ -55,15 +66,21 @@ def relax(
         unrelaxed_protein_pdb=f.read();
 
     logging.info(f'Starting relaxation process ...') 
-    unrelaxed_structure = protein.from_pdb_string(unrelaxed_protein_pdb)
-    amber_relaxer = relax.AmberRelaxation(
+    relaxed_protein_pdb, stats = relax_structure(
+        unrelaxed_protein_pdb,
+        precheck=precheck,
+        short_max_iterations=short_max_iterations,
         max_iterations=max_iterations,
         tolerance=tolerance,
         stiffness=stiffness,
         exclude_residues=exclude_residues,
         max_outer_iterations=max_outer_iterations,
         use_gpu=use_gpu)
-    relaxed_protein_pdb, _, _ = amber_relaxer.process(prot=unrelaxed_structure)
+    logging.info(f'Relaxation stats: {stats}')
+    # relax_mode, precheck_seconds, precheck_violations and
+    # estimated_seconds_saved among them
+    for key, value in stats.items():
+        relaxed_protein.metadata[key] = value
 
     logging.info(f'Saving relaxed protein to {relaxed_protein.path}')
     with open(relaxed_protein.path, 'w') as f:
@@ -71,6 +88,7 @@ def relax(
     relaxed_protein.metadata['data_format']='pdb'
 
     t1 = time.time()
+    relaxed_protein.metadata['relax_seconds']=t1-t0
     logging.info(f'Model relaxation. Elapsed time: {t1-t0}')
 
 
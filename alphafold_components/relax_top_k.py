@@ -0,0 +1,74 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A component relaxing the top ranked predictions of a pipeline run"""
+
+import os
+
+from kfp.v2 import dsl
+from kfp.v2.dsl import Output, Input, Artifact
+
+import config
+
+
+@dsl.component(
+    base_image=config.ALPHAFOLD_COMPONENTS_IMAGE,
+    output_component_file='component_relax_top_k.yaml'
+)
+def relax_top_k(
+    ranking: Input[Artifact],
+    predictions_dir: str,
+    relaxed_proteins: Output[Artifact],
+    top_k: str='all',
+    use_gpu: bool=True,
+    precheck: str='off',
+):
+    """Relaxes the unrelaxed proteins of the `top_k` predictions of a ranking.
+
+    The unrelaxed proteins are read from `predictions_dir`, where the predict
+    steps write them. `relaxed_proteins` is a directory of relaxed PDBs and
+    the `relax_stats.json` of `alphafold_runners/relax_runner.py`; `all`
+    relaxes every prediction.
+    """
+    import logging
+    import os
+    import sys
+    import time
+
+    sys.path.append('/scripts/alphafold_runners')
+    from rank_runner import load_ranking
+    from relax_runner import parse_relax_top_k, relax_batch, top_k_unrelaxed_paths
+
+
+    t0 = time.time()
+    unrelaxed_protein_paths = top_k_unrelaxed_paths(
+        [os.path.join(predictions_dir, name) for name in sorted(os.listdir(predictions_dir))
+         if name.startswith('unrelaxed_') and name.endswith('.pdb')],
+        load_ranking(ranking.path),
+        parse_relax_top_k(top_k))
+    logging.info(f'Relaxing {len(unrelaxed_protein_paths)} proteins')
+    batch_stats = relax_batch(
+        unrelaxed_protein_paths=unrelaxed_protein_paths,
+        output_dir=relaxed_proteins.path,
+        use_gpu=use_gpu,
+        precheck=precheck)
+    for key in ['num_structures', 'num_failed', 'num_skipped', 'num_short',
+                'estimated_seconds_saved']:
+        relaxed_proteins.metadata[key] = batch_stats[key]
+    relaxed_proteins.metadata['data_format']='pdb'
+    if batch_stats['num_failed']:
+        raise RuntimeError(f'{batch_stats["num_failed"]} relaxations failed')
+
+    t1 = time.time()
+    relaxed_proteins.metadata['relax_seconds']=t1-t0
+    logging.info(f'Top k relaxation. Elapsed time: {t1-t0}')
@@ -0,0 +1,32 @@
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'alphafold_runners'))
+
+from directory_cache import DirectoryCache
+
+
+def test_evicts_least_recently_modified_entries_beyond_cap(tmp_path):
+    cache = DirectoryCache(str(tmp_path), max_bytes=20)
+    paths = []
+    for i, name in enumerate(['old', 'new', 'newest']):
+        paths.append(str(tmp_path / name))
+        with open(paths[-1], 'wb') as f:
+            f.write(b'x' * 10)
+        os.utime(paths[-1], (time.time() + i, time.time() + i))
+
+    assert cache._evict(paths + [str(tmp_path / 'missing')]) == 1
+
+    assert sorted(os.listdir(tmp_path)) == ['.lock', 'new', 'newest', 'stats.json']
+    assert cache._read_stats() == {'hits': 0, 'misses': 0, 'evictions': 1}
+
+
+def test_stats_are_shared_through_the_directory(tmp_path):
+    class TimedCache(DirectoryCache):
+        STATS = {'hits': 0, 'seconds_saved': 0.0}
+
+    TimedCache(str(tmp_path), max_bytes=0)._update_stats(hits=1, seconds_saved=2.5)
+    TimedCache(str(tmp_path), max_bytes=0)._update_stats(hits=1)
+
+    assert TimedCache(str(tmp_path), max_bytes=0)._read_stats() == {'hits': 2, 'seconds_saved': 2.5}
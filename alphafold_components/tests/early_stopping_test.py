@@ -0,0 +1,35 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'alphafold_runners'))
+
+from early_stopping import EarlyStopping, parse_early_stopping
+
+
+def test_stops_at_confidence_threshold():
+    early_stopping = EarlyStopping(threshold=90.0)
+
+    assert not early_stopping.update('model_1', 85.0)
+    assert early_stopping.update('model_2', 91.2)
+    assert 'model_2' in early_stopping.reason
+
+    early_stopping.reset()
+    assert not early_stopping.update('model_1', 70.0)
+
+
+def test_stops_without_improvement():
+    early_stopping = EarlyStopping(patience=2, min_delta=1.0)
+
+    assert not early_stopping.update('model_1', 70.0)
+    assert not early_stopping.update('model_2', 75.0)
+    # Improvements within min_delta do not count
+    assert not early_stopping.update('model_3', 75.5)
+    assert early_stopping.update('model_4', 60.0)
+    assert early_stopping.best_name == 'model_3'
+
+
+def test_parse_early_stopping():
+    assert parse_early_stopping(None, None) is None
+    assert parse_early_stopping('', '0') is None
+    early_stopping = parse_early_stopping('85', '3', '0.5')
+    assert (early_stopping.threshold, early_stopping.patience, early_stopping.min_delta) == (85.0, 3, 0.5)
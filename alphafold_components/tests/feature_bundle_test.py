@@ -0,0 +1,100 @@
+import os
+import pickle
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'alphafold_runners'))
+
+from feature_bundle import is_complete_feature_bundle, is_feature_bundle, load_features, read_manifest, write_feature_bundle
+
+
+def _features():
+    return {
+        'msa': np.arange(200 * 100, dtype=np.int32).reshape(200, 100) % 22,
+        'deletion_matrix_int': np.zeros((200, 100), dtype=np.int32),
+        'seq_length': np.full((100,), 100, dtype=np.int32),
+        'domain_name': np.array([b'query'], dtype=object),
+        'msa_species_identifiers': np.array([b'', b'HUMAN'] * 100, dtype=object),
+        'template_all_atom_positions': np.zeros((0, 100, 37, 3), dtype=np.float32),
+    }
+
+
+def _assert_features_equal(actual, expected):
+    assert sorted(actual) == sorted(expected)
+    for key, value in expected.items():
+        assert actual[key].dtype == value.dtype, key
+        assert actual[key].shape == value.shape, key
+        if value.dtype == object:
+            assert list(actual[key]) == list(value), key
+        else:
+            np.testing.assert_array_equal(actual[key], value)
+
+
+def test_bundle_round_trip(tmp_path):
+    path = str(tmp_path / 'features.npz')
+    features = _features()
+
+    write_feature_bundle(features, path)
+    loaded = load_features(path)
+
+    assert is_feature_bundle(path)
+    assert read_manifest(path)['features']['domain_name']['dtype'] == 'object'
+    _assert_features_equal(loaded, features)
+    assert isinstance(loaded['msa'], np.memmap)
+    assert loaded['msa'].ctypes.data % 64 == 0
+
+
+def test_bundle_loads_selected_features(tmp_path):
+    path = str(tmp_path / 'features.npz')
+    write_feature_bundle(_features(), path)
+
+    loaded = load_features(path, keys=['msa', 'domain_name', 'not_a_feature'])
+
+    assert sorted(loaded) == ['domain_name', 'msa']
+
+
+def test_bundle_opens_with_np_load(tmp_path):
+    path = str(tmp_path / 'features.npz')
+    features = _features()
+    write_feature_bundle(features, path)
+
+    with np.load(path) as npz:
+        np.testing.assert_array_equal(npz['msa'], features['msa'])
+
+
+def test_load_features_reads_legacy_pickle(tmp_path):
+    path = str(tmp_path / 'features.pkl')
+    features = _features()
+    with open(path, 'wb') as f:
+        pickle.dump(features, f, protocol=4)
+
+    assert not is_feature_bundle(path)
+    _assert_features_equal(load_features(path), features)
+
+
+def test_compact_bundle_widens_on_load(tmp_path):
+    path = str(tmp_path / 'features.npz')
+    features = _features()
+    features['deletion_matrix_int'][0, 0] = 300
+
+    write_feature_bundle(features, path, compact=True)
+    manifest = read_manifest(path)
+    loaded = load_features(path)
+
+    assert manifest['features']['msa']['storage_dtype'] == '|u1'
+    assert manifest['features']['deletion_matrix_int']['storage_dtype'] == '<u2'
+    assert 'storage_dtype' not in manifest['features']['domain_name']
+    _assert_features_equal(loaded, features)
+
+
+def test_is_complete_feature_bundle(tmp_path):
+    path = str(tmp_path / 'features.npz')
+    assert not is_complete_feature_bundle(path)
+
+    write_feature_bundle(_features(), path)
+    assert is_complete_feature_bundle(path)
+
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) // 2)
+    assert not is_complete_feature_bundle(path)
@@ -0,0 +1,82 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'alphafold_runners'))
+
+from feature_bundle import load_features, write_feature_bundle
+from feature_cache import FeatureCache, content_key
+
+
+def _write(path, content):
+    path.write_text(content)
+    return str(path)
+
+
+def _inputs(directory, msa_content='>query\nACD\n'):
+    directory.mkdir(exist_ok=True)
+    sequence_path = _write(directory / 'seq.fasta', '>query\nACD\n')
+    msa_paths = {_write(directory / 'uniref.a3m', msa_content): 'a3m',
+                 _write(directory / 'mgnify.sto', '# STOCKHOLM 1.0\n//\n'): 'sto'}
+    template_path = _write(directory / 'templates.pkl', 'templates')
+    return sequence_path, msa_paths, template_path
+
+
+def _bundle(path, size):
+    write_feature_bundle({'msa': np.zeros((size,), dtype=np.uint8)}, str(path))
+    return str(path)
+
+
+def test_content_key_depends_on_content_not_location(tmp_path):
+    key = content_key(*_inputs(tmp_path / 'a'))
+
+    assert key == content_key(*_inputs(tmp_path / 'b'))
+    assert key != content_key(*_inputs(tmp_path / 'c', msa_content='>query\nACE\n'))
+    sequence_path, msa_paths, template_path = _inputs(tmp_path / 'd')
+    reversed_msa_paths = dict(reversed(list(msa_paths.items())))
+    assert key != content_key(sequence_path, reversed_msa_paths, template_path)
+    assert key != content_key(sequence_path, msa_paths, template_path,
+                              options={'max_msa_hits': 10})
+
+
+def test_cache_hit_places_bundle(tmp_path):
+    cache = FeatureCache(str(tmp_path / 'cache'))
+    output_path = str(tmp_path / 'features.npz')
+
+    assert not cache.get('key', output_path)
+    cache.put('key', _bundle(tmp_path / 'bundle.npz', 16))
+    assert cache.get('key', output_path)
+
+    assert load_features(output_path)['msa'].shape == (16,)
+    assert cache.hit_rate == 0.5
+    stats = FeatureCache(str(tmp_path / 'cache')).stats()
+    assert (stats['hits'], stats['misses'], stats['hit_rate']) == (1, 1, 0.5)
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    entry_size = os.path.getsize(_bundle(tmp_path / 'probe.npz', 4096))
+    cache = FeatureCache(str(tmp_path / 'cache'), max_bytes=int(2.5 * entry_size))
+    for key in ['first', 'second']:
+        cache.put(key, _bundle(tmp_path / f'{key}.npz', 4096))
+    # Make 'first' the most recently used entry
+    os.utime(os.path.join(cache.cache_dir, 'second.npz'), (0, 0))
+    assert cache.get('first', str(tmp_path / 'out.npz'))
+
+    cache.put('third', _bundle(tmp_path / 'third.npz', 4096))
+
+    assert cache.get('first', str(tmp_path / 'out.npz'))
+    assert cache.get('third', str(tmp_path / 'out.npz'))
+    assert not cache.get('second', str(tmp_path / 'out.npz'))
+    assert cache.stats()['evictions'] == 1
+
+
+def test_entry_evicted_during_get_is_a_miss(tmp_path, monkeypatch):
+    import feature_cache
+
+    cache = FeatureCache(str(tmp_path / 'cache'))
+    # The entry is checked, then removed by another process before it is placed
+    monkeypatch.setattr(feature_cache, 'is_complete_feature_bundle', lambda path: True)
+
+    assert not cache.get('key', str(tmp_path / 'features.npz'))
+    assert (cache.hits, cache.misses) == (0, 1)
@@ -0,0 +1,63 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'alphafold_runners'))
+
+from length_bucketing import CompileStats, bucket_length, crop_prediction, parse_length_buckets
+
+
+def test_bucket_length():
+    buckets = parse_length_buckets('512,128,256')
+
+    assert buckets == (128, 256, 512)
+    assert bucket_length(100, buckets) == 128
+    assert bucket_length(128, buckets) == 128
+    assert bucket_length(300, buckets) == 512
+    assert bucket_length(600, buckets) == 600
+    assert parse_length_buckets('') == ()
+
+
+def test_crop_prediction_crops_residue_axes_only():
+    num_res, padded_length = 100, 128
+    result = {
+        'distogram': {'logits': np.zeros((128, 128, 64)), 'bin_edges': np.zeros((128,))},
+        'masked_msa': {'logits': np.zeros((128, 128, 23))},
+        'predicted_lddt': {'logits': np.zeros((128, 50))},
+        'structure_module': {
+            'final_atom_positions': np.zeros((128, 37, 3)),
+            'final_atom_mask': np.zeros((128, 37)),
+            'traj': np.zeros((8, 128, 7)),
+        },
+        'representations': {'single': np.zeros((128, 128))},
+    }
+
+    cropped = crop_prediction(result, num_res, padded_length)
+
+    assert cropped['distogram']['logits'].shape == (100, 100, 64)
+    assert cropped['distogram']['bin_edges'].shape == (128,)
+    assert cropped['masked_msa']['logits'].shape == (128, 100, 23)
+    assert cropped['predicted_lddt']['logits'].shape == (100, 50)
+    assert cropped['structure_module']['final_atom_positions'].shape == (100, 37, 3)
+    assert cropped['structure_module']['final_atom_mask'].shape == (100, 37)
+    assert cropped['structure_module']['traj'].shape == (8, 100, 7)
+    assert cropped['representations']['single'].shape == (100, 128)
+
+
+class _FakeRunModel:
+    pass
+
+
+def test_compile_stats_counts_new_shapes():
+    stats = CompileStats()
+    first, second = _FakeRunModel(), _FakeRunModel()
+    features = {'aatype': np.zeros((1, 128))}
+
+    assert stats.record(first, features, 30.0)
+    assert not stats.record(first, features, 2.0)
+    assert stats.record(first, {'aatype': np.zeros((1, 256))}, 40.0)
+    assert stats.record(second, features, 30.0)
+
+    assert stats.summary() == {'num_compiles': 3, 'compile_seconds': 100.0,
+                               'num_cached_calls': 1, 'cached_seconds': 2.0}
@@ -0,0 +1,60 @@
+import json
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'alphafold_runners'))
+
+from model_params import (INDEX_NAME, convert_params, converted_params_dir,
+                          is_converted_params, load_flat_params, params_npz_path)
+
+
+_PARAMS = {
+    'alphafold/alphafold_iteration/evoformer/preprocess_1d//weights':
+        np.arange(24, dtype=np.float32).reshape(2, 12),
+    'alphafold/alphafold_iteration/evoformer/preprocess_1d//bias':
+        np.ones((12,), dtype=np.float32),
+    'alphafold/alphafold_iteration/structure_module//scale':
+        np.zeros((0,), dtype=np.float16),
+}
+
+
+def _write_npz(params_dir):
+    np.savez(params_npz_path(str(params_dir), 'model_1'), **_PARAMS)
+
+
+def _assert_params_equal(actual):
+    assert list(actual) == list(_PARAMS)
+    for key, expected in _PARAMS.items():
+        assert actual[key].dtype == expected.dtype
+        np.testing.assert_array_equal(actual[key], expected)
+
+
+def test_converted_params_are_memory_mapped(tmp_path):
+    _write_npz(tmp_path)
+    output_dir = converted_params_dir(str(tmp_path), 'model_1')
+
+    num_bytes = convert_params(params_npz_path(str(tmp_path), 'model_1'), output_dir)
+
+    assert num_bytes == sum(array.nbytes for array in _PARAMS.values())
+    assert is_converted_params(output_dir)
+    assert sorted(os.listdir(tmp_path)) == ['params_model_1', 'params_model_1.npz']
+    params = load_flat_params(str(tmp_path), 'model_1')
+    _assert_params_equal(params)
+    weights = params['alphafold/alphafold_iteration/evoformer/preprocess_1d//weights']
+    assert isinstance(weights, np.memmap)
+    _assert_params_equal(load_flat_params(str(tmp_path), 'model_1', mmap=False))
+
+
+def test_load_falls_back_to_npz(tmp_path):
+    _write_npz(tmp_path)
+    _assert_params_equal(load_flat_params(str(tmp_path), 'model_1'))
+
+    # An index of another version is ignored
+    output_dir = converted_params_dir(str(tmp_path), 'model_1')
+    os.makedirs(output_dir)
+    with open(os.path.join(output_dir, INDEX_NAME), 'w') as f:
+        json.dump({'format': 'model-params', 'version': 0, 'params': {}}, f)
+    assert not is_converted_params(output_dir)
+    _assert_params_equal(load_flat_params(str(tmp_path), 'model_1'))
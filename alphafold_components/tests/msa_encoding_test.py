@@ -0,0 +1,53 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'alphafold_runners'))
+
+from alphafold.common import residue_constants
+
+from msa_encoding import encode_sequence, encode_sequences
+
+
+def _legacy_encode(sequences):
+    return np.array(
+        [[residue_constants.HHBLITS_AA_TO_ID[res] for res in sequence]
+         for sequence in sequences], dtype=np.int32)
+
+
+def test_encode_sequences_matches_dict_lookup():
+    alphabet = ''.join(residue_constants.HHBLITS_AA_TO_ID.keys())
+    sequences = [alphabet, alphabet[::-1], '-' * len(alphabet)]
+
+    int_msa = encode_sequences(sequences)
+
+    assert int_msa.dtype == np.int32
+    np.testing.assert_array_equal(int_msa, _legacy_encode(sequences))
+
+
+def test_encode_sequences_int8():
+    int_msa = encode_sequences(['ACD-', 'XBZU'], dtype=np.int8)
+
+    assert int_msa.dtype == np.int8
+    np.testing.assert_array_equal(int_msa, _legacy_encode(['ACD-', 'XBZU']))
+
+
+def test_encode_sequence_into_preallocated_row():
+    out = np.zeros((2, 3), dtype=np.int32)
+
+    encode_sequence('ACD', out=out[1])
+
+    np.testing.assert_array_equal(out[1], [0, 1, 2])
+    np.testing.assert_array_equal(out[0], [0, 0, 0])
+
+
+def test_encode_sequences_rejects_unknown_residues():
+    with pytest.raises(ValueError):
+        encode_sequences(['AC*'])
+
+
+def test_encode_sequences_rejects_ragged_rows():
+    with pytest.raises(ValueError):
+        encode_sequences(['ACD', 'AC'], num_res=3)
@@ -0,0 +1,71 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'alphafold_runners'))
+
+from alphafold.data import msa_identifiers
+
+from msa_identifier_codes import IdentifierInterner, decode_identifiers, description_prefix, with_identifier_arrays
+
+
+_DESCRIPTIONS = [
+    'query',
+    'tr|A0A146SKV9|A0A146SKV9_FUNHE/12-200 Uncharacterized protein',
+    'tr|A0A146SKV9|A0A146SKV9_FUNHE/210-380',
+    'sp|P0C2L1|A3FB1_HUMAN',
+    'UniRef100_A0A0B4J2F0 description',
+    '',
+]
+
+
+def _expected(name):
+    values = []
+    for description in _DESCRIPTIONS:
+        identifiers = msa_identifiers.get_identifiers(description)
+        if name == 'msa_species_identifiers':
+            values.append(identifiers.species_id.encode('utf-8'))
+        else:
+            values.append(identifiers.uniprot_accession_id.encode('utf-8'))
+    return values
+
+
+def test_description_prefix():
+    assert description_prefix('tr|A|A_HUMAN/1-10 protein') == 'tr|A|A_HUMAN'
+    assert description_prefix('  ') == ''
+
+
+def test_interned_identifiers_decode_to_parsed_identifiers():
+    interner = IdentifierInterner()
+    for description in _DESCRIPTIONS:
+        interner.add(description)
+
+    features = interner.features()
+
+    assert interner.num_parsed == 5
+    assert features['msa_species_identifiers_codes'].dtype == np.int32
+    for name in ['msa_species_identifiers', 'msa_uniprot_accession_identifiers']:
+        assert list(decode_identifiers(features, name)) == _expected(name)
+    restored = with_identifier_arrays(features)
+    assert list(restored['msa_species_identifiers']) == _expected('msa_species_identifiers')
+
+
+def test_extend_matches_adding_descriptions():
+    serial = IdentifierInterner()
+    for description in _DESCRIPTIONS[1:] + _DESCRIPTIONS[:2]:
+        serial.add(description)
+
+    first, second = IdentifierInterner(), IdentifierInterner()
+    for description in _DESCRIPTIONS:
+        first.add(description)
+    for description in _DESCRIPTIONS[:2]:
+        second.add(description)
+    merged = IdentifierInterner()
+    merged.extend(first.features(), np.arange(1, len(_DESCRIPTIONS)))
+    merged.extend(second.features(), np.arange(2))
+
+    expected, actual = serial.features(), merged.features()
+    assert sorted(actual) == sorted(expected)
+    for key, value in expected.items():
+        assert list(actual[key]) == list(value), key
@@ -0,0 +1,80 @@
+import io
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'alphafold_runners'))
+
+from alphafold.data import parsers
+
+from msa_reader import MsaDepth, iter_a3m_records, iter_msa_records, iter_stockholm_records
+
+
+_STOCKHOLM = """# STOCKHOLM 1.0
+
+#=GS query DE query
+query   MA-CD-E
+hit1    MAKC-QE
+hit2    -A-CDRE
+
+query   FG
+hit1    F-
+hit2    GG
+//
+"""
+
+_A3M = """>query
+MACDEFG
+>hit1 description one
+MAkkCD-EFG
+>hit2
+-ACDEfgFG
+"""
+
+
+def _assert_records_match(records, msa):
+    assert [r.sequence for r in records] == list(msa.sequences)
+    assert [r.description for r in records] == list(msa.descriptions)
+    for record, deletion_row in zip(records, msa.deletion_matrix):
+        assert record.deletion_row.dtype == np.int32
+        np.testing.assert_array_equal(record.deletion_row, deletion_row)
+
+
+def test_stockholm_records_match_parser():
+    records = list(iter_stockholm_records(io.StringIO(_STOCKHOLM)))
+
+    _assert_records_match(records, parsers.parse_stockholm(_STOCKHOLM))
+
+
+def test_a3m_records_match_parser():
+    records = list(iter_a3m_records(io.StringIO(_A3M)))
+
+    _assert_records_match(records, parsers.parse_a3m(_A3M))
+
+
+def test_iter_msa_records_from_file(tmp_path):
+    msa_path = tmp_path / 'msa.a3m'
+    msa_path.write_text(_A3M)
+
+    records = list(iter_msa_records(str(msa_path), 'a3m'))
+
+    _assert_records_match(records, parsers.parse_a3m(_A3M))
+
+
+def test_iter_msa_records_rejects_unknown_format(tmp_path):
+    with pytest.raises(RuntimeError):
+        list(iter_msa_records(str(tmp_path / 'msa.fasta'), 'fasta'))
+
+
+@pytest.mark.parametrize('max_hits', [1, 2, 5])
+def test_depth_cap_matches_truncated_parser_output(max_hits):
+    for reader, parse, text in [(iter_stockholm_records, parsers.parse_stockholm, _STOCKHOLM),
+                                (iter_a3m_records, parsers.parse_a3m, _A3M)]:
+        depth = MsaDepth()
+        records = list(reader(io.StringIO(text), max_hits=max_hits, depth=depth))
+
+        _assert_records_match(records, parse(text).truncate(max_seqs=max_hits + 1))
+        assert depth.num_rows == 3
+        assert depth.num_dropped == max(3 - (max_hits + 1), 0)
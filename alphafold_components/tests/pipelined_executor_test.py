@@ -0,0 +1,80 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'alphafold_runners'))
+
+from pipelined_executor import PipelinedExecutor
+
+
+def test_stages_overlap_and_keep_order():
+    events = []
+    lock = threading.Lock()
+
+    def record(event):
+        with lock:
+            events.append(event)
+
+    def prepare(item):
+        time.sleep(0.05)
+        record(('prepared', item))
+        return item * 10
+
+    def compute(item, prepared):
+        record(('compute', item))
+        time.sleep(0.05)
+        yield prepared
+        yield prepared + 1
+
+    written = []
+    executor = PipelinedExecutor(prepare, compute, lambda item, output: written.append(output))
+
+    assert executor.run(range(3)) == []
+    assert written == [0, 1, 10, 11, 20, 21]
+    # The next item is prepared while the current one is computed
+    assert events.index(('prepared', 1)) < events.index(('compute', 1))
+    assert events.index(('prepared', 1)) < events.index(('prepared', 2)) < events.index(('compute', 2))
+    summary = executor.summary()
+    assert summary['num_items'] == 3 and summary['num_outputs'] == 6
+    assert 0 < summary['compute_busy_fraction'] < 1
+
+
+def test_failures_do_not_stop_other_items():
+    def prepare(item):
+        if item == 'bad_prepare':
+            raise ValueError(item)
+        return item
+
+    def compute(item, prepared):
+        if item == 'bad_compute':
+            raise ValueError(item)
+        yield prepared
+
+    def write(item, output):
+        if item == 'bad_write':
+            raise ValueError(item)
+        written.append(output)
+
+    written = []
+    executor = PipelinedExecutor(prepare, compute, write)
+    failures = executor.run(['bad_prepare', 'a', 'bad_compute', 'bad_write', 'b'])
+
+    assert written == ['a', 'b']
+    assert [(item, stage) for item, stage, _ in failures] == [
+        ('bad_prepare', 'prepare'), ('bad_compute', 'compute'), ('bad_write', 'write')]
+
+
+def test_host_seconds_are_not_busy():
+    def compute(item, prepared):
+        t0 = time.perf_counter()
+        time.sleep(0.05)
+        executor.add_host_seconds(time.perf_counter() - t0)
+        yield prepared
+
+    executor = PipelinedExecutor(lambda item: item, compute, lambda item, output: None)
+    executor.run(range(2))
+
+    summary = executor.summary()
+    assert summary['compute_host_seconds'] >= 0.1
+    assert summary['compute_busy_fraction'] < 0.5
@@ -0,0 +1,283 @@
+import json
+import os
+import sys
+import types
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'alphafold_runners'))
+
+import predict_runner
+from early_stopping import EarlyStopping
+from predict_runner import ParamsCache, parse_random_seeds, predict_models
+
+
+def _fake_params(model_name, params_dir):
+    return {'alphafold': {'weights': np.zeros((256,), dtype=np.float32)}}
+
+
+class _DataConfig(types.SimpleNamespace):
+    def to_json_best_effort(self, **kwargs):
+        return json.dumps({'use_templates': self.common.use_templates}, **kwargs)
+
+
+def _fake_model_config(model_name, num_ensemble):
+    common = types.SimpleNamespace(
+        unsupervised_features=['aatype', 'msa'],
+        use_templates=model_name in ['model_1', 'model_2'],
+        template_features=['template_aatype'])
+    eval_config = types.SimpleNamespace(
+        num_ensemble=1, masked_msa_replace_fraction=0.15, max_msa_clusters=512)
+    return types.SimpleNamespace(
+        data=_DataConfig(common=common, eval=eval_config),
+        model=types.SimpleNamespace(global_config=types.SimpleNamespace(multimer_mode=False)))
+
+
+class _FakeRunModel:
+    processed = []
+
+    def __init__(self, config, params=None):
+        self.config = config
+        self.params = params
+
+    def process_features(self, raw_features, random_seed):
+        _FakeRunModel.processed.append((self.config.data.common.use_templates, random_seed))
+        return dict(raw_features)
+
+
+def test_params_cache_drops_least_recently_used(monkeypatch):
+    monkeypatch.setattr(predict_runner, '_get_model_haiku_params', _fake_params)
+    cache = ParamsCache('/params', max_bytes=2 * 1024)
+
+    for model_name in ['model_1', 'model_2', 'model_1', 'model_3', 'model_2']:
+        cache.get(model_name)
+
+    # model_2 was dropped for model_3 and loaded again
+    assert cache.num_loads == 4
+    assert list(cache._params) == ['model_3', 'model_2']
+    assert cache.nbytes == 2 * 1024
+
+
+def test_predict_models_shares_features(monkeypatch):
+    loaded_feature_names = []
+
+    def fake_load_features(features_path, feature_names=None):
+        loaded_feature_names.append(sorted(feature_names))
+        return {name: np.zeros(1) for name in feature_names}
+
+    monkeypatch.setattr(predict_runner, '_get_model_haiku_params', _fake_params)
+    monkeypatch.setattr(predict_runner, '_model_config', _fake_model_config)
+    monkeypatch.setattr(predict_runner, '_load_features', fake_load_features)
+    monkeypatch.setattr(predict_runner.model, 'RunModel', _FakeRunModel)
+    monkeypatch.setattr(predict_runner, '_predict_processed',
+                        lambda runner, features, seed, *args: ({'seed': seed}, 'ATOM\n'))
+    _FakeRunModel.processed = []
+    model_names = ['model_1', 'model_2', 'model_3', 'model_4', 'model_5']
+
+    results = list(predict_models(
+        model_features_path='/features.npz',
+        model_names=model_names,
+        num_ensemble=1,
+        random_seeds={model_name: [0] for model_name in model_names},
+        params_cache=ParamsCache('/params')))
+
+    assert [name for name, _, _, _ in results] == model_names
+    assert loaded_feature_names == [
+        ['aatype', 'deletion_matrix_int', 'msa', 'template_aatype']]
+    assert _FakeRunModel.processed == [(True, 0), (False, 0)]
+
+
+def test_predict_targets_reuses_runners_across_targets(monkeypatch):
+    runners = []
+
+    class CountingRunModel(_FakeRunModel):
+        def __init__(self, config, params=None):
+            super().__init__(config, params)
+            if params is not None:
+                runners.append(self)
+
+    def fake_load_features(features_path, feature_names=None):
+        if features_path.endswith('bad.npz'):
+            raise ValueError('Corrupt features')
+        return {name: np.zeros(1) for name in feature_names}
+
+    monkeypatch.setattr(predict_runner, '_get_model_haiku_params', _fake_params)
+    monkeypatch.setattr(predict_runner, '_model_config', _fake_model_config)
+    monkeypatch.setattr(predict_runner, '_load_features', fake_load_features)
+    monkeypatch.setattr(predict_runner.model, 'RunModel', CountingRunModel)
+    monkeypatch.setattr(predict_runner, '_run_model',
+                        lambda runner, features, seed, *args: ({'seed': seed}, features))
+    monkeypatch.setattr(predict_runner, '_unrelaxed_pdb',
+                        lambda runner, features, result: 'ATOM\n')
+    written = []
+    model_names = ['model_1', 'model_3']
+
+    executor = predict_runner.predict_targets(
+        model_features_paths=['/T1050.npz', '/bad.npz', '/T1031.npz'],
+        model_names=model_names,
+        num_ensemble=1,
+        random_seeds={'model_1': [1], 'model_3': [3]},
+        params_cache=ParamsCache('/params'),
+        write_result=lambda path, name, seed, result, pdb: written.append(
+            (predict_runner.target_name(path), name, result['seed'])))
+
+    assert written == [('T1050', 'model_1', 1), ('T1050', 'model_3', 3),
+                       ('T1031', 'model_1', 1), ('T1031', 'model_3', 3)]
+    assert len(runners) == 2
+    assert [(path, stage) for path, stage, _ in executor.failures] == [('/bad.npz', 'prepare')]
+    assert executor.summary()['num_outputs'] == 4
+
+
+def test_parse_random_seeds():
+    model_names = ['model_1', 'model_2']
+
+    assert parse_random_seeds(None, model_names) == {'model_1': [1], 'model_2': [2]}
+    assert parse_random_seeds('', model_names, default_seed=7) == {'model_1': [7], 'model_2': [7]}
+    assert parse_random_seeds('0,1,2', model_names) == {'model_1': [0, 1, 2], 'model_2': [0, 1, 2]}
+    assert parse_random_seeds('model_2=5,6', model_names) == {'model_1': [1], 'model_2': [5, 6]}
+
+
+def test_predict_models_builds_each_model_once_for_all_seeds(monkeypatch):
+    runners = []
+
+    class CountingRunModel(_FakeRunModel):
+        def __init__(self, config, params):
+            super().__init__(config, params)
+            runners.append(self)
+
+    def fake_model_config(model_name, num_ensemble):
+        model_config = _fake_model_config(model_name, num_ensemble)
+        # Without MSA masking, processing only samples deep MSAs
+        model_config.data.eval.masked_msa_replace_fraction = 0.0
+        return model_config
+
+    monkeypatch.setattr(predict_runner, '_get_model_haiku_params', _fake_params)
+    monkeypatch.setattr(predict_runner, '_model_config', fake_model_config)
+    monkeypatch.setattr(predict_runner, '_load_features',
+                        lambda path, names=None: {'num_alignments': np.full((10,), 100)})
+    monkeypatch.setattr(predict_runner.model, 'RunModel', CountingRunModel)
+    monkeypatch.setattr(predict_runner, '_predict_processed',
+                        lambda runner, features, seed, *args: ({'seed': seed}, 'ATOM\n'))
+    _FakeRunModel.processed = []
+    params_cache = ParamsCache('/params')
+
+    results = list(predict_models(
+        model_features_path='/features.npz',
+        model_names=['model_1', 'model_3'],
+        num_ensemble=1,
+        random_seeds={'model_1': [0, 1, 2], 'model_3': [4]},
+        params_cache=params_cache))
+
+    assert [(name, seed) for name, seed, _, _ in results] == [
+        ('model_1', 0), ('model_1', 1), ('model_1', 2), ('model_3', 4)]
+    assert [result['seed'] for _, _, result, _ in results] == [0, 1, 2, 4]
+    assert len(runners) == 2 and params_cache.num_loads == 2
+    # 100 alignments fit in the 512 MSA clusters, so no processing samples
+    assert _FakeRunModel.processed == [(True, 0), (False, 4)]
+
+
+def test_predict_models_stops_early(monkeypatch):
+    monkeypatch.setattr(predict_runner, '_get_model_haiku_params', _fake_params)
+    monkeypatch.setattr(predict_runner, '_model_config', _fake_model_config)
+    monkeypatch.setattr(predict_runner, '_load_features',
+                        lambda path, names=None: {name: np.zeros(1) for name in names})
+    monkeypatch.setattr(predict_runner.model, 'RunModel', _FakeRunModel)
+    confidences = {('model_1', 0): 70.0, ('model_1', 1): 92.0}
+    monkeypatch.setattr(
+        predict_runner, '_predict_processed',
+        lambda runner, features, seed, *args: (
+            {'ranking_confidence': confidences.get(
+                ('model_1' if runner.config.data.common.use_templates else 'model_3', seed), 50.0)},
+            'ATOM\n'))
+    _FakeRunModel.processed = []
+
+    results = list(predict_models(
+        model_features_path='/features.npz',
+        model_names=['model_1', 'model_3'],
+        num_ensemble=1,
+        random_seeds={'model_1': [0, 1, 2], 'model_3': [0, 1]},
+        params_cache=ParamsCache('/params'),
+        early_stopping=EarlyStopping(threshold=90.0)))
+
+    assert [(name, seed) for name, seed, _, _ in results] == [('model_1', 0), ('model_1', 1)]
+
+
+def test_predict_targets_processes_features_lazily(monkeypatch):
+    monkeypatch.setattr(predict_runner, '_get_model_haiku_params', _fake_params)
+    monkeypatch.setattr(predict_runner, '_model_config', _fake_model_config)
+    monkeypatch.setattr(predict_runner, '_load_features',
+                        lambda path, names=None: {name: np.zeros(1) for name in names})
+    monkeypatch.setattr(predict_runner.model, 'RunModel', _FakeRunModel)
+    monkeypatch.setattr(predict_runner, '_run_model',
+                        lambda runner, features, seed, *args: (
+                            {'ranking_confidence': 95.0 if seed == 1 else 50.0}, features))
+    monkeypatch.setattr(predict_runner, '_unrelaxed_pdb',
+                        lambda runner, features, result: 'ATOM\n')
+    _FakeRunModel.processed = []
+    written = []
+
+    predict_runner.predict_targets(
+        model_features_paths=['/T1050.npz'],
+        model_names=['model_1', 'model_3'],
+        num_ensemble=1,
+        random_seeds={'model_1': [0, 1, 2], 'model_3': [0]},
+        params_cache=ParamsCache('/params'),
+        write_result=lambda path, name, seed, result, pdb: written.append((name, seed)),
+        early_stopping=EarlyStopping(threshold=90.0))
+
+    assert written == [('model_1', 0), ('model_1', 1)]
+    # MSA masking samples with the seed; skipped predictions are not processed
+    assert _FakeRunModel.processed == [(True, 0), (True, 1)]
+
+
+def test_predict_pads_to_length_buckets(monkeypatch):
+    monkeypatch.setattr(predict_runner, 'load_model_runner',
+                        lambda **kwargs: types.SimpleNamespace(config=None, multimer_mode=False))
+    monkeypatch.setattr(predict_runner, '_load_features',
+                        lambda path, names=None: {'seq_length': np.array([200])})
+    monkeypatch.setattr(predict_runner, '_model_feature_names', lambda config: None)
+    monkeypatch.setattr(predict_runner, 'process_features_padded',
+                        lambda config, features, seed, padded_length: {'padded': padded_length})
+    monkeypatch.setattr(predict_runner, '_predict_processed',
+                        lambda runner, features, seed, compile_stats: (features, 'ATOM\n'))
+
+    prediction_result, _ = predict_runner.predict(
+        model_features_path='/features.npz', model_params_path='/params',
+        model_name='model_1', num_ensemble=1, random_seed=0, length_buckets=[256, 512])
+
+    assert prediction_result == {'padded': 256}
+
+
+def test_predict_targets_drops_runners_with_their_params(monkeypatch):
+    runners = []
+
+    class CountingRunModel(_FakeRunModel):
+        def __init__(self, config, params=None):
+            super().__init__(config, params)
+            if params is not None:
+                runners.append(self)
+
+    monkeypatch.setattr(predict_runner, '_get_model_haiku_params', _fake_params)
+    monkeypatch.setattr(predict_runner, '_model_config', _fake_model_config)
+    monkeypatch.setattr(predict_runner, '_load_features',
+                        lambda path, names=None: {name: np.zeros(1) for name in names})
+    monkeypatch.setattr(predict_runner.model, 'RunModel', CountingRunModel)
+    monkeypatch.setattr(predict_runner, '_run_model',
+                        lambda runner, features, seed, *args: ({'seed': seed}, features))
+    monkeypatch.setattr(predict_runner, '_unrelaxed_pdb',
+                        lambda runner, features, result: 'ATOM\n')
+
+    # The cache holds the params of one model at a time
+    executor = predict_runner.predict_targets(
+        model_features_paths=['/T1050.npz', '/T1031.npz'],
+        model_names=['model_1', 'model_3'],
+        num_ensemble=1,
+        random_seeds={'model_1': [1], 'model_3': [3]},
+        params_cache=ParamsCache('/params', max_bytes=1024),
+        write_result=lambda path, name, seed, result, pdb: None)
+
+    assert [runner.config.data.common.use_templates for runner in runners] == [
+        True, False, True, False]
+    summary = executor.summary()
+    assert summary['num_outputs'] == 4
+    assert 0 <= summary['compute_host_seconds'] <= summary['compute_seconds']
@@ -0,0 +1,74 @@
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'alphafold_runners'))
+
+import predict_server
+from predict_server import PredictServer
+
+
+class _FakeRunner:
+    def __init__(self):
+        self.calls = []
+
+
+def _fake_predict_with_model(model_runner, model_features_path, random_seed, **kwargs):
+    if model_features_path.endswith('bad.npz'):
+        raise ValueError('Corrupt features')
+    model_runner.calls.append((os.path.basename(model_features_path), random_seed))
+    return {'ranking_confidence': 90.0}, 'ATOM\n'
+
+
+def _server(monkeypatch):
+    monkeypatch.setattr(predict_server, 'predict_with_model', _fake_predict_with_model)
+    return PredictServer({'model_1': _FakeRunner(), 'model_2': _FakeRunner()})
+
+
+def test_serve_directory_predicts_each_file_with_every_model(tmp_path, monkeypatch):
+    server = _server(monkeypatch)
+    monkeypatch.setattr(predict_server, 'SETTLE_SECONDS', 0)
+    watch_dir, output_dir = tmp_path / 'inbox', tmp_path / 'output'
+    watch_dir.mkdir()
+    for name in ['T1050.npz', 'bad.npz', 'T1031.pkl.tmp']:
+        (watch_dir / name).write_bytes(b'features')
+
+    server.serve_directory(str(watch_dir), str(output_dir), poll_interval=0, max_requests=2)
+
+    assert server.model_runners['model_1'].calls == [('T1050.npz', 1)]
+    assert server.model_runners['model_2'].calls == [('T1050.npz', 2)]
+    assert sorted(os.listdir(output_dir / 'T1050')) == [
+        'result_model_1.npz', 'result_model_1.npz.summary.json',
+        'result_model_2.npz', 'result_model_2.npz.summary.json',
+        'unrelaxed_model_1.pdb', 'unrelaxed_model_2.pdb']
+    assert json.loads((watch_dir / 'done' / 'T1050.json').read_text())['status'] == 'ok'
+    assert 'Corrupt features' in json.loads((watch_dir / 'failed' / 'bad.json').read_text())['error']
+    assert sorted(os.listdir(watch_dir)) == ['T1031.pkl.tmp', 'done', 'failed', 'running']
+    assert (server.num_served, server.num_failed) == (1, 1)
+
+
+def test_serve_socket_answers_requests_in_order(tmp_path, monkeypatch):
+    server = _server(monkeypatch)
+    socket_path = str(tmp_path / 'predict.sock')
+    thread = threading.Thread(
+        target=server.serve_socket, args=(socket_path, str(tmp_path / 'output')))
+    thread.start()
+    while not os.path.exists(socket_path):
+        time.sleep(0.01)
+
+    requests = [{'features_path': '/features/T1050.npz', 'random_seed': 7},
+                {'features_path': '/features/bad.npz'},
+                {'shutdown': True}]
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall(b''.join(json.dumps(r).encode() + b'\n' for r in requests))
+        responses = [json.loads(line) for line in client.makefile('rb')]
+    thread.join(timeout=10)
+
+    assert [r['status'] for r in responses] == ['ok', 'failed', 'shutdown']
+    assert responses[0]['output_dir'] == str(tmp_path / 'output' / 'T1050')
+    assert server.model_runners['model_1'].calls == [('T1050.npz', 7)]
+    assert not thread.is_alive()
@@ -0,0 +1,129 @@
+import os
+import pickle
+import shutil
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'alphafold_runners'))
+
+from feature_bundle import load_feature_bundle
+from prediction_output import (is_prediction_name, load_prediction, load_prediction_summary,
+                               summary_path, write_full_prediction, write_prediction_summary,
+                               write_slim_prediction)
+import rank_runner
+from rank_runner import rank
+
+
+def _prediction_result(ranking_confidence):
+    num_res = 300
+    return {
+        'plddt': np.linspace(0, 100, num_res),
+        'ranking_confidence': np.float64(ranking_confidence),
+        'distogram': {'logits': np.zeros((num_res, num_res, 64), dtype=np.float32)},
+        'structure_module': {
+            'final_atom_positions': np.ones((num_res, 37, 3), dtype=np.float32),
+            'final_atom_mask': np.ones((num_res, 37), dtype=np.float32),
+            'sidechains': {'frames': np.zeros((8, num_res, 8, 12))},
+        },
+    }
+
+
+def test_slim_prediction_keeps_selected_arrays(tmp_path):
+    path = str(tmp_path / 'result_model_1.npz')
+    prediction_result = _prediction_result(81.5)
+
+    write_slim_prediction(prediction_result, path, float16=True)
+    prediction = load_prediction(path)
+
+    assert sorted(prediction) == ['plddt', 'ranking_confidence', 'structure_module']
+    assert sorted(prediction['structure_module']) == ['final_atom_mask', 'final_atom_positions']
+    assert prediction['plddt'].dtype == np.float16
+    np.testing.assert_allclose(prediction['plddt'], prediction_result['plddt'], atol=0.05)
+    assert prediction['ranking_confidence'] == 81.5
+    assert isinstance(load_feature_bundle(path)['structure_module/final_atom_positions'], np.memmap)
+    assert load_prediction(path, keys=['ranking_confidence']) == {'ranking_confidence': 81.5}
+
+
+def test_rank_reads_slim_and_full_predictions(tmp_path):
+    slim_path = str(tmp_path / 'result_model_1.npz')
+    full_path = str(tmp_path / 'result_model_2.pkl')
+    write_slim_prediction(_prediction_result(70.0), slim_path)
+    write_full_prediction(_prediction_result(90.0), full_path)
+
+    with open(full_path, 'rb') as f:
+        assert 'distogram' in pickle.load(f)
+    ranking_confidences, ranked_order = rank([slim_path, full_path])
+
+    assert ranking_confidences == {'result_model_1.npz': 70.0, 'result_model_2.pkl': 90.0}
+    assert ranked_order == ['result_model_2.pkl', 'result_model_1.npz']
+
+
+def test_rank_reads_summaries_instead_of_predictions(tmp_path, monkeypatch):
+    full_path = str(tmp_path / 'result_model_1.pkl')
+    unsummarized_path = str(tmp_path / 'result_model_2.pkl')
+    write_full_prediction(_prediction_result(90.0), full_path)
+    summary = write_prediction_summary(_prediction_result(90.0), full_path)
+    write_full_prediction(_prediction_result(75.0), unsummarized_path)
+    loaded = []
+    monkeypatch.setattr(rank_runner, 'load_prediction',
+                        lambda path, keys: loaded.append(path) or load_prediction(path, keys))
+
+    ranking_confidences, ranked_order = rank([full_path, unsummarized_path])
+
+    assert summary['num_residues'] == 300 and summary['max_plddt'] == 100.0
+    assert summary['fraction_plddt_above_90'] < summary['fraction_plddt_above_70']
+    assert ranking_confidences == {'result_model_1.pkl': 90.0, 'result_model_2.pkl': 75.0}
+    assert ranked_order == ['result_model_1.pkl', 'result_model_2.pkl']
+    assert loaded == [unsummarized_path]
+
+
+def test_summary_of_a_rewritten_prediction_is_stale(tmp_path):
+    path = str(tmp_path / 'result_model_1.npz')
+    write_slim_prediction(_prediction_result(70.0), path)
+    write_prediction_summary(_prediction_result(70.0), path)
+    assert load_prediction_summary(path)['ranking_confidence'] == 70.0
+
+    write_full_prediction(_prediction_result(60.0), path)
+
+    assert load_prediction_summary(path) is None
+    assert os.path.exists(summary_path(path))
+
+
+def test_summary_of_a_same_size_rewrite_is_stale(tmp_path):
+    path = str(tmp_path / 'result_model_1.npz')
+    write_slim_prediction(_prediction_result(70.0), path)
+    write_prediction_summary(_prediction_result(70.0), path)
+    size = os.path.getsize(path)
+
+    write_slim_prediction(_prediction_result(60.0), path)
+
+    assert os.path.getsize(path) == size
+    assert load_prediction_summary(path) is None
+
+
+def test_summary_of_a_copied_prediction_applies(tmp_path):
+    path = str(tmp_path / 'result_model_1.npz')
+    write_slim_prediction(_prediction_result(70.0), path)
+    write_prediction_summary(_prediction_result(70.0), path)
+    copy_dir = tmp_path / 'copy'
+    copy_dir.mkdir()
+    copy_path = str(copy_dir / 'result_model_1.npz')
+    # A plain copy, as GCS makes, does not keep the modification time
+    shutil.copyfile(path, copy_path)
+    shutil.copyfile(summary_path(path), summary_path(copy_path))
+    os.utime(copy_path, ns=(0, 0))
+
+    assert load_prediction_summary(copy_path)['ranking_confidence'] == 70.0
+
+
+def test_is_prediction_name():
+    assert is_prediction_name('result_model_1.npz')
+    assert is_prediction_name('result_model_2_pred_0.pkl')
+    # The names of predictions written before result_<model>
+    assert is_prediction_name('model_1_raw_prediction_.pkl')
+    assert not is_prediction_name('result_model_1.npz.summary.json')
+    assert not is_prediction_name('result_model_1.npz.tmp')
+    assert not is_prediction_name('result_model_1.pkl.1234.tmp')
+    assert not is_prediction_name('unrelaxed_model_1.pdb')
+    assert not is_prediction_name('ranking.json')
@@ -0,0 +1,109 @@
+import os
+import sys
+import types
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'alphafold_runners'))
+
+from alphafold.common import residue_constants
+from relax_precheck import is_violation_free, structure_violations
+
+
+# The ideal N-CA, CA-C and C-N bond lengths, and the N-CA-C, CA-C-N and
+# C-N-CA angles they enclose
+_BOND_LENGTHS = [1.459, 1.525, 1.329]
+_ANGLES = [111.0, 116.568, 121.352]
+
+
+def _backbone(num_res, chain_index=None, offset=(0.0, 0.0, 0.0)):
+    """An extended backbone with ideal bonds and angles in the xy plane."""
+    positions = np.zeros((num_res, residue_constants.atom_type_num, 3))
+    mask = np.zeros((num_res, residue_constants.atom_type_num))
+    point, direction = np.zeros(3), 0.0
+    for k in range(3 * num_res):
+        atom = residue_constants.atom_order[['N', 'CA', 'C'][k % 3]]
+        positions[k // 3, atom], mask[k // 3, atom] = point, 1
+        if k:
+            # Turning left and right in turn keeps every dihedral at 180 degrees
+            direction += (-1)**k * np.radians(180.0 - _ANGLES[(k - 1) % 3])
+        point = point + _BOND_LENGTHS[k % 3] * np.array([np.cos(direction), np.sin(direction), 0.0])
+    return types.SimpleNamespace(
+        atom_positions=positions + np.asarray(offset),
+        atom_mask=mask,
+        aatype=np.zeros(num_res, dtype=np.int32),
+        residue_index=np.arange(num_res) + 1,
+        chain_index=np.zeros(num_res, dtype=np.int32) if chain_index is None else chain_index)
+
+
+def _concatenate(*prots):
+    return types.SimpleNamespace(**{
+        key: np.concatenate([getattr(prot, key) for prot in prots])
+        for key in ['atom_positions', 'atom_mask', 'aatype', 'residue_index', 'chain_index']})
+
+
+def test_ideal_backbone_is_violation_free():
+    violations = structure_violations(_backbone(20))
+
+    assert violations['num_clashes'] == 0
+    assert violations['num_bond_violations'] == 0
+    assert violations['max_bond_deviation'] < 0.01
+    assert is_violation_free(violations)
+
+
+def test_stretched_peptide_bond_is_a_violation():
+    prot = _backbone(10)
+    prot.atom_positions[5:, :, 0] += 1.0
+
+    violations = structure_violations(prot)
+
+    assert violations['num_bond_violations'] == 1
+    assert violations['num_violating_residues'] == 2
+    assert not is_violation_free(violations)
+
+
+def test_bent_peptide_bond_is_a_violation():
+    prot = _backbone(10)
+    # Rotates the chain after the C of residue 4 about it, keeping the C-N bond
+    c = prot.atom_positions[4, residue_constants.atom_order['C']].copy()
+    angle = np.radians(40.0)
+    rotation = np.array([[np.cos(angle), -np.sin(angle), 0.0],
+                         [np.sin(angle), np.cos(angle), 0.0],
+                         [0.0, 0.0, 1.0]])
+    prot.atom_positions[5:] = (prot.atom_positions[5:] - c) @ rotation.T + c
+
+    violations = structure_violations(prot)
+
+    assert violations['num_bond_violations'] == 0
+    assert violations['num_angle_violations'] == 1
+    assert violations['num_violating_residues'] == 2
+    assert not is_violation_free(violations)
+
+
+def test_stretched_residue_is_a_violation():
+    prot = _backbone(10)
+    n, ca = residue_constants.atom_order['N'], residue_constants.atom_order['CA']
+    n_ca = prot.atom_positions[9, ca] - prot.atom_positions[9, n]
+    prot.atom_positions[9, ca] += 0.5 * n_ca / np.linalg.norm(n_ca)
+
+    violations = structure_violations(prot)
+
+    assert violations['num_bond_violations'] == 0
+    assert violations['num_angle_violations'] == 0
+    assert violations['num_within_residue_violations'] > 0
+    assert violations['num_violating_residues'] == 1
+    assert not is_violation_free(violations)
+
+
+def test_overlapping_chains_clash():
+    chain_b = _backbone(10, chain_index=np.ones(10, dtype=np.int32), offset=(0.0, 1.0, 0.0))
+    # A second chain, and a chain break, are not peptide bonded
+    violations = structure_violations(_concatenate(_backbone(10), chain_b))
+
+    assert violations['num_bond_violations'] == 0
+    assert violations['num_clashes'] > 0
+    assert violations['max_clash_overlap'] > 0
+    assert violations['num_violating_residues'] == 20
+
+    far_chain_b = _backbone(10, chain_index=np.ones(10, dtype=np.int32), offset=(0.0, 10.0, 0.0))
+    assert is_violation_free(structure_violations(_concatenate(_backbone(10), far_chain_b)))
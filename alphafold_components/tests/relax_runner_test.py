@@ -0,0 +1,137 @@
+import json
+import os
+import sys
+import types
+
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'alphafold_runners'))
+
+import relax_runner
+from rank_runner import load_ranking, write_ranking
+from relax_runner import (parse_relax_top_k, relax_batch, relax_protein, relax_structure,
+                          relaxed_name, select_top_k, top_k_unrelaxed_paths)
+
+
+class _FakeRelaxation:
+    built = 0
+
+    def __init__(self, **options):
+        _FakeRelaxation.built += 1
+
+    def process(self, prot):
+        if prot.aatype.size == 0:
+            raise ValueError('No residues')
+        violations = np.zeros(prot.aatype.shape)
+        violations[0] = 1
+        return 'RELAXED\n', {'initial_energy': 10.0, 'final_energy': -5.0, 'attempts': 1}, violations
+
+
+def _fake_from_pdb_string(pdb):
+    return types.SimpleNamespace(aatype=np.zeros(len(pdb.splitlines()), dtype=np.int32))
+
+
+def test_relaxed_name():
+    assert relaxed_name('/in/unrelaxed_model_1.pdb') == 'relaxed_model_1.pdb'
+    assert relaxed_name('/in/T1050.pdb') == 'relaxed_T1050.pdb'
+
+
+def test_relax_batch_writes_structures_and_stats(tmp_path, monkeypatch):
+    monkeypatch.setattr(relax_runner.relax, 'AmberRelaxation', _FakeRelaxation)
+    monkeypatch.setattr(relax_runner.protein, 'from_pdb_string', _fake_from_pdb_string)
+    monkeypatch.setattr(relax_runner, '_relaxers', {})
+    _FakeRelaxation.built = 0
+    paths = []
+    for name, pdb in [('unrelaxed_model_1.pdb', 'ATOM\nATOM\n'),
+                      ('unrelaxed_model_2.pdb', 'ATOM\n'),
+                      ('unrelaxed_empty.pdb', '')]:
+        paths.append(str(tmp_path / name))
+        with open(paths[-1], 'w') as f:
+            f.write(pdb)
+    output_dir = str(tmp_path / 'relaxed')
+
+    batch_stats = relax_batch(paths, output_dir, num_workers=1)
+
+    assert sorted(os.listdir(output_dir)) == [
+        'relax_stats.json', 'relaxed_model_1.pdb', 'relaxed_model_2.pdb']
+    # One relaxer serves every structure of the worker
+    assert _FakeRelaxation.built == 1
+    assert batch_stats['num_structures'] == 3 and batch_stats['num_failed'] == 1
+    with open(os.path.join(output_dir, 'relax_stats.json')) as f:
+        structures = json.load(f)['structures']
+    assert [stats['status'] for stats in structures] == ['ok', 'ok', 'failed']
+    assert structures[0]['num_residues'] == 2
+    assert structures[0]['num_violating_residues'] == 1
+    assert structures[0]['final_energy'] == -5.0
+    assert 'No residues' in structures[2]['error']
+
+
+def test_relax_protein_returns_stats(tmp_path, monkeypatch):
+    monkeypatch.setattr(relax_runner.relax, 'AmberRelaxation', _FakeRelaxation)
+    monkeypatch.setattr(relax_runner.protein, 'from_pdb_string', _fake_from_pdb_string)
+    monkeypatch.setattr(relax_runner, '_relaxers', {})
+    path = tmp_path / 'unrelaxed_model_1.pdb'
+    path.write_text('ATOM\nATOM\n')
+
+    relaxed_protein_pdb, stats = relax_protein(str(path))
+
+    assert relaxed_protein_pdb == 'RELAXED\n'
+    assert stats['relax_mode'] == 'full' and stats['num_residues'] == 2
+
+
+def test_select_top_k():
+    ranking_confidences = {'model_1': 71.5, 'model_2': 88.0, 'model_3': 80.2}
+
+    assert select_top_k(ranking_confidences, 2) == ['model_2', 'model_3']
+    assert select_top_k(ranking_confidences, None) == ['model_2', 'model_3', 'model_1']
+    assert select_top_k(ranking_confidences, 0) == []
+    assert parse_relax_top_k('all') is None and parse_relax_top_k('') is None
+    assert parse_relax_top_k('1') == 1
+
+
+def test_top_k_unrelaxed_paths_follow_the_ranking(tmp_path):
+    ranking_path = str(tmp_path / 'ranking.json')
+    write_ranking({'result_model_1.npz': 71.5, 'result_model_2_seed3.pkl': 88.0},
+                  ['result_model_2_seed3.pkl', 'result_model_1.npz'], ranking_path)
+    paths = ['/in/unrelaxed_model_1.pdb', '/in/unrelaxed_model_2_seed3.pdb']
+
+    assert top_k_unrelaxed_paths(paths, load_ranking(ranking_path), 1) == [
+        '/in/unrelaxed_model_2_seed3.pdb']
+    assert top_k_unrelaxed_paths(paths, load_ranking(ranking_path), None) == paths[::-1]
+    with pytest.raises(RuntimeError):
+        top_k_unrelaxed_paths(paths[:1], load_ranking(ranking_path), 1)
+
+
+def test_relax_structure_skips_violation_free_structures(monkeypatch):
+    monkeypatch.setattr(relax_runner.relax, 'AmberRelaxation', _FakeRelaxation)
+    monkeypatch.setattr(relax_runner.protein, 'from_pdb_string', _fake_from_pdb_string)
+    monkeypatch.setattr(relax_runner, '_relaxers', {})
+    monkeypatch.setattr(relax_runner, '_full_relaxations', {'seconds': 0.0, 'num_residues': 0})
+    violation_free = {'num_clashes': 0, 'num_bond_violations': 0, 'num_violating_residues': 0}
+    monkeypatch.setattr(relax_runner, 'structure_violations', lambda prot: violation_free)
+
+    _, full_stats = relax_structure('ATOM\nATOM\n')
+    pdb, skipped_stats = relax_structure('ATOM\nATOM\n', precheck='skip')
+    _, short_stats = relax_structure('ATOM\nATOM\n', precheck='short')
+
+    assert full_stats['relax_mode'] == 'full' and 'precheck_violations' not in full_stats
+    assert pdb == 'ATOM\nATOM\n'
+    assert skipped_stats['relax_mode'] == 'skipped'
+    assert skipped_stats['precheck_violations'] == violation_free
+    assert 'estimated_seconds_saved' in skipped_stats
+    assert short_stats['relax_mode'] == 'short' and short_stats['final_energy'] == -5.0
+    # The short pass has its own relaxer, with one bounded minimization
+    assert sorted(json.loads(key)['max_outer_iterations'] for key in relax_runner._relaxers) == [1, 3]
+
+
+def test_skip_without_full_relaxations_estimates_the_default_rate(monkeypatch):
+    monkeypatch.setattr(relax_runner.protein, 'from_pdb_string', _fake_from_pdb_string)
+    monkeypatch.setattr(relax_runner, '_full_relaxations', {'seconds': 0.0, 'num_residues': 0})
+    monkeypatch.setattr(relax_runner, 'structure_violations',
+                        lambda prot: {'num_violating_residues': 0})
+
+    _, stats = relax_structure('ATOM\n' * 100, precheck='skip', use_gpu=True)
+
+    assert stats['relax_mode'] == 'skipped'
+    assert 0 < stats['estimated_seconds_saved'] <= 100 * relax_runner.DEFAULT_SECONDS_PER_RESIDUE[True]
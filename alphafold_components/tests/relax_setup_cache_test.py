@@ -0,0 +1,146 @@
+import os
+import sys
+import types
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'alphafold_runners'))
+
+import relax_setup_cache
+from relax_setup_cache import RelaxSetupCache, topology_key
+
+
+class _Topology:
+    """Residues of (name, atom names) in one chain, with bonds between atoms."""
+
+    def __init__(self, residues, bonds=()):
+        chain = types.SimpleNamespace()
+        self._residues = []
+        self._atoms = []
+        for index, (name, atom_names) in enumerate(residues):
+            residue = types.SimpleNamespace(name=name, index=index, chain=chain)
+            residue_atoms = []
+            for atom_name in atom_names:
+                atom = types.SimpleNamespace(name=atom_name, residue=residue,
+                                             index=len(self._atoms))
+                residue_atoms.append(atom)
+                self._atoms.append(atom)
+            residue.atoms = lambda residue_atoms=residue_atoms: iter(residue_atoms)
+            self._residues.append(residue)
+        chain.residues = lambda: iter(self._residues)
+        self._chains = [chain]
+        self._bonds = [(self._atoms[i], self._atoms[j]) for i, j in bonds]
+
+    def chains(self):
+        return iter(self._chains)
+
+    def atoms(self):
+        return iter(self._atoms)
+
+    def bonds(self):
+        return iter(self._bonds)
+
+
+class _Force:
+    def __init__(self, expression):
+        self.particles = []
+        self.context_updates = 0
+
+    def addGlobalParameter(self, name, value):
+        pass
+
+    def addPerParticleParameter(self, name):
+        pass
+
+    def addParticle(self, i, position):
+        self.particles.append((i, position))
+
+    def setParticleParameters(self, index, i, position):
+        self.particles[index] = (i, position)
+
+    def updateParametersInContext(self, context):
+        self.context_updates += 1
+
+
+class _System:
+    def __init__(self, topology):
+        self.num_particles = len(list(topology.atoms()))
+        self.forces = []
+
+    def getNumParticles(self):
+        return self.num_particles
+
+    def addForce(self, force):
+        self.forces.append(force)
+
+
+class _ForceField:
+    created = []
+
+    def __init__(self, name):
+        _ForceField.created.append(name)
+        self.systems = 0
+
+    def createSystem(self, topology, constraints=None):
+        self.systems += 1
+        return _System(topology)
+
+
+def _fake_openmm(monkeypatch):
+    _ForceField.created = []
+    monkeypatch.setattr(relax_setup_cache, 'openmm', types.SimpleNamespace(
+        CustomExternalForce=_Force,
+        LangevinIntegrator=lambda *args: None,
+        Platform=types.SimpleNamespace(getPlatformByName=lambda name: name)))
+    monkeypatch.setattr(relax_setup_cache, 'openmm_app', types.SimpleNamespace(
+        ForceField=_ForceField,
+        HBonds='HBonds',
+        Simulation=lambda topology, system, integrator, platform: types.SimpleNamespace(
+            system=system, context=object())))
+
+
+_ALA_GLY = [('ALA', ['N', 'CA', 'C', 'O', 'CB', 'H']), ('GLY', ['N', 'CA', 'C', 'O', 'H'])]
+
+
+def test_topology_key_covers_atoms_and_bonds():
+    key = topology_key(_Topology(_ALA_GLY, bonds=[(2, 6)]))
+
+    assert key == topology_key(_Topology(_ALA_GLY, bonds=[(2, 6)]))
+    # E.g. another histidine protonation, or a disulfide bond
+    assert key != topology_key(_Topology([_ALA_GLY[0], ('GLY', ['N', 'CA', 'C', 'O'])],
+                                         bonds=[(2, 6)]))
+    assert key != topology_key(_Topology(_ALA_GLY, bonds=[(2, 6), (0, 1)]))
+
+
+def test_simulations_are_reused_with_new_restraint_positions(monkeypatch):
+    _fake_openmm(monkeypatch)
+    cache = RelaxSetupCache(max_entries=1)
+    model_1 = types.SimpleNamespace(topology=_Topology(_ALA_GLY), positions=list(range(11)))
+    model_2 = types.SimpleNamespace(topology=_Topology(_ALA_GLY), positions=list(range(100, 111)))
+    other = types.SimpleNamespace(topology=_Topology(_ALA_GLY[:1]), positions=list(range(6)))
+
+    first = cache.simulation(model_1, 10.0, 'non_hydrogen', [], False)
+    second = cache.simulation(model_2, 10.0, 'non_hydrogen', [], False)
+    third = cache.simulation(other, 10.0, 'non_hydrogen', [], False)
+    fourth = cache.simulation(model_2, 10.0, 'non_hydrogen', [], False)
+
+    assert second is first and third is not first and fourth is not first
+    assert (cache.hits, cache.misses) == (1, 3)
+    assert _ForceField.created == ['amber99sb.xml']
+    # Hydrogens are not restrained, and the restraints follow model_2
+    assert first.restrained_atoms == [0, 1, 2, 3, 4, 6, 7, 8, 9]
+    assert first.restraints.particles[0] == (0, 100)
+    assert first.restraints.context_updates == 1
+
+
+def test_options_are_part_of_the_key(monkeypatch):
+    _fake_openmm(monkeypatch)
+    cache = RelaxSetupCache()
+    prot = types.SimpleNamespace(topology=_Topology(_ALA_GLY), positions=list(range(11)))
+
+    entry = cache.simulation(prot, 10.0, 'non_hydrogen', [], False)
+
+    assert cache.simulation(prot, 10.0, 'non_hydrogen', [1], False) is not entry
+    assert cache.simulation(prot, 10.0, 'c_alpha', [], False) is not entry
+    assert cache.simulation(prot, 10.0, 'non_hydrogen', [], True) is not entry
+    assert cache.simulation(prot, 10.0, 'non_hydrogen', [], False) is entry
+    cache.discard(entry)
+    assert cache.simulation(prot, 10.0, 'non_hydrogen', [], False) is not entry
@@ -0,0 +1,43 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'alphafold_runners'))
+
+from xla_cache import XlaCache
+
+
+def _compile(xla_cache, name, size=10):
+    with open(os.path.join(xla_cache.xla_dir, name), 'wb') as f:
+        f.write(b'\0' * size)
+
+
+def test_record_hits_and_misses(tmp_path):
+    first_process = XlaCache(str(tmp_path))
+    entries = first_process.entries()
+    _compile(first_process, 'executable_1')
+    assert not first_process.record('key_1', 60.0, entries)
+
+    second_process = XlaCache(str(tmp_path))
+    assert second_process.record('key_1', 5.0, second_process.entries())
+    assert second_process.seconds_saved == 55.0
+
+    entries = second_process.entries()
+    _compile(second_process, 'executable_2')
+    assert not second_process.record('key_2', 40.0, entries)
+
+    assert second_process.stats() == {
+        'hits': 1, 'misses': 2, 'evictions': 0, 'seconds_saved': 55.0}
+
+
+def test_evicts_least_recently_used_entries(tmp_path):
+    xla_cache = XlaCache(str(tmp_path), max_bytes=25)
+    for i in range(3):
+        entries = xla_cache.entries()
+        _compile(xla_cache, f'executable_{i}')
+        os.utime(os.path.join(xla_cache.xla_dir, f'executable_{i}'), (i, i))
+        xla_cache.record(f'key_{i}', 60.0, entries)
+
+    assert xla_cache.entries() == {'executable_1', 'executable_2'}
+    assert xla_cache.stats()['evictions'] == 1
+    # The evicted executable is compiled again
+    assert not xla_cache.record('key_0', 60.0, xla_cache.entries())
@@ -22,6 +22,9 @@ REFERENCE_DATASETS_GCS_LOCATION = 'gs://alphafold_protein_structure'
 REFERENCE_DATASETS_URI = '10.71.1.10,/datasets_v1,/mnt/nfs/alphafold,projects/895222332033/global/networks/default'
 MODEL_PARAMS_GCS_LOCATION='gs://alphafold_protein_structure/upload/model_params'
 MODEL_PARAMS_URI='gs://alphafold_protein_structure'
+# Cloud Storage FUSE path under which the predict steps of a run also write
+# their predictions, for the rank step after the loop over models
+PREDICTIONS_PATH = '/gcs/alphafold_protein_structure/predictions'
 
 UNIREF90_PATH = 'uniref90/uniref90.fasta'
 MGNIFY_PATH = 'mgnify/mgy_clusters_2018_12.fa'
@@ -54,6 +54,9 @@ readonly PREDICT_ACCELERATOR_COUNT=1
 
 readonly JACKHMMER_CPU=8
 readonly HHBLITS_CPU=12
+readonly AGGREGATE_MAX_WORKERS=4
+# Hits kept per MSA besides the query during aggregation, 0 keeps all
+readonly AGGREGATE_MAX_MSA_HITS=0
 
 readonly IMAGE=gcr.io/aburdenko-project/alphafold
 readonly JACKHMMER_COMMAND='python /scripts/alphafold_runners/jackhmmer_runner.py'
@@ -62,6 +65,7 @@ readonly HHSEARCH_COMMAND='python /scripts/alphafold_runners/hhsearch_runner.py'
 readonly AGGREGATE_COMMAND='python /scripts/alphafold_runners/aggregate_features_runner.py'
 readonly PREDICT_COMMAND='python /scripts/alphafold_runners/predict_relax_runner.py'
 readonly RANK_COMMAND='python /scripts/alphafold_runners/rank_runner.py'
+readonly RELAX_COMMAND='python /scripts/alphafold_runners/relax_runner.py'
 
 readonly UNIREF90_PATH='uniref90/uniref90.fasta'
 readonly MGNIFY_PATH='mgnify/mgy_clusters_2018_12.fa'
@@ -80,6 +84,9 @@ readonly BFD_MAXSEQ=1_000_000
 readonly PDB_MAXSEQ=1_000_000
 
 readonly RELAX_USE_GPU=1
+# Relaxes only the K predictions with the highest ranking confidence once
+# they are ranked; all relaxes every prediction in its predict job
+readonly RELAX_TOP_K=all
 
 #readonly MODELS=( model_1 model_2 model_3 model_4 model_5 )
 readonly MODELS=( model_1 model_2 )
@@ -228,7 +235,7 @@ job_ids+=( $pdb_job_id )
 echo "Starting feature aggregation on: $(date)" 
 task=aggregate
 logging_path="${output_path}/logging/${task}"
-output_features_path="${output_path}/features/aggregated_features.pkl"
+output_features_path="${output_path}/features/aggregated_features.npz"
 msas_path="${output_path}/msas"
 aggregate_job_id=$(dsub \
 --name "$task" \
@@ -244,6 +251,8 @@ aggregate_job_id=$(dsub \
 --input SEQUENCE_PATH="$SEQUENCE" \
 --input TEMPLATE_FEATURES_PATH="$pdb_output_features_path" \
 --output OUTPUT_FEATURES_PATH="$output_features_path" \
+--env MAX_WORKERS="$AGGREGATE_MAX_WORKERS" \
+--env MAX_MSA_HITS="$AGGREGATE_MAX_MSA_HITS" \
 --after "${job_ids[@]}" \
 --wait )
 
@@ -259,9 +268,19 @@ for model_name in "${MODELS[@]}"
 do
     task="${model_name}_predict_relax"
     logging_path="${output_path}/logging/${task}"
-    raw_prediction_path="${output_path}/predictions/${model_name}_raw_prediction_.pkl"
-    unrelaxed_protein_path="${output_path}/proteins/${model_name}/unrelaxed_protein.pb"
-    relaxed_protein_path="${output_path}/proteins/${model_name}/relaxed_protein.pdb"
+    # A slim prediction bundle; add --env FULL_PREDICTION=1 and a .pkl name
+    # to pickle the full prediction result instead. The runner writes its
+    # summary sidecar next to it, which the rank step reads
+    raw_prediction_path="${output_path}/predictions/result_${model_name}.npz"
+    unrelaxed_protein_path="${output_path}/proteins/unrelaxed_${model_name}.pdb"
+    relaxed_protein_path="${output_path}/proteins/relaxed_${model_name}.pdb"
+    if [[ "$RELAX_TOP_K" == all ]]
+    then
+        relax_args=( --output RELAXED_PROTEIN_PATH="$relaxed_protein_path" \
+                     --env RELAX_USE_GPU="$RELAX_USE_GPU" )
+    else
+        relax_args=( --env RELAX_USE_GPU=0 )
+    fi
     echo "Starting prediction for model ${model_name}" 
 
     predict_job_id=$(dsub \
@@ -282,26 +301,58 @@ do
     --env RANDOM_SEED=0 \
     --env NUM_ENSEMBLE=1 \
     --output RAW_PREDICTION_PATH="$raw_prediction_path" \
+    --output RAW_PREDICTION_SUMMARY_PATH="${raw_prediction_path}.summary.json" \
     --output UNRELAXED_PROTEIN_PATH="$unrelaxed_protein_path" \
-    --output RELAXED_PROTEIN_PATH="$relaxed_protein_path" \
-    --env RELAX_USE_GPU="$RELAX_USE_GPU" )
+    "${relax_args[@]}" )
     job_ids+=( "$predict_job_id" )
 done
 
-# The only goal of this step is to watch for failues
-# Dstat --wait always returns 0 so we don't know if the prediction
-# job failed. That is a small hack
-echo "Waiting for prediction jobs to complete" 
-task=wait
+# Ranks the predictions by the summary sidecars written next to them.
+# It also watches for failures: dstat --wait always returns 0 so we
+# wouldn't know if a prediction job failed
+echo "Ranking predictions on $(date)"
+task=rank
 logging_path="${output_path}/logging/${task}"
+ranking_path="${output_path}/ranking/ranking.json"
 dsub \
 --name "$task" \
---command 'echo Done!' \
+--command "$RANK_COMMAND" \
 --provider "$DSUB_PROVIDER" \
 --project "$PROJECT" \
 --regions "$REGION" \
 --logging "$logging_path" \
---after "${job_ids[@]}" 
+--image "$IMAGE" \
+--machine-type "$RANK_MACHINE_TYPE" \
+--boot-disk-size "$BOOT_DISK_SIZE" \
+--input-recursive PREDICTION_RESULTS_PATH="${output_path}/predictions" \
+--output RANKING_RESULTS_PATH="$ranking_path" \
+--after "${job_ids[@]}" \
+--wait
+
+if [[ "$RELAX_TOP_K" != all ]]
+then
+    echo "Relaxing the top ${RELAX_TOP_K} predictions on $(date)"
+    task=relax
+    logging_path="${output_path}/logging/${task}"
+    dsub \
+    --name "$task" \
+    --command "$RELAX_COMMAND" \
+    --provider "$DSUB_PROVIDER" \
+    --project "$PROJECT" \
+    --regions "$REGION" \
+    --logging "$logging_path" \
+    --image "$IMAGE" \
+    --machine-type "$PREDICT_MACHINE_TYPE" \
+    --boot-disk-size "$BOOT_DISK_SIZE" \
+    --accelerator-type "$PREDICT_ACCELERATOR_TYPE" \
+    --accelerator-count "$PREDICT_ACCELERATOR_COUNT" \
+    --input-recursive UNRELAXED_PROTEINS_DIR="${output_path}/proteins" \
+    --input RANKING_RESULTS_PATH="$ranking_path" \
+    --output-recursive RELAXED_PROTEINS_DIR="${output_path}/proteins" \
+    --env RELAX_TOP_K="$RELAX_TOP_K" \
+    --env RELAX_USE_GPU="$RELAX_USE_GPU" \
+    --wait
+fi
 
 prediction_end_time=$(date +%s)
 echo "Prediction elapsed time $(( $prediction_end_time - $prediction_start_time ))"
@@ -0,0 +1,400 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks the Python hot paths of feature aggregation.
+
+Synthetic Stockholm and A3M MSAs and HHR template hits of controlled depth
+are generated from the FASTA files in `sequences/`. For every target and
+depth the benchmark times MSA reading, MSA and sequence featurization,
+Stockholm to A3M conversion, HHR parsing and feature serialization, and
+reports throughput and peak RSS of every stage.
+
+Results can be stored as a JSON baseline. Later runs against the baseline
+report the stages that got slower or used more memory than the tolerances
+and exit with a non-zero status.
+
+python performance_tests/featurization_benchmark.py --depths=1000,10000 \
+    --baseline_path=featurization_baseline.json --update_baseline
+"""
+
+import gc
+import json
+import os
+import pickle
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+from typing import Optional
+
+import numpy as np
+
+from absl import app
+from absl import flags
+
+_REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(_REPO_ROOT, 'alphafold_components', 'alphafold_runners'))
+
+from alphafold.data import parsers
+
+from aggregate_features_runner import _make_msa_features, _make_sequence_features, _read_msa
+from feature_bundle import write_feature_bundle
+
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('sequences_dir', os.path.join(_REPO_ROOT, 'sequences'), 'Directory with FASTA targets')
+flags.DEFINE_list('targets', ['T1031', 'T1044', 'T1050'], 'Targets to benchmark')
+flags.DEFINE_list('depths', ['1000', '10000'], 'Numbers of rows of the synthetic MSAs')
+flags.DEFINE_integer('num_template_hits', 20, 'Number of hits in the synthetic HHR files')
+flags.DEFINE_integer('repeats', 3, 'Runs of every stage; the fastest is reported')
+flags.DEFINE_integer('seed', 0, 'Random seed used to generate the synthetic inputs')
+flags.DEFINE_string('work_dir', None, 'Directory for the synthetic inputs, a temporary one by default')
+flags.DEFINE_string('results_path', None, 'Path to write the results JSON to')
+flags.DEFINE_string('baseline_path', None, 'Baseline results JSON to compare against')
+flags.DEFINE_bool('update_baseline', False, 'Write the results to the baseline path instead of comparing')
+flags.DEFINE_float('time_tolerance', 0.25, 'Allowed relative slowdown against the baseline')
+flags.DEFINE_float('min_time_delta', 0.005, 'Slowdowns below this many seconds are timing noise')
+flags.DEFINE_float('rss_tolerance', 0.25, 'Allowed relative peak RSS increase against the baseline')
+
+_RESULTS_VERSION = 1
+
+_AMINO_ACIDS = np.frombuffer(b'ACDEFGHIKLMNPQRSTVWY', dtype=np.uint8)
+_SPECIES = ['HUMAN', 'MOUSE', 'YEAST', 'ECOLI', 'ARATH', 'DANRE', 'DROME', 'BOVIN']
+
+# Every row may insert up to this many residues at each insertion site
+_INSERTION_WIDTH = 3
+_INSERTION_SITES = 16
+
+
+def _read_query(sequence_path: str):
+    with open(sequence_path) as f:
+        sequences, descriptions = parsers.parse_fasta(f.read())
+    return sequences[0], descriptions[0]
+
+
+def _synthetic_alignment(query: str, num_rows: int, rng):
+    """Returns the match columns and insertions of rows derived from the query.
+
+    Match columns are substituted or deleted at random. Insertions are
+    lowercase residues after a fixed set of query positions, padded with
+    gaps to `_INSERTION_WIDTH`.
+    """
+    num_res = len(query)
+    matches = np.tile(np.frombuffer(query.encode('ascii'), dtype=np.uint8), (num_rows, 1))
+    substituted = rng.random(matches.shape) < 0.3
+    matches[substituted] = rng.choice(_AMINO_ACIDS, size=int(substituted.sum()))
+    deleted = rng.random(matches.shape) < 0.1
+    matches[deleted] = ord('-')
+    matches[0] = np.frombuffer(query.encode('ascii'), dtype=np.uint8)
+
+    sites = np.sort(rng.choice(num_res, size=min(_INSERTION_SITES, num_res), replace=False))
+    insertions = rng.choice(_AMINO_ACIDS, size=(num_rows, len(sites), _INSERTION_WIDTH))
+    insertions += ord('a') - ord('A')
+    lengths = rng.integers(0, _INSERTION_WIDTH + 1, size=(num_rows, len(sites)))
+    lengths[0] = 0
+    padding = np.arange(_INSERTION_WIDTH) >= lengths[..., None]
+    insertions[padding] = ord('-')
+    return matches, sites, insertions
+
+
+def _row_name(index: int, num_res: int):
+    species = _SPECIES[index % len(_SPECIES)]
+    accession = f'A0A{index:07d}'
+    return f'tr|{accession}|{accession}_{species}/1-{num_res}'
+
+
+def _write_stockholm(path: str, target: str, matches, sites, insertions):
+    """Writes the alignment in jackhmmer's single block Stockholm format."""
+    num_rows, num_res = matches.shape
+    names = [target] + [_row_name(i, num_res) for i in range(1, num_rows)]
+    name_width = max(len(name) for name in names) + 1
+    # Insertion columns follow the query position they are attached to
+    split_points = sites + 1
+    with open(path, 'w') as f:
+        f.write('# STOCKHOLM 1.0\n\n')
+        for i, name in enumerate(names[1:], start=1):
+            f.write(f'#=GS {name} DE Uncharacterized protein {i}\n')
+        f.write('\n')
+        for i, name in enumerate(names):
+            blocks = np.split(matches[i], split_points)
+            row = [blocks[0].tobytes()]
+            for site_insertions, block in zip(insertions[i], blocks[1:]):
+                row.append(site_insertions.tobytes())
+                row.append(block.tobytes())
+            f.write(f'{name:<{name_width}}{b"".join(row).decode("ascii")}\n')
+        f.write('//\n')
+
+
+def _write_a3m(path: str, target: str, matches, sites, insertions):
+    """Writes the alignment as A3M, with lowercase insertions and no padding."""
+    num_rows, num_res = matches.shape
+    split_points = sites + 1
+    with open(path, 'w') as f:
+        for i in range(num_rows):
+            name = target if i == 0 else f'{_row_name(i, num_res)} Uncharacterized protein {i}'
+            blocks = np.split(matches[i], split_points)
+            row = [blocks[0].tobytes()]
+            for site_insertions, block in zip(insertions[i], blocks[1:]):
+                row.append(site_insertions[site_insertions != ord('-')].tobytes())
+                row.append(block.tobytes())
+            f.write(f'>{name}\n{b"".join(row).decode("ascii")}\n')
+
+
+def _hhr_line(kind: str, name: str, start: int, sequence: str, end: int, length: int):
+    return f'{kind} {name[:14]:<15}{start:>4} {sequence} {end:>4} ({length})\n'
+
+
+def _write_hhr(path: str, target: str, query: str, num_hits: int, rng):
+    """Writes HHsearch hits aligning random query segments to PDB chains."""
+    num_res = len(query)
+    with open(path, 'w') as f:
+        f.write(f'Query         {target}\nMatch_columns {num_res}\nNo_of_seqs    1 out of 1\n\n')
+        f.write(' No Hit                             Prob E-value P-value  Score    SS Cols '
+                'Query HMM  Template HMM\n')
+        for hit in range(1, num_hits + 1):
+            f.write(f'{hit:>3} {hit:04d}_A\n')
+        for hit in range(1, num_hits + 1):
+            name = f'{hit:04d}_A'
+            query_start = int(rng.integers(0, num_res // 2))
+            query_end = int(rng.integers(query_start + 1, num_res + 1))
+            segment = np.frombuffer(query[query_start:query_end].encode('ascii'), dtype=np.uint8).copy()
+            substituted = rng.random(segment.shape) < 0.4
+            segment[substituted] = rng.choice(_AMINO_ACIDS, size=int(substituted.sum()))
+            f.write(f'\nNo {hit}\n>{name} mol:protein length:{len(segment)}  SYNTHETIC PROTEIN\n')
+            f.write(f'Probab=99.{hit:02d}  E-value=1e-{hit}  Score=200.0  '
+                    f'Aligned_cols={len(segment)}  Identities=60%  Similarity=0.800  '
+                    f'Sum_probs=90.0  Template_Neff=5.000\n')
+            # HHsearch wraps alignments in blocks of 80 columns
+            for offset in range(0, len(segment), 80):
+                q_block = query[query_start + offset:min(query_start + offset + 80, query_end)]
+                t_block = segment[offset:offset + 80].tobytes().decode('ascii')
+                f.write('\n')
+                f.write(_hhr_line('Q', target, query_start + offset + 1, q_block,
+                                  query_start + offset + len(q_block), num_res))
+                f.write(_hhr_line('Q', 'Consensus', query_start + offset + 1, q_block.lower(),
+                                  query_start + offset + len(q_block), num_res))
+                f.write(' ' * 22 + '|' * len(q_block) + '\n')
+                f.write(_hhr_line('T', 'Consensus', offset + 1, t_block.lower(),
+                                  offset + len(t_block), len(segment)))
+                f.write(_hhr_line('T', name, offset + 1, t_block,
+                                  offset + len(t_block), len(segment)))
+        f.write('\nDone!\n')
+
+
+def _generate_inputs(work_dir: str, target: str, num_rows: int, seed: int):
+    """Writes the synthetic inputs of a target and returns their paths."""
+    rng = np.random.default_rng(seed)
+    sequence_path = os.path.join(FLAGS.sequences_dir, f'{target}.fasta')
+    query, _ = _read_query(sequence_path)
+    matches, sites, insertions = _synthetic_alignment(query, num_rows, rng)
+    paths = {
+        'sequence': sequence_path,
+        'sto': os.path.join(work_dir, f'{target}_{num_rows}.sto'),
+        'a3m': os.path.join(work_dir, f'{target}_{num_rows}.a3m'),
+        'hhr': os.path.join(work_dir, f'{target}_{num_rows}.hhr'),
+        'bundle': os.path.join(work_dir, f'{target}_{num_rows}.npz'),
+        'pickle': os.path.join(work_dir, f'{target}_{num_rows}.pkl'),
+    }
+    _write_stockholm(paths['sto'], target, matches, sites, insertions)
+    _write_a3m(paths['a3m'], target, matches, sites, insertions)
+    _write_hhr(paths['hhr'], target, query, FLAGS.num_template_hits, rng)
+    return paths
+
+
+def _reset_peak_rss() -> bool:
+    """Resets the peak RSS of the process, which only Linux supports."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _proc_status_bytes(field: str) -> Optional[int]:
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(f'{field}:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _peak_rss_bytes() -> int:
+    peak_rss = _proc_status_bytes('VmHWM')
+    if peak_rss is not None:
+        return peak_rss
+    # Since process start; kilobytes on Linux but bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def _measure(stage_fn, repeats: int):
+    """Returns the fastest time, the largest peak RSS and the largest RSS
+    increase over the start of the stage of `stage_fn` runs.
+    """
+    seconds, peak_rss, rss_increase = [], [], []
+    for _ in range(repeats):
+        gc.collect()
+        _reset_peak_rss()
+        start_rss = _proc_status_bytes('VmRSS') or _peak_rss_bytes()
+        t0 = time.perf_counter()
+        stage_fn()
+        seconds.append(time.perf_counter() - t0)
+        peak_rss.append(_peak_rss_bytes())
+        rss_increase.append(peak_rss[-1] - start_rss)
+    return min(seconds), max(peak_rss), max(rss_increase)
+
+
+def _consume(records):
+    for _ in records:
+        pass
+
+
+def _stages(paths: dict):
+    """Returns the benchmarked stages as (name, function, rows, bytes) tuples.
+
+    `rows` and `bytes` are the work done by one call of the function and
+    are used to report throughput.
+    """
+    query, description = _read_query(paths['sequence'])
+    with open(paths['sto']) as f:
+        stockholm = f.read()
+    records = {msa_format: list(_read_msa(paths[msa_format], msa_format))
+               for msa_format in ['sto', 'a3m']}
+    features = _make_msa_features([records['sto'], records['a3m']])
+    features.update(_make_sequence_features(query, description, len(query)))
+    num_rows = len(records['sto'])
+    num_hits = FLAGS.num_template_hits
+    with open(paths['hhr']) as f:
+        hhr = f.read()
+    sizes = {name: os.path.getsize(paths[name]) for name in ['sto', 'a3m', 'hhr']}
+    features_size = sum(value.nbytes for value in features.values())
+
+    def write_pickle():
+        with open(paths['pickle'], 'wb') as f:
+            pickle.dump(features, f, protocol=4)
+
+    return [
+        ('read_msa_sto', lambda: _consume(_read_msa(paths['sto'], 'sto')), num_rows, sizes['sto']),
+        ('read_msa_a3m', lambda: _consume(_read_msa(paths['a3m'], 'a3m')), num_rows, sizes['a3m']),
+        ('convert_stockholm_to_a3m', lambda: parsers.convert_stockholm_to_a3m(stockholm),
+         num_rows, sizes['sto']),
+        ('make_msa_features', lambda: _make_msa_features([records['sto'], records['a3m']]),
+         2 * num_rows, sizes['sto'] + sizes['a3m']),
+        ('make_sequence_features',
+         lambda: _make_sequence_features(query, description, len(query)), 1, len(query)),
+        ('parse_hhr', lambda: parsers.parse_hhr(hhr), num_hits, sizes['hhr']),
+        ('write_feature_bundle', lambda: write_feature_bundle(features, paths['bundle'], compact=True),
+         len(features['msa']), features_size),
+        ('write_pickle', write_pickle, len(features['msa']), features_size),
+    ]
+
+
+def _run(work_dir: str):
+    results = {}
+    for target in FLAGS.targets:
+        for num_rows in [int(depth) for depth in FLAGS.depths]:
+            paths = _generate_inputs(work_dir, target, num_rows, FLAGS.seed)
+            for stage, stage_fn, rows, size in _stages(paths):
+                seconds, peak_rss, rss_increase = _measure(stage_fn, FLAGS.repeats)
+                case = f'{target}/{num_rows}/{stage}'
+                results[case] = {
+                    'seconds': seconds,
+                    'rows_per_second': rows / max(seconds, 1e-9),
+                    'mib_per_second': size / 2**20 / max(seconds, 1e-9),
+                    'peak_rss_mib': peak_rss / 2**20,
+                    'rss_increase_mib': rss_increase / 2**20,
+                }
+                print(f'{case:<42} {seconds:9.4f}s {rows / max(seconds, 1e-9):12.0f} rows/s '
+                      f'{size / 2**20 / max(seconds, 1e-9):9.1f} MiB/s '
+                      f'{peak_rss / 2**20:9.1f} MiB peak RSS (+{rss_increase / 2**20:.1f})')
+            for path in paths.values():
+                if path.startswith(work_dir) and os.path.exists(path):
+                    os.remove(path)
+    return results
+
+
+def _regressions(results: dict, baseline: dict):
+    """Returns descriptions of the stages that regressed against the baseline."""
+    regressions = []
+    for case, expected in baseline['results'].items():
+        actual = results.get(case)
+        if actual is None:
+            continue
+        slowdown = actual['seconds'] - expected['seconds']
+        if slowdown > max(expected['seconds'] * FLAGS.time_tolerance, FLAGS.min_time_delta):
+            regressions.append(
+                f'{case}: {actual["seconds"]:.4f}s, baseline {expected["seconds"]:.4f}s '
+                f'({actual["seconds"] / expected["seconds"] - 1:+.0%})')
+        if actual['peak_rss_mib'] > expected['peak_rss_mib'] * (1 + FLAGS.rss_tolerance):
+            regressions.append(
+                f'{case}: {actual["peak_rss_mib"]:.1f} MiB peak RSS, baseline '
+                f'{expected["peak_rss_mib"]:.1f} MiB '
+                f'({actual["peak_rss_mib"] / expected["peak_rss_mib"] - 1:+.0%})')
+    return regressions
+
+
+def _main(argv):
+    if FLAGS.update_baseline and not FLAGS.baseline_path:
+        raise app.UsageError('--update_baseline requires --baseline_path')
+    if not _reset_peak_rss():
+        print('Peak RSS cannot be reset on this platform and is reported since process start')
+
+    if FLAGS.work_dir:
+        os.makedirs(FLAGS.work_dir, exist_ok=True)
+        results = _run(FLAGS.work_dir)
+    else:
+        with tempfile.TemporaryDirectory() as work_dir:
+            results = _run(work_dir)
+
+    report = {
+        'version': _RESULTS_VERSION,
+        'host': {'platform': platform.platform(), 'python': platform.python_version(),
+                 'cpu_count': os.cpu_count()},
+        'config': {'depths': [int(depth) for depth in FLAGS.depths],
+                   'num_template_hits': FLAGS.num_template_hits,
+                   'repeats': FLAGS.repeats, 'seed': FLAGS.seed},
+        'results': results,
+    }
+    if FLAGS.results_path:
+        with open(FLAGS.results_path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if not FLAGS.baseline_path:
+        return 0
+    if FLAGS.update_baseline:
+        with open(FLAGS.baseline_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Wrote baseline to {FLAGS.baseline_path}')
+        return 0
+
+    with open(FLAGS.baseline_path) as f:
+        baseline = json.load(f)
+    if baseline.get('config') != report['config']:
+        print('Warning: the baseline was recorded with a different configuration')
+    regressions = _regressions(results, baseline)
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    print(f'{len(regressions)} regressions against {FLAGS.baseline_path}')
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    app.run(_main)
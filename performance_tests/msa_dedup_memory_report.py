@@ -0,0 +1,115 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Reports memory retained by MSA deduplication on large synthetic MSAs.
+
+Compares the original set of full sequence strings with digest based
+deduplication, with and without exact verification. Only the memory held by
+the deduplication state is reported; the encoded rows are the output of
+aggregation in every mode and are excluded.
+
+python performance_tests/msa_dedup_memory_report.py --num_rows=200000 --num_res=1000
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from absl import app
+from absl import flags
+
+_REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(_REPO_ROOT, 'alphafold_components', 'alphafold_runners'))
+
+from msa_dedup import SequenceDeduplicator
+from msa_encoding import MsaRowBuffer
+
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('num_rows', 100_000, 'Number of rows in the synthetic MSA')
+flags.DEFINE_integer('num_res', 1000, 'Number of columns in the synthetic MSA')
+flags.DEFINE_float('duplicate_fraction', 0.2, 'Fraction of rows repeating an earlier row')
+flags.DEFINE_integer('seed', 0, 'Random seed')
+
+_ALPHABET = np.frombuffer(b'ACDEFGHIKLMNPQRSTVWY-', dtype=np.uint8)
+
+
+def _synthetic_rows(num_rows, num_res, duplicate_fraction, seed):
+    """Yields aligned rows without retaining them."""
+    rng = np.random.default_rng(seed)
+    emitted = []
+    for _ in range(num_rows):
+        if emitted and rng.random() < duplicate_fraction:
+            yield emitted[rng.integers(len(emitted))]
+            continue
+        row = rng.choice(_ALPHABET, size=num_res).tobytes().decode('ascii')
+        # Keep a small pool of earlier rows to draw duplicates from
+        if len(emitted) < 100:
+            emitted.append(row)
+        yield row
+
+
+def _exact_strings(rows):
+    seen = set()
+    for sequence in rows:
+        if sequence not in seen:
+            seen.add(sequence)
+    return seen, None
+
+
+def _digests(rows, verify):
+    buffer = MsaRowBuffer(num_res=FLAGS.num_res, dtype=np.int8)
+    dedup = SequenceDeduplicator(verify=verify, rows=buffer)
+    for sequence in rows:
+        if dedup.add(sequence):
+            buffer.append(sequence, np.zeros(FLAGS.num_res, dtype=np.int32))
+    return dedup, buffer
+
+
+def _measure(label, dedup_fn):
+    rows = _synthetic_rows(
+        FLAGS.num_rows, FLAGS.num_res, FLAGS.duplicate_fraction, FLAGS.seed)
+    tracemalloc.start()
+    t0 = time.time()
+    state, buffer = dedup_fn(rows)
+    elapsed = time.time() - t0
+    total, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # The row buffer is the aggregation output, not deduplication overhead
+    output_bytes = 0
+    if buffer is not None:
+        output_bytes = sum(chunk.nbytes for chunk in buffer._msa_chunks)
+        output_bytes += sum(chunk.nbytes for chunk in buffer._deletion_chunks)
+    retained = total - output_bytes
+    print(f'{label:>16}: {len(state):>9} unique rows, '
+          f'{retained / 2**20:10.1f} MiB retained, '
+          f'{retained / max(len(state), 1):8.1f} B/row, {elapsed:6.2f}s')
+    del state, buffer
+
+
+def _main(argv):
+    print(f'{FLAGS.num_rows} rows x {FLAGS.num_res} columns, '
+          f'{FLAGS.duplicate_fraction:.0%} duplicates')
+    _measure('exact strings', _exact_strings)
+    _measure('digests', lambda rows: _digests(rows, verify=False))
+    _measure('digests+verify', lambda rows: _digests(rows, verify=True))
+
+
+if __name__ == "__main__":
+    app.run(_main)
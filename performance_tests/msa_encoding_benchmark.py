@@ -0,0 +1,94 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks lookup-table MSA encoding against the per-residue dict lookup.
+
+Synthetic MSAs are seeded from the FASTA files in `sequences/`. For every
+target the legacy encoding and `msa_encoding.encode_sequences` are timed and
+their outputs compared element by element.
+
+python performance_tests/msa_encoding_benchmark.py --num_rows=20000
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+
+from absl import app
+from absl import flags
+
+_REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(_REPO_ROOT, 'alphafold_components', 'alphafold_runners'))
+
+from alphafold.common import residue_constants
+from alphafold.data import parsers
+
+from msa_encoding import encode_sequences
+
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('sequences_dir', os.path.join(_REPO_ROOT, 'sequences'), 'Directory with FASTA targets')
+flags.DEFINE_list('targets', ['T1031', 'T1044', 'T1050', 'T1061'], 'Targets to benchmark')
+flags.DEFINE_integer('num_rows', 10_000, 'Number of rows in each synthetic MSA')
+flags.DEFINE_integer('seed', 0, 'Random seed used to mutate the query')
+
+# Residues sampled into synthetic rows, including the ambiguous HHblits codes
+_ALPHABET = np.frombuffer(b'ACDEFGHIKLMNPQRSTVWYBZXUOJ-', dtype=np.uint8)
+
+
+def _synthetic_msa(query: str, num_rows: int, seed: int):
+    """Returns aligned rows derived from the query by random substitutions."""
+    rng = np.random.default_rng(seed)
+    query_bytes = np.frombuffer(query.encode('ascii'), dtype=np.uint8)
+    rows = np.tile(query_bytes, (num_rows, 1))
+    mutated = rng.random(rows.shape) < 0.3
+    rows[mutated] = rng.choice(_ALPHABET, size=int(mutated.sum()))
+    return [query] + [row.tobytes().decode('ascii') for row in rows[1:]]
+
+
+def _legacy_encode(sequences):
+    """The original `_make_msa_features` encoding."""
+    int_msa = []
+    for sequence in sequences:
+        int_msa.append(
+            [residue_constants.HHBLITS_AA_TO_ID[res] for res in sequence])
+    return np.array(int_msa, dtype=np.int32)
+
+
+def _main(argv):
+    for target in FLAGS.targets:
+        with open(os.path.join(FLAGS.sequences_dir, f'{target}.fasta')) as f:
+            sequences, _ = parsers.parse_fasta(f.read())
+        sequences = _synthetic_msa(sequences[0], FLAGS.num_rows, FLAGS.seed)
+        num_res = len(sequences[0])
+
+        t0 = time.time()
+        expected = _legacy_encode(sequences)
+        t1 = time.time()
+        actual = encode_sequences(sequences, num_res=num_res, dtype=np.int32)
+        t2 = time.time()
+
+        if actual.dtype != expected.dtype or not np.array_equal(actual, expected):
+            raise RuntimeError(f'Encoding mismatch for target {target}')
+
+        print(f'{target}: {len(sequences)} x {num_res} '
+              f'legacy {t1-t0:.3f}s, lookup table {t2-t1:.3f}s, '
+              f'speedup {(t1-t0)/max(t2-t1, 1e-9):.1f}x, outputs identical')
+
+
+if __name__ == "__main__":
+    app.run(_main)
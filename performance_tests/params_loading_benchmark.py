@@ -0,0 +1,151 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks loading model parameters.
+
+Compares the original loader, which reads the `.npz` into a bytes object
+before decompressing it, with reading the `.npz` directly and with memory
+mapping parameters converted by `model_params`. Every loader runs in a
+fresh process and reports its load time, the time to read every array
+once, as moving the parameters to the device does, and its peak RSS.
+Memory mapped pages are file backed and can be dropped by the kernel, so
+the anonymous RSS after reading is reported as well.
+
+Without --params_dir synthetic parameters of --synthetic_mib are used.
+
+python performance_tests/params_loading_benchmark.py --params_dir=/data/params --model_name=model_1
+"""
+
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from absl import app
+from absl import flags
+
+_REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(_REPO_ROOT, 'alphafold_components', 'alphafold_runners'))
+
+from model_params import convert_params, converted_params_dir, load_flat_params, params_npz_path
+
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('params_dir', None, 'Directory with params_<model_name>.npz files')
+flags.DEFINE_string('model_name', 'model_1', 'Model whose parameters are loaded')
+flags.DEFINE_integer('synthetic_mib', 370, 'Size of the synthetic parameters')
+
+
+def _load_bytesio(params_dir, model_name):
+    """The original `_get_model_haiku_params` loading."""
+    import io
+    with open(params_npz_path(params_dir, model_name), 'rb') as f:
+        params = np.load(io.BytesIO(f.read()), allow_pickle=False)
+    return {key: params[key] for key in params.files}
+
+
+def _load_npz(params_dir, model_name):
+    return load_flat_params(params_dir, model_name, mmap=False)
+
+
+def _load_mmap(params_dir, model_name):
+    return load_flat_params(params_dir, model_name, mmap=True)
+
+
+_LOADERS = {
+    'bytesio': _load_bytesio,
+    'npz': _load_npz,
+    'mmap': _load_mmap,
+}
+
+
+def _status_mib(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(f'{field}:'):
+                return int(line.split()[1]) / 1024
+    return float('nan')
+
+
+def _measure(loader_name, params_dir, model_name):
+    """Runs in a fresh process, so peak RSS only covers this loader.
+
+    The process-wide `ru_maxrss` survives fork and exec, so the high water
+    mark of the process memory is read from /proc instead.
+    """
+    start_rss = _status_mib('VmRSS')
+    t0 = time.perf_counter()
+    params = _LOADERS[loader_name](params_dir, model_name)
+    t1 = time.perf_counter()
+    checksum = sum(float(np.sum(array, dtype=np.float64)) for array in params.values())
+    t2 = time.perf_counter()
+    return {
+        'load_seconds': t1 - t0,
+        'read_seconds': t2 - t1,
+        'start_rss_mib': start_rss,
+        'peak_rss_mib': _status_mib('VmHWM'),
+        'anon_rss_mib': _status_mib('RssAnon'),
+        'checksum': checksum,
+    }
+
+
+def _write_synthetic_params(params_dir, model_name, size_mib):
+    rng = np.random.default_rng(0)
+    params = {}
+    num_layers = 48
+    layer_size = size_mib * 2**20 // 4 // num_layers
+    for i in range(num_layers):
+        scope = f'alphafold/alphafold_iteration/evoformer/evoformer_iteration_{i}'
+        params[f'{scope}//weights'] = rng.random(layer_size, dtype=np.float32)
+        params[f'{scope}//bias'] = np.zeros(128, dtype=np.float32)
+    np.savez(params_npz_path(params_dir, model_name), **params)
+
+
+def _run(params_dir):
+    npz_path = params_npz_path(params_dir, FLAGS.model_name)
+    print(f'{npz_path}: {os.path.getsize(npz_path) / 2**20:.1f} MiB')
+    t0 = time.perf_counter()
+    convert_params(npz_path, converted_params_dir(params_dir, FLAGS.model_name))
+    print(f'One-time conversion: {time.perf_counter() - t0:.2f}s')
+
+    context = multiprocessing.get_context('spawn')
+    checksums = set()
+    for loader_name in _LOADERS:
+        with context.Pool(1) as pool:
+            result = pool.apply(_measure, (loader_name, params_dir, FLAGS.model_name))
+        checksums.add(result['checksum'])
+        print(f'{loader_name:>8}: load {result["load_seconds"]:6.2f}s, '
+              f'read {result["read_seconds"]:6.2f}s, '
+              f'peak RSS {result["peak_rss_mib"]:7.1f} MiB '
+              f'(+{result["peak_rss_mib"] - result["start_rss_mib"]:.1f}), '
+              f'anonymous RSS {result["anon_rss_mib"]:7.1f} MiB')
+    if len(checksums) != 1:
+        raise RuntimeError('Loaders returned different parameters')
+
+
+def _main(argv):
+    if FLAGS.params_dir:
+        _run(FLAGS.params_dir)
+        return
+    with tempfile.TemporaryDirectory() as params_dir:
+        _write_synthetic_params(params_dir, FLAGS.model_name, FLAGS.synthetic_mib)
+        _run(params_dir)
+
+
+if __name__ == "__main__":
+    app.run(_main)
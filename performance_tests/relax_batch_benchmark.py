@@ -0,0 +1,88 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks batch relaxation against sequential relaxation.
+
+The sequential baseline relaxes the structures one after another in one
+process, with OpenMM using as many CPU threads as it chooses, as the relax
+runner does for a single structure. The batch relaxes them with
+`relax_runner.relax_batch`, in a pool of single-threaded workers. Each
+runs in a fresh process, and the speedup is the ratio of their wall times.
+
+python performance_tests/relax_batch_benchmark.py --pdb_dir=/output/T1050 --num_workers=8
+"""
+
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+from absl import app
+from absl import flags
+
+_REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(_REPO_ROOT, 'alphafold_components', 'alphafold_runners'))
+
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('pdb_dir', None, 'Directory with unrelaxed PDBs')
+flags.DEFINE_list('pdb_paths', None, 'Unrelaxed PDBs, instead of --pdb_dir')
+flags.DEFINE_integer('num_workers', None, 'Batch workers, one per core by default')
+
+
+def _pdb_paths():
+    if FLAGS.pdb_paths:
+        return FLAGS.pdb_paths
+    return sorted(os.path.join(FLAGS.pdb_dir, name)
+                  for name in os.listdir(FLAGS.pdb_dir) if name.endswith('.pdb'))
+
+
+def _relax_sequentially(pdb_paths):
+    """Runs in a fresh process, so OpenMM picks its default thread count."""
+    import relax_runner
+
+    t0 = time.perf_counter()
+    for path in pdb_paths:
+        relax_runner.relax_protein(path)
+    return time.perf_counter() - t0
+
+
+def _relax_batch(pdb_paths, num_workers):
+    import relax_runner
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        t0 = time.perf_counter()
+        batch_stats = relax_runner.relax_batch(pdb_paths, output_dir, num_workers=num_workers)
+        return time.perf_counter() - t0, batch_stats
+
+
+def _main(argv):
+    pdb_paths = _pdb_paths()
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1) as pool:
+        sequential_seconds = pool.apply(_relax_sequentially, (pdb_paths,))
+    print(f'Sequential: {len(pdb_paths)} structures in {sequential_seconds:.1f}s')
+
+    with context.Pool(1) as pool:
+        batch_seconds, batch_stats = pool.apply(_relax_batch, (pdb_paths, FLAGS.num_workers))
+    print(f'Batch: {len(pdb_paths)} structures with {batch_stats["num_workers"]} workers '
+          f'in {batch_seconds:.1f}s, parallel efficiency '
+          f'{batch_stats["parallel_efficiency"]:.0%}, {batch_stats["num_failed"]} failed')
+    print(f'Speedup over sequential: {sequential_seconds / batch_seconds:.2f}x')
+
+
+if __name__ == "__main__":
+    app.run(_main)
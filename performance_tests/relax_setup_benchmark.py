@@ -0,0 +1,116 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks reusing the OpenMM setup of relaxations.
+
+Cleans the unrelaxed structures as AlphaFold's relaxation does, then times
+the setup of their minimization, the force field, system and context, the
+way AlphaFold sets up every minimization and with `relax_setup_cache`
+shared by the structures. The cache pays off for the models or seeds of one
+sequence, e.g. the unrelaxed PDBs of one target of the predict runner.
+
+With --relax the structures are also relaxed end to end without and with
+the cache, each in a fresh process.
+
+python performance_tests/relax_setup_benchmark.py --pdb_dir=/output/T1050 --relax
+"""
+
+import multiprocessing
+import os
+import sys
+import time
+
+from absl import app
+from absl import flags
+
+_REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(_REPO_ROOT, 'alphafold_components', 'alphafold_runners'))
+
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('pdb_dir', None, 'Directory with unrelaxed PDBs')
+flags.DEFINE_list('pdb_paths', None, 'Unrelaxed PDBs, instead of --pdb_dir')
+flags.DEFINE_float('stiffness', 10.0, 'Restraint stiffness, in kcal/mol/A^2')
+flags.DEFINE_boolean('use_gpu', False, 'Set up the CUDA platform instead of CPU')
+flags.DEFINE_boolean('relax', False, 'Also time full relaxations')
+
+
+def _pdb_paths():
+    if FLAGS.pdb_paths:
+        return FLAGS.pdb_paths
+    return sorted(os.path.join(FLAGS.pdb_dir, name)
+                  for name in os.listdir(FLAGS.pdb_dir) if name.endswith('.pdb'))
+
+
+def _time_setup(pdb_paths):
+    import io
+
+    from alphafold.common import protein
+    from alphafold.relax import amber_minimize
+    from relax_setup_cache import ENERGY, LENGTH, RelaxSetupCache, openmm_app
+
+    stiffness = FLAGS.stiffness * ENERGY / (LENGTH**2)
+    pdbs = []
+    for path in pdb_paths:
+        with open(path) as f:
+            prot = protein.from_pdb_string(f.read())
+        pdbs.append(openmm_app.PDBFile(io.StringIO(amber_minimize.clean_protein(prot))))
+
+    shared_cache = RelaxSetupCache()
+    for path, pdb in zip(pdb_paths, pdbs):
+        # A new cache per structure sets up everything, as AlphaFold does
+        t0 = time.perf_counter()
+        RelaxSetupCache().simulation(pdb, stiffness, 'non_hydrogen', [], FLAGS.use_gpu)
+        uncached_seconds = time.perf_counter() - t0
+        hits = shared_cache.hits
+        t0 = time.perf_counter()
+        shared_cache.simulation(pdb, stiffness, 'non_hydrogen', [], FLAGS.use_gpu)
+        cached_seconds = time.perf_counter() - t0
+        print(f'{os.path.basename(path)}: {pdb.topology.getNumAtoms()} atoms, '
+              f'setup {uncached_seconds:6.2f}s uncached, {cached_seconds:6.2f}s cached '
+              f'({"hit" if shared_cache.hits > hits else "miss"})')
+
+
+def _relax(pdb_paths, setup_cache, use_gpu):
+    """Runs in a fresh process, where flags are not parsed."""
+    import relax_runner
+    import relax_setup_cache
+
+    if setup_cache:
+        relax_setup_cache.install()
+    seconds = []
+    for path in pdb_paths:
+        with open(path) as f:
+            _, stats = relax_runner.relax_structure(f.read(), use_gpu=use_gpu)
+        seconds.append(stats['seconds'])
+    return seconds
+
+
+def _main(argv):
+    pdb_paths = _pdb_paths()
+    _time_setup(pdb_paths)
+    if not FLAGS.relax:
+        return
+
+    context = multiprocessing.get_context('spawn')
+    for setup_cache in [False, True]:
+        with context.Pool(1) as pool:
+            seconds = pool.apply(_relax, (pdb_paths, setup_cache, FLAGS.use_gpu))
+        print(f'Relax {"with" if setup_cache else "without"} the setup cache: '
+              f'{sum(seconds):.1f}s, {", ".join(f"{s:.1f}" for s in seconds)}s per structure')
+
+
+if __name__ == "__main__":
+    app.run(_main)
@@ -28,8 +28,8 @@ from kfp import components
 
 import config
 from alphafold_components import  (
-    RelaxProteinOp, AggregateFeaturesOp, ModelPredictOp, 
-    JackhmmerOp, HHBlitsOp, HHSearchOp, ImportSeqenceOp)
+    RelaxProteinOp, AggregateFeaturesOp, ModelPredictOp, RankPredictionsOp,
+    RelaxTopKOp, JackhmmerOp, HHBlitsOp, HHSearchOp, ImportSeqenceOp)
 
 
 @dsl.pipeline(name=config.PIPELINE_NAME, description=config.PIPELINE_DESCRIPTION)
@@ -41,9 +41,12 @@ def pipeline(
     max_template_date: str='2020-05-14',
     models: List[Mapping]=[{'model_name': 'model_1', 'random_seed': 1}],
     use_gpu_for_relaxation: bool=True,
+    relax_models: bool=True,
+    relax_top_k: str='all',
     num_ensemble: int=1,
     reference_datasets_uri: str=config.REFERENCE_DATASETS_URI, 
-    model_params_uri: str=config.MODEL_PARAMS_GCS_LOCATION):
+    model_params_uri: str=config.MODEL_PARAMS_GCS_LOCATION,
+    predictions_path: str=config.PREDICTIONS_PATH):
     """Runs AlphaFold inference."""
 
     input_sequence = dsl.importer(
@@ -136,6 +139,10 @@ def pipeline(
     )
     aggregate_features.set_display_name('Aggregate features')#.set_caching_options(enable_caching=True)
 
+    # The loop has no fan-in, so the predict steps also write their
+    # predictions to a directory of the run, which the rank step reads
+    predictions_dir = f'{predictions_path}/{dsl.PIPELINE_JOB_ID_PLACEHOLDER}'
+
     # Think what to do with random seed when switch to Parallel loop
     with dsl.ParallelFor(models) as model:
         model_predict = ModelPredictOp(
@@ -143,7 +150,8 @@ def pipeline(
             model_params=model_parameters.output,
             model_name=model.model_name,
             num_ensemble=num_ensemble,
-            random_seed=model.random_seed
+            random_seed=model.random_seed,
+            predictions_dir=predictions_dir,
         )
         model_predict.set_display_name('Predict')#.set_caching_options(enable_caching=True)
         model_predict.set_cpu_limit(config.CPU_LIMIT)
@@ -153,20 +161,44 @@ def pipeline(
         model_predict.set_env_variable("TF_FORCE_UNIFIED_MEMORY", config.TF_FORCE_UNIFIED_MEMORY)
         model_predict.set_env_variable("XLA_PYTHON_CLIENT_MEM_FRACTION", config.XLA_PYTHON_CLIENT_MEM_FRACTION)
 
-        relax_protein = RelaxProteinOp(
-            unrelaxed_protein=model_predict.outputs['unrelaxed_protein'],
-            use_gpu=use_gpu_for_relaxation,
-        )
-        relax_protein.set_display_name('Relax protein')#.set_caching_options(enable_caching=True)
-        relax_protein.set_cpu_limit(config.RELAX_CPU_LIMIT)
-        relax_protein.set_memory_limit(config.RELAX_MEMORY_LIMIT)
-        relax_protein.set_gpu_limit(config.RELAX_GPU_LIMIT)
-        relax_protein.add_node_selector_constraint(config.GKE_ACCELERATOR_KEY, config.RELAX_GPU_TYPE)
-        relax_protein.set_env_variable("TF_FORCE_UNIFIED_MEMORY", config.TF_FORCE_UNIFIED_MEMORY)
-        relax_protein.set_env_variable("XLA_PYTHON_CLIENT_MEM_FRACTION", config.XLA_PYTHON_CLIENT_MEM_FRACTION)
+        # Every model is relaxed as soon as it is predicted unless only the
+        # top ranked ones are, after the rank step
+        with dsl.Condition(relax_models == True, name='relax'):
+            with dsl.Condition(relax_top_k == 'all', name='relax-all'):
+                relax_protein = RelaxProteinOp(
+                    unrelaxed_protein=model_predict.outputs['unrelaxed_protein'],
+                    use_gpu=use_gpu_for_relaxation,
+                )
+                relax_protein.set_display_name('Relax protein')#.set_caching_options(enable_caching=True)
+                relax_protein.set_cpu_limit(config.RELAX_CPU_LIMIT)
+                relax_protein.set_memory_limit(config.RELAX_MEMORY_LIMIT)
+                relax_protein.set_gpu_limit(config.RELAX_GPU_LIMIT)
+                relax_protein.add_node_selector_constraint(config.GKE_ACCELERATOR_KEY, config.RELAX_GPU_TYPE)
+                relax_protein.set_env_variable("TF_FORCE_UNIFIED_MEMORY", config.TF_FORCE_UNIFIED_MEMORY)
+                relax_protein.set_env_variable("XLA_PYTHON_CLIENT_MEM_FRACTION", config.XLA_PYTHON_CLIENT_MEM_FRACTION)
+
+    rank_predictions = RankPredictionsOp(
+        predictions_dir=predictions_dir,
+    ).after(model_predict)
+    rank_predictions.set_display_name('Rank predictions')
+
+    with dsl.Condition(relax_models == True, name='relax-top-k'):
+        with dsl.Condition(relax_top_k != 'all', name='relax-selected'):
+            relax_top = RelaxTopKOp(
+                ranking=rank_predictions.outputs['ranking'],
+                predictions_dir=predictions_dir,
+                top_k=relax_top_k,
+                use_gpu=use_gpu_for_relaxation,
+            )
+            relax_top.set_display_name('Relax top ranked proteins')
+            relax_top.set_cpu_limit(config.RELAX_CPU_LIMIT)
+            relax_top.set_memory_limit(config.RELAX_MEMORY_LIMIT)
+            relax_top.set_gpu_limit(config.RELAX_GPU_LIMIT)
+            relax_top.add_node_selector_constraint(config.GKE_ACCELERATOR_KEY, config.RELAX_GPU_TYPE)
+            relax_top.set_env_variable("TF_FORCE_UNIFIED_MEMORY", config.TF_FORCE_UNIFIED_MEMORY)
+            relax_top.set_env_variable("XLA_PYTHON_CLIENT_MEM_FRACTION", config.XLA_PYTHON_CLIENT_MEM_FRACTION)
  
 
-
 def _main(argv):
     compiler.Compiler().compile(
         pipeline_func=pipeline,